@@ -0,0 +1,67 @@
+"""
+Measures how fast translate_chn splits large texts into chunks: plan_chunks,
+plan_chunks_streaming and a get_next_chunk loop over the whole text.
+
+    python3 bench/chunking.py --sizes 1 8 --output chunking.json
+"""
+import argparse
+
+from common import make_text, best_of, write_results
+import translate_chn
+
+
+def split_with_get_next_chunk(text: str, max_tokens: int) -> int:
+    """
+    Returns:
+        int: The number of chunks found by calling get_next_chunk until the end of the text.
+    """
+    chunks = 0
+    position = 0
+    is_end = False
+    while not is_end:
+        _, position, _, is_end = translate_chn.get_next_chunk(text, position, max_tokens)
+        chunks += 1
+    return chunks
+
+
+def run(sizes_mb: list, max_tokens=1365, repeat=3) -> dict:
+    """
+    Args:
+        sizes_mb (list): The text sizes to measure, in MB.
+        max_tokens (int): The token limit of a chunk.
+        repeat (int): Runs per measurement; the fastest one counts.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    # Load the tokenizer outside of the measurements
+    translate_chn.get_encoding()
+    results = []
+    for size_mb in sizes_mb:
+        text = make_text(int(size_mb * 1024 * 1024))
+        data = text.encode('utf-8')
+        megabytes = len(data) / 1024 / 1024
+        plan_seconds = best_of(lambda: translate_chn.plan_chunks(data, max_tokens), repeat)
+        streaming_seconds = best_of(lambda: translate_chn.plan_chunks_streaming(data, max_tokens), repeat)
+        next_chunk_seconds = best_of(lambda: split_with_get_next_chunk(text, max_tokens), repeat)
+        results.append({
+            'size_mb': round(megabytes, 2),
+            'chunks': len(translate_chn.plan_chunks(data, max_tokens)),
+            'plan_chunks_seconds': plan_seconds,
+            'plan_chunks_mb_per_second': megabytes / plan_seconds,
+            'plan_chunks_streaming_seconds': streaming_seconds,
+            'plan_chunks_streaming_mb_per_second': megabytes / streaming_seconds,
+            'get_next_chunk_seconds': next_chunk_seconds,
+            'get_next_chunk_mb_per_second': megabytes / next_chunk_seconds,
+        })
+    return {'benchmark': 'chunking', 'max_tokens': max_tokens, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the chunking throughput of translate_chn')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 8], help='Text sizes in MB')
+    parser.add_argument('--tokens', type=int, default=1365, help='Maximum tokens per chunk')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.sizes, args.tokens, args.repeat), args.output)
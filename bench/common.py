@@ -0,0 +1,87 @@
+"""
+Helpers shared by the benchmarks: the import path of the repository, synthetic input
+text, timing and JSON output.
+
+The benchmarks never reach the network. The API is replaced by bench/mock_server.py,
+and tiktoken reads its encodings from ~/.chatgpt/data-gym-cache, where chat.py and
+translate_chn.py download them on their first run.
+"""
+import os
+import sys
+import json
+import time
+import random
+from pathlib import Path
+
+REPO_DIRECTORY = Path(__file__).resolve().parent.parent
+if str(REPO_DIRECTORY) not in sys.path:
+    sys.path.insert(0, str(REPO_DIRECTORY))
+
+WORDS = (
+    'the of and to in is was for that with as on by at from his her it an were which are this '
+    'book chapter river morning light window letter silence journey garden evening question answer'
+).split()
+
+
+def make_text(size: int, seed=0) -> str:
+    """
+    Builds English-like text of sentences and paragraphs.
+
+    Args:
+        size (int): The approximate length of the text in characters.
+        seed (int): Seed of the word choice, so that runs are repeatable.
+
+    Returns:
+        str: The text.
+    """
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 24))).capitalize()
+        sentence += rng.choice(('. ', '. ', '! ', '? ', '.\n\n'))
+        parts.append(sentence)
+        length += len(sentence)
+    return ''.join(parts)
+
+
+def use_mock_api(base_url: str):
+    """
+    Points the OpenAI clients of this process at the mock server.
+
+    Args:
+        base_url (str): The base URL of the mock server.
+    """
+    os.environ['OPENAI_API_BASE'] = base_url
+    os.environ['OPENAI_API_KEY'] = 'mock'
+
+
+def best_of(function, repeat=3) -> float:
+    """
+    Args:
+        function (Callable): The code to time, called without arguments.
+        repeat (int): How many times to run it.
+
+    Returns:
+        float: The shortest run time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def write_results(results: dict, output=None):
+    """
+    Prints the results as JSON and optionally writes them to a file.
+
+    Args:
+        results (dict): The benchmark results.
+        output (str): The file to write, or None.
+    """
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output:
+        Path(output).write_text(text + '\n')
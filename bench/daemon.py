@@ -0,0 +1,132 @@
+"""
+Measures chat_daemon.py against the mock server: the time from launching a client to
+being attached to a session, to compare with bench/startup.py, and the memory of the
+daemon as the number of attached sessions grows (Linux only).
+
+    python3 bench/daemon.py --runs 10 --sessions 1 10 50 --output daemon.json
+"""
+import sys
+import time
+import argparse
+import statistics
+import tempfile
+import subprocess
+from pathlib import Path
+
+from common import REPO_DIRECTORY, use_mock_api, write_results
+from mock_server import MockOpenAIServer
+from chat_client import DaemonClient
+
+# Runs in the child interpreter; prints READY where chat_client.py would show the prompt.
+CHILD_SCRIPT = '''
+import sys
+from chat_client import DaemonClient
+client = DaemonClient(sys.argv[1])
+client.connect(start=False)
+client.attach(save=False)
+print('READY', flush=True)
+'''
+
+
+def measure_time_to_attach(socket_path: Path) -> float:
+    """
+    Returns:
+        float: Seconds from starting the interpreter until the client is attached.
+    """
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD_SCRIPT, str(socket_path)],
+        cwd=REPO_DIRECTORY,
+        capture_output=True,
+        text=True,
+    ).stdout
+    if 'READY' not in output:
+        raise RuntimeError('The client did not attach')
+    return time.perf_counter() - start
+
+
+def wait_for_daemon(socket_path: Path, timeout=30.0) -> DaemonClient:
+    """
+    Returns:
+        DaemonClient: A client connected to the daemon once it listens.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        client = DaemonClient(socket_path)
+        try:
+            client.connect(start=False)
+            return client
+        except ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def get_rss_mb(pid: int) -> float:
+    """
+    Returns:
+        float: The resident memory of a process in MB, or 0 where /proc is missing.
+    """
+    try:
+        for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def run(runs=5, session_counts=(1, 10, 50)) -> dict:
+    """
+    Args:
+        runs (int): The number of client launches to measure.
+        session_counts (list): The numbers of attached sessions to measure the memory at.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    with MockOpenAIServer(answer_words=50) as server, tempfile.TemporaryDirectory() as directory:
+        use_mock_api(server.base_url)
+        socket_path = Path(directory) / 'daemon.sock'
+        # The daemon logs to its working directory
+        daemon = subprocess.Popen(
+            [sys.executable, str(REPO_DIRECTORY / 'chat_daemon.py'), '--socket', str(socket_path)],
+            cwd=directory,
+            stderr=subprocess.DEVNULL,
+        )
+        clients = []
+        try:
+            wait_for_daemon(socket_path).close()
+            samples = [measure_time_to_attach(socket_path) for _ in range(runs)]
+            memory = []
+            for count in session_counts:
+                while len(clients) < count:
+                    client = DaemonClient(socket_path)
+                    client.connect(start=False)
+                    client.attach(save=False)
+                    for _ in client.ask('Tell me something.'):
+                        pass
+                    clients.append(client)
+                memory.append({'sessions': count, 'rss_mb': get_rss_mb(daemon.pid)})
+        finally:
+            for client in clients:
+                client.close()
+            daemon.terminate()
+            daemon.wait()
+    return {
+        'benchmark': 'daemon',
+        'runs': runs,
+        'time_to_attach_min': min(samples),
+        'time_to_attach_median': statistics.median(samples),
+        'time_to_attach_max': max(samples),
+        'memory': memory,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the client start-up and memory of chat_daemon.py')
+    parser.add_argument('--runs', type=int, default=5, help='Number of client launches to measure')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 10, 50], help='Attached session counts')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.runs, args.sessions), args.output)
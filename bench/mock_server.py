@@ -0,0 +1,174 @@
+"""
+A local stand-in for the OpenAI chat completions API, so that the benchmarks run offline.
+
+The server answers POST /v1/chat/completions, streamed or not, with a canned answer
+of a configurable length. It can add latency before the first byte, pace the chunks
+of streamed answers and fail a share of the requests with 429 or 500. It can also
+run on its own, e.g. to try chat.py against it:
+
+    python3 bench/mock_server.py --port 8800 --latency 0.2 --chunk-interval 0.02
+    OPENAI_API_BASE=http://127.0.0.1:8800/v1 OPENAI_API_KEY=mock python3 chat.py -s
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ANSWER_PARAGRAPH = (
+    'This is a **benchmark** answer from the mock server. It has `inline code`, '
+    'a [link](https://example.com) and enough words to look like a real reply.'
+)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'MockOpenAIServer'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _send_json(self, status: int, body: dict, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, data: str):
+        payload = f'data: {data}\n\n'.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(payload), payload))
+        self.wfile.flush()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        mock = self.server
+        mock.count_request()
+        if mock.latency:
+            time.sleep(mock.latency)
+        if mock.error_rate and mock.random.random() < mock.error_rate:
+            if mock.random.random() < 0.5:
+                self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                                headers=[('Retry-After', str(mock.retry_after))])
+            else:
+                self._send_json(500, {'error': {'message': 'Server error', 'type': 'server_error'}})
+            return
+        words = mock.answer_words()
+        prompt_tokens = sum(len(m['content'].split()) for m in request['messages'])
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(words),
+                 'total_tokens': prompt_tokens + len(words)}
+        if not request.get('stream'):
+            self._send_json(200, {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()),
+                'model': request['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(words)},
+                             'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for word in words:
+            if mock.chunk_interval:
+                time.sleep(mock.chunk_interval)
+            self._send_chunk(json.dumps({
+                'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                'model': request['model'],
+                'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}],
+            }))
+        self._send_chunk('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """
+    The mock server, served from a daemon thread once started.
+
+    Use it as a context manager, or call start and stop.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, chunk_interval=0.0, error_rate=0.0, answer_words=200,
+                 retry_after=0.1, seed=0):
+        """
+        Args:
+            port (int): The port to listen on, or 0 for any free port.
+            latency (float): Seconds to wait before answering a request.
+            chunk_interval (float): Seconds between the chunks of a streamed answer.
+            error_rate (float): The share of requests that fail, half with 429 and half with 500.
+            answer_words (int): The number of words in an answer; each is one streamed chunk.
+            retry_after (float): The Retry-After of the 429 responses, in seconds.
+            seed (int): Seed of the random errors, so that runs are repeatable.
+        """
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.chunk_interval = chunk_interval
+        self.error_rate = error_rate
+        self.answer_length = answer_words
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """The URL to use as OPENAI_API_BASE."""
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def answer_words(self) -> list:
+        """
+        Returns:
+            list: The words of the answer, each with its trailing separator.
+        """
+        words = []
+        paragraph = ANSWER_PARAGRAPH.split(' ')
+        for index in range(self.answer_length):
+            words.append(paragraph[index % len(paragraph)] + ('\n\n' if index % 40 == 39 else ' '))
+        return words
+
+    def start(self) -> 'MockOpenAIServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a mock OpenAI chat completions API')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before answering')
+    parser.add_argument('--chunk-interval', type=float, default=0.0, help='Seconds between streamed chunks')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests that fail (0-1)')
+    parser.add_argument('--answer-words', type=int, default=200, help='Words per answer')
+    args = parser.parse_args()
+    server = MockOpenAIServer(args.port, args.latency, args.chunk_interval, args.error_rate, args.answer_words)
+    print(f'Serving on {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
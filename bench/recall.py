@@ -0,0 +1,67 @@
+"""
+Measures the history index of ChatSession.enable_recall: the cost of indexing a turn
+and of recalling the turns relevant to a question, as the history grows.
+
+    python3 bench/recall.py --turns 100 1000 10000 --output recall.json
+"""
+import time
+import argparse
+
+from common import make_text, write_results
+from history_index import HistoryIndex
+
+
+def build_index(turns: int, texts: list) -> tuple:
+    """
+    Returns:
+        tuple: A HistoryIndex of the given number of turns and the average time of
+        adding one, in microseconds.
+    """
+    index = HistoryIndex()
+    start = time.perf_counter()
+    for number in range(turns):
+        index.add_messages([
+            {'role': 'user', 'content': texts[number % len(texts)]},
+            {'role': 'assistant', 'content': texts[(number + 1) % len(texts)]},
+        ], [100, 100])
+    return index, (time.perf_counter() - start) / max(1, turns) * 1e6
+
+
+def run(turn_counts: list, queries=200, budget=1000) -> dict:
+    """
+    Args:
+        turn_counts (list): The history lengths to measure, in turns.
+        queries (int): Recalls per measurement.
+        budget (int): The token budget of a recall.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    texts = [make_text(400, seed) for seed in range(50)]
+    questions = [make_text(80, seed + 1000) for seed in range(queries)]
+    results = []
+    for turns in turn_counts:
+        index, add_us = build_index(turns, texts)
+        recalled = 0
+        start = time.perf_counter()
+        for question in questions:
+            recalled += index.recall(question, budget)[1]
+        seconds = time.perf_counter() - start
+        results.append({
+            'turns': turns,
+            'terms': len(index.postings),
+            'add_turn_us': add_us,
+            'recall_us': seconds / queries * 1e6,
+            'recalled_tokens': recalled / queries,
+            'history_tokens': turns * 200,
+        })
+    return {'benchmark': 'recall', 'budget': budget, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the history index')
+    parser.add_argument('--turns', type=int, nargs='+', default=[100, 1000, 10000], help='History lengths')
+    parser.add_argument('--queries', type=int, default=200, help='Recalls per measurement')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.turns, args.queries), args.output)
@@ -0,0 +1,107 @@
+"""
+Measures the rendering of streamed answers: StreamingMarkdownRenderer fed with small
+deltas, and CmdSession.handle_stream_output end to end against the mock server.
+Output goes to an in-memory console, so the terminal does not limit the result.
+
+    python3 bench/render.py --words 500 2000 --output render.json
+"""
+import io
+import os
+import sys
+import time
+import argparse
+
+from rich.console import Console
+
+from common import use_mock_api, write_results
+from mock_server import MockOpenAIServer
+import simple_logger
+from chat import CmdSession
+from chat_session import ChatSession
+from stream_render import StreamingMarkdownRenderer
+
+DELTA_LENGTH = 4
+
+
+def make_markdown(words: int) -> str:
+    """
+    Builds a markdown answer of paragraphs, lists and code blocks.
+
+    Args:
+        words (int): The approximate number of words.
+
+    Returns:
+        str: The answer.
+    """
+    blocks = []
+    count = 0
+    while count < words:
+        blocks.append('Here is **some** text with `code` and a [link](https://example.com). ' * 4)
+        blocks.append('- first item\n- second item with *emphasis*\n- third item')
+        blocks.append('```python\nfor index in range(10):\n    print(index * 2)\n```')
+        count += 60
+    return '\n\n'.join(blocks)
+
+
+def new_console() -> Console:
+    return Console(file=io.StringIO(), force_terminal=True, width=100)
+
+
+def measure_renderer(text: str) -> dict:
+    """
+    Returns:
+        dict: The time to render the text fed in DELTA_LENGTH-character deltas.
+    """
+    deltas = [text[i:i + DELTA_LENGTH] for i in range(0, len(text), DELTA_LENGTH)]
+    start = time.perf_counter()
+    with StreamingMarkdownRenderer(new_console()) as renderer:
+        for delta in deltas:
+            renderer.feed(delta)
+    seconds = time.perf_counter() - start
+    return {'deltas': len(deltas), 'seconds': seconds, 'deltas_per_second': len(deltas) / seconds}
+
+
+def measure_stream_output(server: MockOpenAIServer, words: int) -> dict:
+    """
+    Returns:
+        dict: The time of one handle_stream_output call for an answer of the given length.
+    """
+    server.answer_length = words
+    cmd_session = CmdSession()
+    cmd_session.console = new_console()
+    chat_session = ChatSession()
+    start = time.perf_counter()
+    cmd_session.handle_stream_output(chat_session, 'Tell me something long.')
+    seconds = time.perf_counter() - start
+    return {'chunks': words, 'seconds': seconds, 'chunks_per_second': words / seconds}
+
+
+def run(word_counts: list) -> dict:
+    """
+    Args:
+        word_counts (list): The answer lengths to measure, in words.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    # Nothing to learn from the log of the benchmark
+    simple_logger.SimpleLogger.logfilename = os.devnull
+    sys.argv = ['chat.py', '--stream', '--no-save']
+    results = []
+    with MockOpenAIServer() as server:
+        use_mock_api(server.base_url)
+        for words in word_counts:
+            results.append({
+                'words': words,
+                'renderer': measure_renderer(make_markdown(words)),
+                'handle_stream_output': measure_stream_output(server, words),
+            })
+    return {'benchmark': 'render', 'delta_length': DELTA_LENGTH, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the rendering of streamed answers')
+    parser.add_argument('--words', type=int, nargs='+', default=[500, 2000], help='Answer lengths in words')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.words), args.output)
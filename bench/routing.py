@@ -0,0 +1,69 @@
+"""
+Measures the endpoint router against two mock servers, a fast one and a slow one.
+Halfway through, the fast server starts failing every request, to show the failover
+to the slow one and the ejection of the failing one.
+
+    python3 bench/routing.py --requests 40 --output routing.json
+"""
+import sys
+import time
+import argparse
+
+from common import use_mock_api, write_results
+from mock_server import MockOpenAIServer
+import endpoint_router
+from chat_session import ChatSession
+
+
+def run(requests=40, fast_latency=0.05, slow_latency=0.3) -> dict:
+    """
+    Args:
+        requests (int): The number of requests to send.
+        fast_latency (float): Seconds per request of the fast server.
+        slow_latency (float): Seconds per request of the slow server.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    with MockOpenAIServer(latency=fast_latency, answer_words=20) as fast, \
+            MockOpenAIServer(latency=slow_latency, answer_words=20) as slow:
+        use_mock_api(fast.base_url)
+        router = endpoint_router.configure([
+            endpoint_router.Endpoint(fast.base_url, name='fast'),
+            endpoint_router.Endpoint(slow.base_url, name='slow'),
+        ])
+        chat_session = ChatSession()
+        phases = []
+        for phase in ('healthy', 'fast failing'):
+            if phase == 'fast failing':
+                fast.error_rate = 1.0
+            fast_before, slow_before = fast.requests, slow.requests
+            start = time.perf_counter()
+            for index in range(requests // 2):
+                chat_session.clear_context()
+                chat_session.ask(f'Question {index}')
+            seconds = time.perf_counter() - start
+            phases.append({
+                'phase': phase,
+                'seconds': seconds,
+                'seconds_per_request': seconds / (requests // 2),
+                'fast_requests': fast.requests - fast_before,
+                'slow_requests': slow.requests - slow_before,
+            })
+        status = router.format_status()
+    # stdout is for the JSON results
+    print(status, file=sys.stderr)
+    return {
+        'benchmark': 'routing',
+        'fast_latency': fast_latency,
+        'slow_latency': slow_latency,
+        'phases': phases,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the endpoint router against two mock servers')
+    parser.add_argument('--requests', type=int, default=40, help='Number of requests')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.requests), args.output)
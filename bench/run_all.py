@@ -0,0 +1,74 @@
+"""
+Runs all the benchmarks and writes their results to one JSON file, tagged with the
+git commit, so that results can be compared between versions:
+
+    python3 bench/run_all.py --output results-$(git rev-parse --short HEAD).json
+    python3 bench/run_all.py --quick
+"""
+import sys
+import time
+import argparse
+import platform
+import subprocess
+
+from common import REPO_DIRECTORY, write_results
+import chunking
+import token_ledger
+import render
+import translate
+import routing
+import recall
+import startup
+import daemon
+
+
+def get_commit() -> str:
+    """
+    Returns:
+        str: The current git commit of the repository, or an empty string outside of git.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIRECTORY, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(quick=False) -> dict:
+    """
+    Args:
+        quick (bool): Use small inputs, for a fast smoke run.
+
+    Returns:
+        dict: The results of all the benchmarks.
+    """
+    benchmarks = [
+        lambda: chunking.run([0.5] if quick else [1, 8], repeat=1 if quick else 3),
+        lambda: token_ledger.run([100, 1000] if quick else [100, 1000, 10000], calls=100 if quick else 1000),
+        lambda: render.run([500] if quick else [500, 2000]),
+        lambda: translate.run([1, 4] if quick else [1, 4, 16], chunks=8 if quick else 32),
+        lambda: routing.run(10 if quick else 40),
+        lambda: recall.run([100, 1000] if quick else [100, 1000, 10000], queries=50 if quick else 200),
+        lambda: startup.run(2 if quick else 5),
+        lambda: daemon.run(2 if quick else 5, [1, 10] if quick else [1, 10, 50]),
+    ]
+    results = []
+    for benchmark in benchmarks:
+        results.append(benchmark())
+        print(f"{results[-1]['benchmark']} done", file=sys.stderr)
+    return {
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run all the benchmarks')
+    parser.add_argument('--quick', action='store_true', help='Use small inputs')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.quick), args.output)
@@ -0,0 +1,83 @@
+"""
+Measures the time from launching chat.py to the first `You:` prompt.
+
+Each run starts a fresh interpreter that imports chat, builds the CmdSession and the
+ChatSession and shows the welcome box, which is everything chat.py does before it
+prompts. The results are printed as JSON, so they can be compared between versions:
+
+    python3 bench/startup.py --runs 10 --output startup.json
+"""
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+from common import REPO_DIRECTORY, use_mock_api, write_results
+from mock_server import MockOpenAIServer
+
+# Runs in the child interpreter; prints READY where chat.py would show the prompt.
+CHILD_SCRIPT = '''
+import sys
+sys.argv = ['chat.py']
+import chat
+cmd_session = chat.CmdSession()
+chat_session = chat.ChatSession()
+cmd_session.show_help(title='Welcome to ChatGPT')
+print('READY', flush=True)
+'''
+
+
+def measure_time_to_prompt() -> float:
+    """
+    Returns:
+        float: Seconds from starting the interpreter until the prompt would be shown.
+    """
+    start = time.perf_counter()
+    child = subprocess.Popen(
+        [sys.executable, '-c', CHILD_SCRIPT],
+        cwd=REPO_DIRECTORY,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    for line in child.stdout:
+        if line.strip() == 'READY':
+            elapsed = time.perf_counter() - start
+            break
+    else:
+        child.wait()
+        raise RuntimeError('chat.py did not reach the prompt')
+    child.stdout.close()
+    child.wait()
+    return elapsed
+
+
+def run(runs: int) -> dict:
+    """
+    Args:
+        runs (int): The number of launches to measure.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    with MockOpenAIServer() as server:
+        # The children inherit the environment, so their warm-up connects to the mock server
+        use_mock_api(server.base_url)
+        samples = [measure_time_to_prompt() for _ in range(runs)]
+    return {
+        'benchmark': 'startup',
+        'runs': runs,
+        'time_to_prompt_min': min(samples),
+        'time_to_prompt_median': statistics.median(samples),
+        'time_to_prompt_max': max(samples),
+        'samples': samples,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the time to the first chat.py prompt')
+    parser.add_argument('--runs', type=int, default=5, help='Number of launches to measure')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.runs), args.output)
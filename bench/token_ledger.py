@@ -0,0 +1,99 @@
+"""
+Measures the cost of the ChatSession token ledger as the history grows: appending a
+message, _count_current_tokens and trim_context, both when nothing needs to be
+trimmed and when half of the history has to go.
+
+    python3 bench/token_ledger.py --messages 100 1000 10000 --output token_ledger.json
+"""
+import os
+import time
+import argparse
+
+from common import make_text, use_mock_api, write_results
+from mock_server import MockOpenAIServer
+from chat_session import ChatSession
+
+
+def per_call(function, calls: int) -> float:
+    """
+    Returns:
+        float: The average time of a call in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def build_session(messages: int, texts: list) -> tuple:
+    """
+    Returns:
+        tuple: A ChatSession with the given number of messages and the average time of
+        appending one, in microseconds.
+    """
+    session = ChatSession()
+    start = time.perf_counter()
+    for index in range(messages // 2):
+        session.append_user_message(texts[index % len(texts)])
+        session.append_assistant_message(texts[(index + 1) % len(texts)])
+    return session, (time.perf_counter() - start) / max(1, messages) * 1e6
+
+
+def measure_trim(session: ChatSession, repeat: int) -> float:
+    """
+    Returns:
+        float: The average time in microseconds of a trim_context call that drops about
+        half of the history.
+    """
+    chat_context = list(session.chat_context)
+    prefix = list(session.context_window.prefix)
+    limit = session.context_window.limit
+    session.context_window.limit = session.context_window.reserve_tokens + prefix[-1] // 2
+    total = 0.0
+    for _ in range(repeat):
+        session.chat_context = list(chat_context)
+        session.context_window.prefix = list(prefix)
+        start = time.perf_counter()
+        session.trim_context()
+        total += time.perf_counter() - start
+    session.context_window.limit = limit
+    session.chat_context = chat_context
+    session.context_window.prefix = prefix
+    return total / repeat * 1e6
+
+
+def run(message_counts: list, calls=1000) -> dict:
+    """
+    Args:
+        message_counts (list): The history lengths to measure, in messages.
+        calls (int): Calls per measurement.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    # Large enough that building the history never trims it
+    os.environ['OPENAI_CONTEXT_WINDOW'] = str(10 ** 9)
+    texts = [make_text(400, seed) for seed in range(50)]
+    results = []
+    with MockOpenAIServer() as server:
+        use_mock_api(server.base_url)
+        for messages in message_counts:
+            session, append_us = build_session(messages, texts)
+            results.append({
+                'messages': len(session.chat_context),
+                'context_tokens': session.current_context_tokens,
+                'append_message_us': append_us,
+                'count_current_tokens_us': per_call(session._count_current_tokens, calls),
+                'trim_context_no_trim_us': per_call(lambda: session.trim_context(texts[0]), calls),
+                'trim_context_half_us': measure_trim(session, max(1, calls // 10)),
+            })
+    return {'benchmark': 'token_ledger', 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the token ledger of ChatSession')
+    parser.add_argument('--messages', type=int, nargs='+', default=[100, 1000, 10000], help='History lengths')
+    parser.add_argument('--calls', type=int, default=1000, help='Calls per measurement')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.messages, args.calls), args.output)
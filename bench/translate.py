@@ -0,0 +1,70 @@
+"""
+Measures the end-to-end wall time of translate_chn.translate against the mock server
+at different worker counts. Every run starts from an empty manifest.
+
+    python3 bench/translate.py --workers 1 4 16 --latency 0.2 --output translate.json
+"""
+import io
+import time
+import argparse
+import tempfile
+import contextlib
+from pathlib import Path
+
+from common import make_text, use_mock_api, write_results
+from mock_server import MockOpenAIServer
+import translate_chn
+
+
+def run(worker_counts: list, chunks=32, max_tokens=500, latency=0.2, error_rate=0.0) -> dict:
+    """
+    Args:
+        worker_counts (list): The numbers of workers to measure.
+        chunks (int): The approximate number of chunks of the source.
+        max_tokens (int): The token limit of a chunk.
+        latency (float): Seconds the mock server takes per request.
+        error_rate (float): The share of requests the mock server fails.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    results = []
+    with MockOpenAIServer(latency=latency, error_rate=error_rate, answer_words=100) as server, \
+            tempfile.TemporaryDirectory() as directory:
+        use_mock_api(server.base_url)
+        source = Path(directory) / 'source.txt'
+        source.write_text(make_text(chunks * max_tokens * 4))
+        for workers in worker_counts:
+            output = Path(directory) / f'output-{workers}.txt'
+            requests_before = server.requests
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                translate_chn.translate(str(source), str(output), max_token_per_request=max_tokens, workers=workers)
+                seconds = time.perf_counter() - start
+            manifest = translate_chn.TranslationManifest.open(str(output), source.read_bytes(), max_tokens, translate_chn.plan_chunks)
+            results.append({
+                'workers': workers,
+                'chunks': len(manifest.chunks),
+                'requests': server.requests - requests_before,
+                'seconds': seconds,
+                'chunks_per_second': len(manifest.chunks) / seconds,
+            })
+    return {
+        'benchmark': 'translate',
+        'latency': latency,
+        'error_rate': error_rate,
+        'max_tokens': max_tokens,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the wall time of translate_chn.translate')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16], help='Worker counts')
+    parser.add_argument('--chunks', type=int, default=32, help='Approximate number of chunks')
+    parser.add_argument('--tokens', type=int, default=500, help='Maximum tokens per chunk')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds per mock request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of failed mock requests (0-1)')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    write_results(run(args.workers, args.chunks, args.tokens, args.latency, args.error_rate), args.output)
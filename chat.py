@@ -1,14 +1,17 @@
 import sys
+import json
+import time
+import asyncio
 import argparse
-from typing import Union
+import datetime
+from typing import Union, TYPE_CHECKING
 from rich.console import Console
-from rich.markdown import Markdown
-from rich.live import Live
 from rich.panel import Panel
 from prompt_toolkit import prompt
+from prompt_toolkit.application.current import get_app
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.key_binding import KeyPressEvent
-from prompt_toolkit.validation import Validator
+from prompt_toolkit.validation import Validator, ValidationError
 from prompt_toolkit.shortcuts import input_dialog
 from prompt_toolkit.styles import Style
 from prompt_toolkit.filters import (
@@ -17,11 +20,47 @@ from prompt_toolkit.filters import (
     vi_insert_mode,
     in_paste_mode
 )
-from chat_session import ChatSession
 from simple_logger import SimpleLogger
+from session_store import SessionStore
+
+if TYPE_CHECKING:
+    from rich.markdown import Markdown
+    from chat_session import ChatSession
+    from draft_counter import DraftTokenCounter
+
+class BudgetValidator(Validator):
+    """
+    Refuses a message that does not fit the model's context window even once all the
+    history but the system message is dropped, so it never reaches the API.
+    """
+    def __init__(self, draft_counter: 'DraftTokenCounter', chat_session: 'ChatSession', validator=None):
+        """
+        Args:
+            draft_counter (DraftTokenCounter): Counts the tokens of the message.
+            chat_session (ChatSession): The session the message is sent in.
+            validator (Validator): A validator that runs first, or None.
+        """
+        self.draft_counter = draft_counter
+        self.chat_session = chat_session
+        self.validator = validator
+
+    def validate(self, document):
+        if self.validator is not None:
+            self.validator.validate(document)
+        text = document.text
+        if CmdSession.is_command(text) or text.startswith('system='):
+            return
+        tokens = self.draft_counter.count_exact(text)
+        most = self.chat_session.get_message_room()[1]
+        if tokens > most:
+            raise ValidationError(
+                message=f'The message has {tokens} tokens, but the model accepts {max(0, most)}. Shorten it or split it.',
+                cursor_position=len(text),
+            )
+
 
 class CmdSession:
-    commands = ('cls', 'm', 's', 'bye', 'h')
+    commands = ('cls', 'm', 's', 'bye', 'h', 'stats')
     bindings = KeyBindings()
     insert_mode = vi_insert_mode | emacs_insert_mode
 
@@ -34,12 +73,43 @@ class CmdSession:
         parser.add_argument('-m', '--multiline', action='store_true', help='Switch to multiple line mode')
         parser.add_argument('-c', '--nocolor', action='store_true', help='Disable colorful output')
         parser.add_argument('-s', '--stream', action='store_true', help='Enable stream output')
+        parser.add_argument('-a', '--auto-summarize', action='store_true',
+            help='Summarize older turns in the background when the context gets long')
+        parser.add_argument('--recall', type=int, default=0, metavar='TOKENS',
+            help='Index the turns that leave the context and send the most relevant ones, up to TOKENS, with each question')
+        parser.add_argument('--check-budget', action='store_true',
+            help="Refuse messages too long for the model's context window")
+        parser.add_argument('--cache', action='store_true',
+            help='Answer repeated requests with temperature 0 from a local cache')
+        parser.add_argument('--batch', metavar='FILE',
+            help='Answer the prompts of a JSONL file (- for stdin) without the interactive prompt')
+        parser.add_argument('--concurrency', type=int, default=16, help='Batch threads running at once')
+        parser.add_argument('--order', choices=('input', 'completion'), default='input',
+            help='Write the batch results in input order or as they complete')
+        parser.add_argument('--attach', nargs='?', const='', metavar='ID',
+            help='Chat through the local daemon, in a new session or the given warm or saved one')
+        parser.add_argument('-r', '--resume', metavar='ID', help='Resume a saved session')
+        parser.add_argument('--sessions', action='store_true', help='List the saved sessions and exit')
+        parser.add_argument('--no-save', action='store_true', help='Do not save this session')
         args = parser.parse_args()
 
         self.multiline_mode = args.multiline
         self.colorful_mode = not args.nocolor
         self.stream_mode = args.stream
-
+        self.auto_summarize = args.auto_summarize
+        self.use_cache = args.cache
+        self.recall_tokens = args.recall
+        self.check_budget = args.check_budget
+        self.draft_counter = None
+        self.resume_id = args.resume
+        self.attach_id = args.attach
+        self.batch_filename = args.batch
+        self.concurrency = args.concurrency
+        self.result_order = args.order
+        self.list_sessions = args.sessions
+        self.save_session = not args.no_save
+        self.session_log = None
+        self.response_cache = None
 
         self.logger = SimpleLogger()
 
@@ -70,10 +140,34 @@ class CmdSession:
             return 0 <= val <= 2
         return True
 
-    def box(self, message: Union[str, Markdown], title=''):
+    def box(self, message: Union[str, 'Markdown'], title=''):
         self.console.print(Panel(message, expand=False, title=title))
 
-    def get_input(self, prompt_mark: str):
+    def get_toolbar(self, chat_session: 'ChatSession'):
+        """
+        Returns the bottom toolbar of the prompt: the tokens of the draft, counted in the
+        background, the size of the context and the room left in the prompt budget.
+        """
+        if self.draft_counter is None:
+            from chat_session import get_token_encoding
+            from draft_counter import DraftTokenCounter
+            self.draft_counter = DraftTokenCounter(lambda: get_token_encoding(chat_session.model))
+
+        def toolbar():
+            app = get_app()
+            self.draft_counter.on_update = app.invalidate
+            tokens, current = self.draft_counter.request(app.current_buffer.text)
+            free, most = chat_session.get_message_room()
+            draft = f' Draft: {tokens:,} tokens{"" if current else "…"}'
+            context = f' | Context: {chat_session.context_window.total:,} / {chat_session.context_window.budget:,}'
+            if tokens > most:
+                return [('', draft + context), ('class:bottom-toolbar.warning', f' | Too long for the model, at most {max(0, most):,} ')]
+            if tokens > free:
+                return [('', draft + context), ('class:bottom-toolbar.warning', ' | Older history will be trimmed ')]
+            return draft + context + f' | Left: {free - tokens:,} '
+        return toolbar
+
+    def get_input(self, prompt_mark: str, chat_session: 'ChatSession' = None):
         validator = Validator.from_callable(
             CmdSession.is_valid_cmd,
             error_message="Illegal command. Please enter 'h' to view help.",
@@ -81,13 +175,22 @@ class CmdSession:
         )
         custom_style = Style.from_dict({
             'prompt': 'fg:#E0D562',  # Customize the prompt color
+            'bottom-toolbar.warning': 'fg:#E05252',
         })
+        toolbar = self.get_toolbar(chat_session) if chat_session is not None else None
         if not self.multiline_mode:
+            if self.check_budget and chat_session is not None:
+                validator = BudgetValidator(self.draft_counter, chat_session, validator)
             return prompt(
-                prompt_mark, validator=validator, validate_while_typing=False, style=custom_style
+                prompt_mark, validator=validator, validate_while_typing=False, style=custom_style,
+                bottom_toolbar=toolbar
             ).strip()
+        validator = None
+        if self.check_budget and chat_session is not None:
+            validator = BudgetValidator(self.draft_counter, chat_session)
         ret = prompt(
-            prompt_mark, multiline=True, prompt_continuation="", key_bindings=CmdSession.bindings, style=custom_style
+            prompt_mark, multiline=True, prompt_continuation="", key_bindings=CmdSession.bindings, style=custom_style,
+            bottom_toolbar=toolbar, validator=validator, validate_while_typing=False
         )
         return ret
 
@@ -99,6 +202,7 @@ class CmdSession:
     m: Switch to multiple line mode
     s: Switch to single line mode
     t=0.7: Set Temperature of API (0-2)
+    stats: Show latency and throughput of this session
     system=: Change system prompt
     '''
         self.box(help_text, title)
@@ -111,7 +215,7 @@ class CmdSession:
         self.multiline_mode = False
         self.box('Single Line Mode, use Enter to send. Use m to switch back to Multiple Line Mode.')
 
-    def handle_cls_command(self, chat_session: ChatSession):
+    def handle_cls_command(self, chat_session: 'ChatSession'):
         summary = chat_session.summarize()
         chat_session.clear_context()
         self.box(summary, title='chat context cleared.')
@@ -122,7 +226,7 @@ class CmdSession:
     def handle_s_command(self):
         self.switch_to_single_line_mode()
 
-    def handle_t_command(self, user_text: str, chat_session: ChatSession):
+    def handle_t_command(self, user_text: str, chat_session: 'ChatSession'):
         chat_session.change_temperature(user_text)
         self.box(f'Temperature is set to {chat_session.temperature}')
 
@@ -137,22 +241,86 @@ class CmdSession:
     def handle_h_command(self):
         self.show_help()
 
-    def handle_exit_command(self, chat_session: ChatSession):
-        self.box(f'\nToken consumed: {chat_session.get_tokens_consumed()}\nCost of this session: {chat_session.get_session_cost():.2f}',
-            title='Bye')
+    def handle_stats_command(self, chat_session: 'ChatSession'):
+        self.box(chat_session.metrics.format_summary(), title='Session stats')
+        if chat_session.history_index is not None:
+            self.box(f'{len(chat_session.history_index)} older turns indexed, '
+                f'{chat_session.recalled_tokens} tokens recalled for the last question', title='History index')
+        from endpoint_router import get_router
+        router = get_router()
+        if router is not None:
+            self.box(router.format_status(), title='Endpoints')
+
+    def handle_exit_command(self, chat_session: 'ChatSession'):
+        message = f'\nToken consumed: {chat_session.get_tokens_consumed()}\nCost of this session: {chat_session.get_session_cost():.2f}'
+        if chat_session.response_cache is not None:
+            message += f'\nResponse cache: {chat_session.response_cache.get_stats()}'
+        if self.session_log is not None and not self.session_log.is_empty:
+            self.session_log.close()
+            message += f'\nResume this session with: chat.py --resume {self.session_log.session_id}'
+        self.box(message, title='Bye')
 
-    def handle_stream_output(self, chat_session: ChatSession, user_text: str):
+    def show_sessions(self):
+        sessions = SessionStore().list_sessions()
+        if not sessions:
+            self.box('No saved sessions.')
+            return
+        lines = []
+        for session_id, entry in sessions:
+            updated = datetime.datetime.fromtimestamp(entry.get('updated', 0)).strftime('%Y-%m-%d %H:%M')
+            lines.append(f"{session_id}  {updated}  {entry.get('model', '')}  {entry.get('title', '')}")
+        self.box('\n'.join(lines), title='Saved sessions')
+
+    def handle_stream_output(self, chat_session: 'ChatSession', user_text: str):
+        # rich.markdown is slow to import, so it is loaded with the first answer
+        from stream_render import StreamingMarkdownRenderer
+        requests = len(chat_session.metrics.requests)
         response = chat_session.ask_stream(user_text)
         self.console.print("[bold blue]ChatGPT[/bold blue]")
-        with Live("[bold green]Asking...", refresh_per_second=0.5) as live:
-            for r in response:
-                markdown = Markdown(r, inline_code_lexer="auto", inline_code_theme="monokai")
-                live.update(markdown)
+        deltas = []
+        with StreamingMarkdownRenderer(self.console) as renderer:
+            for delta in response:
+                deltas.append(delta)
+                renderer.feed(delta)
+        self.log_answer(chat_session, ''.join(deltas), requests)
+
+    def log_answer(self, chat_session: 'ChatSession', answer_text: str, requests: int):
+        """
+        Logs an answer with the metrics of its request.
+
+        Args:
+            chat_session (ChatSession): The session that answered.
+            answer_text (str): The answer.
+            requests (int): The number of requests in the session metrics before the question was asked.
+        """
+        if len(chat_session.metrics.requests) > requests:
+            request_metrics = chat_session.metrics.requests[requests]
+            self.logger.log_answer(
+                answer_text,
+                model=chat_session.model,
+                latency=round(request_metrics.total_seconds, 3),
+                first_token=round(request_metrics.first_token_seconds, 3),
+                prompt_tokens=request_metrics.prompt_tokens,
+                completion_tokens=request_metrics.completion_tokens,
+            )
+        else:
+            # An answer from the response cache records no request
+            self.logger.log_answer(
+                answer_text,
+                model=chat_session.model,
+                latency=0,
+                first_token=0,
+                prompt_tokens=0,
+                completion_tokens=0,
+                cached=True,
+            )
 
     def handle_output(self, user_text, chat_session):
+        from rich.markdown import Markdown
         with self.console.status("[bold green]Asking...", spinner="point") as status:
+            requests = len(chat_session.metrics.requests)
             response = chat_session.ask(user_text)
-            self.logger.log_answer(response)
+            self.log_answer(chat_session, response, requests)
             if self.colorful_mode:
                 self.console.print("[bold blue]ChatGPT[/bold blue]")
                 markdown = Markdown(response, inline_code_lexer="auto", inline_code_theme="monokai",)
@@ -162,9 +330,9 @@ class CmdSession:
                 print(response)
             status.update("[bold green]Done!")
 
-    def process_user_text(self, user_text: str, chat_session: ChatSession):
-        trimmed = chat_session.trim_context()
-        if trimmed:
+    def process_user_text(self, user_text: str, chat_session: 'ChatSession'):
+        trimmed = chat_session.trim_context(user_text)
+        if trimmed and chat_session.history_index is None:
             self.box('[bold red]Attention: The context of chat is too long, some context has been cleared.[/bold red]\n'
                 'To clear the remaining context, you can use the command "cls".')
         self.logger.log_prompt(user_text)
@@ -181,13 +349,222 @@ class CmdSession:
                 self.logger.log_error(str(e))
                 raise e
 
-    def start_chat(self):
+    @staticmethod
+    def read_batch_requests(lines) -> list:
+        """
+        Reads batch requests, one per line. A line is either a JSON object with a prompt
+        and optionally an id, a thread name, a system message and a temperature, a JSON
+        string, or the plain text of a one-shot prompt.
+        """
+        requests = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError:
+                request = None
+            if isinstance(request, str):
+                request = {'prompt': request}
+            elif not isinstance(request, dict):
+                request = {'prompt': line.rstrip('\n')}
+            if not request.get('prompt'):
+                raise ValueError(f'Batch request without a prompt: {line.strip()}')
+            requests.append(request)
+        return requests
+
+    def new_batch_session(self) -> 'ChatSession':
+        from chat_session import ChatSession
         chat_session = ChatSession()
-        self.show_help(title='Welcome to ChatGPT')
+        chat_session.response_cache = self.response_cache
+        if self.recall_tokens:
+            chat_session.enable_recall(self.recall_tokens)
+        return chat_session
+
+    async def run_batch_async(self, requests: list) -> dict:
+        """
+        Runs the batch requests and writes their results to stdout as JSON lines.
+
+        Returns:
+            dict: The totals of the run.
+        """
+        from chat_driver import run_batch_async
+        totals = {'requests': len(requests), 'errors': 0, 'cached': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        buffered = {}
+        next_index = 0
+
+        def write(result):
+            sys.stdout.write(json.dumps(result, ensure_ascii=False) + '\n')
+            sys.stdout.flush()
 
+        async for index, result in run_batch_async(requests, self.concurrency, self.new_batch_session):
+            totals['errors'] += 'error' in result
+            totals['cached'] += result.get('cached', False)
+            totals['prompt_tokens'] += result.get('prompt_tokens', 0)
+            totals['completion_tokens'] += result.get('completion_tokens', 0)
+            if self.result_order == 'completion':
+                write(dict(result, index=index))
+                continue
+            buffered[index] = result
+            while next_index in buffered:
+                write(dict(buffered.pop(next_index), index=next_index))
+                next_index += 1
+        return totals
+
+    def run_batch(self):
+        """
+        Headless mode: answers the prompts of the batch file concurrently, writes the
+        results to stdout and a summary to stderr.
+        """
+        console = Console(stderr=True)
+        try:
+            if self.batch_filename == '-':
+                requests = self.read_batch_requests(sys.stdin)
+            else:
+                with open(self.batch_filename, encoding='utf-8') as f:
+                    requests = self.read_batch_requests(f)
+        except (OSError, ValueError) as e:
+            console.print(f'[bold red]{e}[/bold red]')
+            sys.exit(1)
+        if self.use_cache:
+            from chat_session import RESPONSE_CACHE_FILENAME, RESPONSE_CACHE_TTL
+            from disk_cache import DiskCache
+            self.response_cache = DiskCache(RESPONSE_CACHE_FILENAME, ttl=RESPONSE_CACHE_TTL)
+        start = time.perf_counter()
+        totals = asyncio.run(self.run_batch_async(requests))
+        seconds = time.perf_counter() - start
+        tokens = totals['prompt_tokens'] + totals['completion_tokens']
+        summary = (
+            f"Requests: {totals['requests']}, errors: {totals['errors']}, cached: {totals['cached']}\n"
+            f"Wall time: {seconds:.2f}s, {totals['requests'] / seconds:.2f} requests/s\n"
+            f"Tokens: {tokens} (prompt {totals['prompt_tokens']}, completion {totals['completion_tokens']}), "
+            f"{totals['completion_tokens'] / seconds:.1f} completion tokens/s"
+        )
+        console.print(Panel(summary, expand=False, title='Batch done'))
+        if totals['errors']:
+            sys.exit(2)
+
+    def run_attached(self):
+        """
+        Chats in a session of the local daemon, which keeps the session, the tokenizer
+        and the API connections warm between invocations. The daemon is started if it
+        is not running.
+        """
+        from chat_client import DaemonClient, DaemonError
+        from stream_render import StreamingMarkdownRenderer
+        client = DaemonClient()
+        try:
+            client.connect()
+            attached = client.attach(
+                self.attach_id or None,
+                save=self.save_session,
+                cache=self.use_cache,
+                recall=self.recall_tokens,
+                auto_summarize=self.auto_summarize,
+                check_budget=self.check_budget,
+            )
+        except (ConnectionError, DaemonError) as e:
+            self.box(f'[bold red]{e}[/bold red]')
+            return
+        self.show_help(title=f"Welcome to ChatGPT, session {attached['session']}")
+        if attached['resumed']:
+            self.box(f"Resumed session {attached['session']} with {attached['messages']} messages in the context.")
+        system_message = attached['system']
         while True:
             try:
                 user_text = self.get_input('You: ')
+                command = user_text.strip()
+                if not command:
+                    continue
+                if command in ('exit', 'bye', 'quit'):
+                    break
+                if command == 'cls':
+                    self.box(client.call('clear')['summary'], title='chat context cleared.')
+                elif command == 'm':
+                    self.handle_m_command()
+                elif command == 's':
+                    self.handle_s_command()
+                elif command == 'h':
+                    self.handle_h_command()
+                elif command == 'stats':
+                    self.box(client.call('stats')['text'], title='Session stats')
+                elif command.startswith('t='):
+                    if not self.is_valid_cmd(command):
+                        self.box("Illegal command. Please enter 'h' to view help.")
+                        continue
+                    temperature = client.call('temperature', value=float(command.split('=')[-1]))['temperature']
+                    self.box(f'Temperature is set to {temperature}')
+                elif command.startswith('system='):
+                    text = input_dialog(
+                        title="Change system prompt message",
+                        text="Current System Message is",
+                        default=system_message
+                    ).run()
+                    if text is not None:
+                        system_message = client.call('system', text=text)['system']
+                else:
+                    self.console.print("[bold blue]ChatGPT[/bold blue]")
+                    answer = client.ask(user_text)
+                    with StreamingMarkdownRenderer(self.console) as renderer:
+                        while True:
+                            try:
+                                renderer.feed(next(answer))
+                            except StopIteration as stop:
+                                result = stop.value or {}
+                                break
+                    if result.get('trimmed'):
+                        self.box('[bold red]Attention: The context of chat is too long, some context has been cleared.[/bold red]\n'
+                            'To clear the remaining context, you can use the command "cls".')
+            except DaemonError as e:
+                self.box(f'[bold red]{e}[/bold red]')
+            except ConnectionError as e:
+                self.box(f'[bold red]{e}[/bold red]')
+                return
+            except KeyboardInterrupt:
+                break
+        stats = client.call('stats')
+        message = f"\nToken consumed: {stats['tokens_consumed']}\nCost of this session: {stats['cost']:.2f}"
+        if stats['saved']:
+            message += f"\nResume this session with: chat.py --attach {attached['session']}"
+        self.box(message, title='Bye')
+        client.close()
+
+    def start_chat(self):
+        if self.list_sessions:
+            self.show_sessions()
+            return
+        resumed_log = None
+        if self.resume_id:
+            try:
+                resumed_log = SessionStore().open(self.resume_id)
+            except KeyError:
+                self.box(f'[bold red]No saved session with id {self.resume_id}.[/bold red] Use --sessions to list them.')
+                return
+        # chat_session pulls in the tokenizer, which chat.py --attach leaves to the daemon
+        from chat_session import ChatSession, RESPONSE_CACHE_FILENAME, RESPONSE_CACHE_TTL
+        from disk_cache import DiskCache
+        chat_session = ChatSession(resumed_log)
+        chat_session.auto_summarize = self.auto_summarize
+        if self.recall_tokens:
+            chat_session.enable_recall(self.recall_tokens)
+        if self.use_cache:
+            chat_session.response_cache = DiskCache(RESPONSE_CACHE_FILENAME, ttl=RESPONSE_CACHE_TTL)
+        if not self.save_session:
+            # A resumed session is loaded, but nothing new is saved
+            chat_session.session_log = None
+        elif resumed_log is None:
+            chat_session.session_log = SessionStore().create(chat_session.model)
+        self.session_log = chat_session.session_log
+        if self.session_log is not None:
+            self.logger = SimpleLogger(self.session_log.session_id)
+        self.show_help(title='Welcome to ChatGPT')
+        if resumed_log is not None:
+            self.box(f'Resumed session {self.resume_id} with {len(chat_session.chat_context)} messages in the context.')
+
+        while True:
+            try:
+                chat_session.preconnect()
+                user_text = self.get_input('You: ', chat_session)
                 if len(user_text.strip()) == 0:
                     continue
                 if user_text.strip() == 'cls':
@@ -208,6 +585,9 @@ class CmdSession:
                 if user_text.strip() == 'h':
                     self.handle_h_command()
                     continue
+                if user_text.strip() == 'stats':
+                    self.handle_stats_command(chat_session)
+                    continue
                 if user_text.strip() in ('exit', 'bye', 'quit'):
                     self.handle_exit_command(chat_session)
                     break
@@ -221,4 +601,9 @@ class CmdSession:
 
 if __name__ == '__main__':
     chatBot = CmdSession()
-    chatBot.start_chat()
+    if chatBot.batch_filename:
+        chatBot.run_batch()
+    elif chatBot.attach_id is not None:
+        chatBot.run_attached()
+    else:
+        chatBot.start_chat()
@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+from pathlib import Path
+from collections.abc import Generator
+
+# The same as chat_daemon.SOCKET_PATH. This module only uses the standard library, so
+# that a client starts in milliseconds, and chat_daemon imports the chat modules.
+SOCKET_PATH = Path(os.environ.get('CHAT_DAEMON_SOCKET') or Path.home() / '.chatgpt' / 'daemon.sock')
+DAEMON_LOG_FILENAME = Path.home() / '.chatgpt' / 'daemon.log'
+# Seconds to wait for a daemon started by the client to listen.
+START_TIMEOUT = 15.0
+
+
+class DaemonError(Exception):
+    """An error reported by the daemon."""
+
+
+class DaemonClient:
+    """
+    A connection to the chat daemon, attached to one of its sessions.
+    """
+    def __init__(self, socket_path: Path = SOCKET_PATH):
+        self.socket_path = Path(socket_path)
+        self._socket = None
+        self._file = None
+        # Whether the answer of the last request was not read to its end, e.g. after Ctrl+C
+        self._unfinished = False
+
+    def _try_connect(self) -> bool:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.socket_path))
+        except OSError:
+            sock.close()
+            return False
+        self._socket = sock
+        self._file = sock.makefile('rb')
+        return True
+
+    def start_daemon(self):
+        """
+        Starts chat_daemon.py in the background, detached from this terminal. Its errors
+        go to ~/.chatgpt/daemon.log.
+        """
+        DAEMON_LOG_FILENAME.parent.mkdir(parents=True, exist_ok=True)
+        with open(DAEMON_LOG_FILENAME, 'ab') as log:
+            subprocess.Popen(
+                [sys.executable, str(Path(__file__).with_name('chat_daemon.py')), '--socket', str(self.socket_path)],
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=log,
+                start_new_session=True,
+            )
+
+    def connect(self, start=True):
+        """
+        Connects to the daemon.
+
+        Args:
+            start (bool): Start the daemon if it is not running.
+
+        Raises:
+            ConnectionError: If the daemon is not running and was not started, or did
+            not start in time.
+        """
+        if self._try_connect():
+            return
+        if not start:
+            raise ConnectionError(f'No chat daemon is listening on {self.socket_path}')
+        self.start_daemon()
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            if self._try_connect():
+                return
+        raise ConnectionError(f'The chat daemon did not start, see {DAEMON_LOG_FILENAME}')
+
+    def request(self, op: str, **fields) -> Generator:
+        """
+        Sends a request and yields the events of the answer, the last one being "done".
+
+        Raises:
+            DaemonError: If the daemon reports an error.
+            ConnectionError: If the daemon closed the connection.
+        """
+        if self._unfinished:
+            # Skip the rest of the previous answer
+            while self._read_event().get('event') not in ('done', 'error'):
+                pass
+        self._socket.sendall(json.dumps(dict(fields, op=op), ensure_ascii=False).encode('utf-8') + b'\n')
+        self._unfinished = True
+        while True:
+            event = self._read_event()
+            if event.get('event') == 'error':
+                self._unfinished = False
+                raise DaemonError(event.get('message', 'Unknown error'))
+            if event.get('event') == 'done':
+                self._unfinished = False
+            yield event
+            if event.get('event') == 'done':
+                return
+
+    def _read_event(self) -> dict:
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('The chat daemon closed the connection')
+        return json.loads(line)
+
+    def call(self, op: str, **fields) -> dict:
+        """
+        Sends a request and waits for its answer.
+
+        Returns:
+            dict: The "done" event.
+        """
+        for event in self.request(op, **fields):
+            if event.get('event') == 'done':
+                return event
+        return {}
+
+    def attach(self, session_id=None, save=True, **settings) -> dict:
+        """
+        Attaches to a session of the daemon.
+
+        Args:
+            session_id (str): The id of a warm or saved session, or None for a new one.
+            save (bool): Whether a new or resumed session saves its messages.
+            **settings: Features to turn on in the session: cache, recall (tokens),
+                auto_summarize and check_budget.
+
+        Returns:
+            dict: The session id, whether it was resumed, its number of messages and
+            its system message.
+        """
+        return self.call('attach', session=session_id, save=save, ssh=os.environ.get('SSH_CONNECTION', ''), settings=settings)
+
+    def ask(self, prompt: str) -> Generator:
+        """
+        Asks a question in the attached session.
+
+        Yields:
+            str: The pieces of the answer as they arrive.
+
+        Returns:
+            dict: The "done" event, with the token counts and whether the context was trimmed.
+        """
+        for event in self.request('ask', prompt=prompt):
+            if event.get('event') == 'delta':
+                yield event['text']
+            elif event.get('event') == 'done':
+                return event
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = None
+
+
+HELP_TEXT = '''h: Display Help
+bye: Quit
+cls: Clear Chat Context
+t=0.7: Set Temperature of API (0-2)
+stats: Show latency and throughput of this session
+system=<text>: Change system prompt'''
+
+
+def run_command(client: DaemonClient, text: str) -> bool:
+    """
+    Runs a chat command.
+
+    Returns:
+        bool: False if the text is not a command.
+    """
+    if text == 'h':
+        print(HELP_TEXT)
+    elif text == 'cls':
+        print(client.call('clear')['summary'])
+        print('-- chat context cleared.')
+    elif text.startswith('t='):
+        try:
+            value = float(text[2:])
+        except ValueError:
+            value = -1
+        if not 0 <= value <= 2:
+            print("Illegal command. Please enter 'h' to view help.")
+        else:
+            print(f"Temperature is set to {client.call('temperature', value=value)['temperature']}")
+    elif text.startswith('system='):
+        client.call('system', text=text[len('system='):])
+        print('System message changed, chat context cleared.')
+    elif text == 'stats':
+        print(client.call('stats')['text'])
+    else:
+        return False
+    return True
+
+
+def main():
+    # Line editing and history for input()
+    import readline
+    parser = argparse.ArgumentParser(description='ChatGPT through the local chat daemon')
+    parser.add_argument('-r', '--resume', metavar='ID', help='Attach to a warm or saved session')
+    parser.add_argument('--no-save', action='store_true', help='Do not save this session')
+    parser.add_argument('--no-start', action='store_true', help='Do not start the daemon if it is not running')
+    parser.add_argument('--socket', default=str(SOCKET_PATH), help='The Unix socket of the daemon')
+    args = parser.parse_args()
+
+    client = DaemonClient(Path(args.socket))
+    try:
+        client.connect(start=not args.no_start)
+        attached = client.attach(args.resume, save=not args.no_save)
+    except (ConnectionError, DaemonError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    state = 'Resumed' if attached['resumed'] else 'Attached to'
+    print(f"{state} session {attached['session']} with {attached['messages']} messages. Enter 'h' for help.")
+    while True:
+        try:
+            text = input('You: ').strip()
+            if not text:
+                continue
+            if text in ('exit', 'bye', 'quit'):
+                break
+            if run_command(client, text):
+                continue
+            print('ChatGPT')
+            answer = client.ask(text)
+            while True:
+                try:
+                    sys.stdout.write(next(answer))
+                    sys.stdout.flush()
+                except StopIteration as stop:
+                    result = stop.value or {}
+                    break
+            print()
+            if result.get('trimmed'):
+                print('-- Attention: the context of chat is too long, some context has been cleared.')
+        except DaemonError as e:
+            print(f'Error: {e}', file=sys.stderr)
+        except (KeyboardInterrupt, EOFError):
+            print()
+            break
+        except ConnectionError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    stats = client.call('stats')
+    print(f"Token consumed: {stats['tokens_consumed']}\nCost of this session: {stats['cost']:.2f}")
+    if stats['saved']:
+        print(f"Resume this session with: chat_client.py --resume {attached['session']}")
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
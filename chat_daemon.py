@@ -0,0 +1,400 @@
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import signal
+import asyncio
+import threading
+import argparse
+from pathlib import Path
+
+from chat_session import ChatSession, TOKENS_PER_MESSAGE, RESPONSE_CACHE_FILENAME, RESPONSE_CACHE_TTL
+from disk_cache import DiskCache
+from session_store import SessionStore
+from simple_logger import SimpleLogger
+
+SOCKET_PATH = Path(os.environ.get('CHAT_DAEMON_SOCKET') or Path.home() / '.chatgpt' / 'daemon.sock')
+# Sessions without a client for this long are dropped from memory; attaching again resumes them from their log.
+IDLE_SECONDS = 15 * 60
+# Large enough for a pasted file in a single prompt.
+MAX_LINE_BYTES = 16 * 1024 * 1024
+# Requests longer than this are parsed in a worker thread.
+LARGE_LINE_BYTES = 64 * 1024
+
+
+class AlreadyRunningError(RuntimeError):
+    """Another daemon serves the socket."""
+
+
+class DaemonSession:
+    """
+    A warm ChatSession held by the daemon, with its logger and attached clients.
+    """
+    def __init__(self, session_id: str, chat_session: ChatSession):
+        self.session_id = session_id
+        self.chat_session = chat_session
+        self.logger = SimpleLogger(session_id)
+        # One request at a time, when several clients share the session
+        self.lock = asyncio.Lock()
+        self.clients = 0
+        self.last_used = time.monotonic()
+        # Refuse prompts that do not fit the model's context window
+        self.check_budget = False
+
+    def close(self):
+        if self.chat_session.session_log is not None:
+            self.chat_session.session_log.close()
+
+
+class ChatDaemon:
+    """
+    Keeps chat sessions warm for many terminal clients, on one event loop.
+
+    The ChatSessions, the tokenizer and the pooled HTTP clients live in this one
+    process, so a client starts in milliseconds and memory grows with the number of
+    active sessions, not with the number of terminals.
+
+    Clients speak JSON lines over a Unix socket: every request is an object with an
+    "op", answered by any number of {"event": "delta", "text": ...} objects and then
+    one {"event": "done", ...} or {"event": "error", "message": ...}. The operations are:
+
+        ping         tells that the daemon is up
+        attach       {"session": id or null, "save": bool, "ssh": SSH_CONNECTION,
+                      "settings": {"cache": bool, "recall": tokens, "auto_summarize": bool,
+                                   "check_budget": bool}}
+        ask          {"prompt": text}, answered in deltas
+        clear        summarizes and clears the context
+        temperature  {"value": float}
+        system       {"text": the new system message}
+        stats        the metrics of the session
+    """
+    def __init__(self, socket_path: Path = SOCKET_PATH, idle_seconds=IDLE_SECONDS):
+        """
+        Args:
+            socket_path (Path): The Unix socket to listen on.
+            idle_seconds (float): How long a session without clients stays in memory.
+        """
+        self.socket_path = Path(socket_path)
+        # Locked by the running daemon, which writes its pid into it
+        self.pid_path = self.socket_path.with_name(self.socket_path.name + '.pid')
+        self.idle_seconds = idle_seconds
+        self.sessions = {}
+        self.store = SessionStore()
+        # The response cache shared by the sessions that ask for one
+        self.response_cache = None
+        self._cache_lock = threading.Lock()
+
+    def _open_session(self, session_id, save: bool) -> tuple:
+        """
+        Resumes a saved session or starts a new one. Reads the session log and the
+        index, so it runs in a worker thread.
+
+        Returns:
+            tuple: The ChatSession, its id and whether it was resumed from its log.
+        """
+        if session_id:
+            chat_session = ChatSession(self.store.open(session_id))
+            if not save:
+                chat_session.session_log = None
+            return chat_session, session_id, True
+        chat_session = ChatSession()
+        if save:
+            chat_session.session_log = self.store.create(chat_session.model)
+            session_id = chat_session.session_log.session_id
+        else:
+            session_id = uuid.uuid4().hex[:8]
+        return chat_session, session_id, False
+
+    async def attach(self, session_id, save=True) -> tuple:
+        """
+        Finds a warm session, resumes a saved one or starts a new one.
+
+        Args:
+            session_id (str): The id of the session, or None for a new one.
+            save (bool): Whether a new or resumed session saves its messages.
+
+        Returns:
+            tuple: The DaemonSession and whether it was resumed from its log.
+
+        Raises:
+            KeyError: If there is no such session.
+        """
+        if session_id in self.sessions:
+            return self.sessions[session_id], False
+        chat_session, session_id, resumed = await asyncio.to_thread(self._open_session, session_id, save)
+        if session_id in self.sessions:
+            # Another client resumed it meanwhile; nothing was written to this copy
+            return self.sessions[session_id], False
+        session = self.sessions[session_id] = DaemonSession(session_id, chat_session)
+        return session, resumed
+
+    def apply_settings(self, session: DaemonSession, settings: dict):
+        """
+        Turns on the features a client asked for when attaching, as chat.py does with
+        its command line options. A setting never turns a feature off, so that clients
+        sharing a session do not undo each other. Enabling recall reads the session
+        log, so this runs in a worker thread.
+
+        Args:
+            session (DaemonSession): The attached session.
+            settings (dict): cache, recall (tokens), auto_summarize and check_budget.
+        """
+        chat_session = session.chat_session
+        if settings.get('auto_summarize'):
+            chat_session.auto_summarize = True
+        if settings.get('recall') and chat_session.history_index is None:
+            chat_session.enable_recall(int(settings['recall']))
+        if settings.get('cache') and chat_session.response_cache is None:
+            with self._cache_lock:
+                if self.response_cache is None:
+                    self.response_cache = DiskCache(RESPONSE_CACHE_FILENAME, ttl=RESPONSE_CACHE_TTL)
+            chat_session.response_cache = self.response_cache
+        if settings.get('check_budget'):
+            session.check_budget = True
+
+    async def evict_idle(self):
+        """Drops the sessions that had no client for idle_seconds."""
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if session.clients == 0 and now - session.last_used > self.idle_seconds:
+                del self.sessions[session_id]
+                # Closing updates the session index, under its file lock
+                await asyncio.to_thread(session.close)
+
+    async def handle_ask(self, session: DaemonSession, prompt: str, send):
+        # Everything that tokenizes the prompt, waits for the token ledger or writes to
+        # disk runs in worker threads, so that a long prompt does not hold up other clients.
+        # The prompt is tokenized once and its count reused.
+        chat_session = session.chat_session
+        tokens = await asyncio.to_thread(chat_session.count_message_tokens, prompt)
+        if session.check_budget:
+            most = chat_session.get_message_room()[1]
+            if tokens - TOKENS_PER_MESSAGE > most:
+                await send({'event': 'error', 'message': f'The message has {tokens - TOKENS_PER_MESSAGE} tokens, but the model accepts {max(0, most)}. Shorten it or split it.'})
+                return
+        trimmed = await asyncio.to_thread(chat_session.trim_context, prompt, tokens)
+        await asyncio.to_thread(session.logger.log_prompt, prompt)
+        requests = len(chat_session.metrics.requests)
+        deltas = []
+        async for delta in chat_session.ask_stream_async(prompt, tokens):
+            deltas.append(delta)
+            await send({'event': 'delta', 'text': delta})
+        result = {'event': 'done', 'trimmed': trimmed, 'prompt_tokens': 0, 'completion_tokens': 0}
+        # An answer from the response cache records no request
+        fields = {'model': chat_session.model, 'latency': 0, 'first_token': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached': True}
+        if len(chat_session.metrics.requests) > requests:
+            request_metrics = chat_session.metrics.requests[requests]
+            del fields['cached']
+            result.update(prompt_tokens=request_metrics.prompt_tokens, completion_tokens=request_metrics.completion_tokens)
+            fields.update(
+                latency=round(request_metrics.total_seconds, 3),
+                first_token=round(request_metrics.first_token_seconds, 3),
+                prompt_tokens=request_metrics.prompt_tokens,
+                completion_tokens=request_metrics.completion_tokens,
+            )
+        await asyncio.to_thread(session.logger.log_answer, ''.join(deltas), **fields)
+        await send(result)
+
+    async def handle_request(self, session: DaemonSession, request: dict, send):
+        """
+        Runs one request of an attached client.
+        """
+        chat_session = session.chat_session
+        op = request.get('op')
+        if op == 'ask':
+            await self.handle_ask(session, request.get('prompt', ''), send)
+        elif op == 'clear':
+            summary = await chat_session.summarize_async()
+            # Resetting the context writes to the session log and its index
+            await asyncio.to_thread(chat_session.clear_context)
+            await send({'event': 'done', 'summary': summary})
+        elif op == 'temperature':
+            chat_session.change_temperature(f"t={request.get('value')}")
+            await send({'event': 'done', 'temperature': chat_session.temperature})
+        elif op == 'system':
+            await asyncio.to_thread(chat_session.change_system_message, request.get('text'))
+            await send({'event': 'done', 'system': chat_session.system_message})
+        elif op == 'stats':
+            await send({
+                'event': 'done',
+                'text': chat_session.metrics.format_summary(),
+                'tokens_consumed': chat_session.get_tokens_consumed(),
+                'cost': chat_session.get_session_cost(),
+                'saved': chat_session.session_log is not None and not chat_session.session_log.is_empty,
+            })
+        else:
+            await send({'event': 'error', 'message': f'Unknown operation: {op}'})
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = None
+        connected = True
+
+        async def send(event: dict):
+            # Once the client is gone, the answer is still completed and kept in the context
+            nonlocal connected
+            if not connected:
+                return
+            try:
+                writer.write(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+        try:
+            while connected:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await send({'event': 'error', 'message': f'Requests are limited to {MAX_LINE_BYTES} bytes'})
+                    break
+                if not line:
+                    break
+                try:
+                    # A pasted file takes a while to parse
+                    request = json.loads(line) if len(line) < LARGE_LINE_BYTES else await asyncio.to_thread(json.loads, line)
+                except json.JSONDecodeError:
+                    request = None
+                if not isinstance(request, dict):
+                    await send({'event': 'error', 'message': 'Requests must be JSON objects, one per line'})
+                    continue
+                op = request.get('op')
+                if op == 'ping':
+                    await send({'event': 'done', 'pid': os.getpid(), 'sessions': len(self.sessions)})
+                elif op == 'attach':
+                    try:
+                        new_session, resumed = await self.attach(request.get('session'), request.get('save', True))
+                    except KeyError:
+                        await send({'event': 'error', 'message': f"No saved session with id {request.get('session')}"})
+                        continue
+                    if session is not None:
+                        session.clients -= 1
+                    session = new_session
+                    session.clients += 1
+                    async with session.lock:
+                        try:
+                            await asyncio.to_thread(self.apply_settings, session, request.get('settings') or {})
+                        except Exception as e:
+                            session.logger.log_error(str(e))
+                            await send({'event': 'error', 'message': str(e)})
+                            continue
+                    if request.get('ssh'):
+                        session.logger.remote_ip = request['ssh'].split()[0]
+                    await send({
+                        'event': 'done',
+                        'session': session.session_id,
+                        'resumed': resumed,
+                        'messages': len(session.chat_session.chat_context),
+                        'system': session.chat_session.system_message,
+                    })
+                elif session is None:
+                    await send({'event': 'error', 'message': 'Attach to a session first'})
+                else:
+                    async with session.lock:
+                        try:
+                            await self.handle_request(session, request, send)
+                        except Exception as e:
+                            session.logger.log_error(str(e))
+                            await send({'event': 'error', 'message': str(e)})
+                        session.last_used = time.monotonic()
+        finally:
+            if session is not None:
+                session.clients -= 1
+                session.last_used = time.monotonic()
+            writer.close()
+
+    async def evict_idle_periodically(self):
+        while True:
+            await asyncio.sleep(min(60, self.idle_seconds))
+            await self.evict_idle()
+
+    def _lock_pid_file(self):
+        """
+        Locks the pid file for as long as the daemon runs, so that only one daemon
+        serves the socket.
+
+        Returns:
+            The open pid file, holding the lock.
+
+        Raises:
+            AlreadyRunningError: If another daemon holds the lock.
+        """
+        pid_file = open(self.pid_path, 'a+')
+        try:
+            fcntl.flock(pid_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pid_file.seek(0)
+            pid = pid_file.read().strip()
+            pid_file.close()
+            raise AlreadyRunningError(f'A daemon with pid {pid} is already serving {self.socket_path}')
+        pid_file.truncate(0)
+        pid_file.write(str(os.getpid()))
+        pid_file.flush()
+        return pid_file
+
+    async def serve(self):
+        """
+        Listens until cancelled. The socket is only accessible to the current user.
+
+        Raises:
+            AlreadyRunningError: If another daemon serves the socket.
+        """
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        pid_file = self._lock_pid_file()
+        try:
+            # With the lock held, a socket left behind is from a daemon that did not exit cleanly
+            self.socket_path.unlink(missing_ok=True)
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(self.handle_client, path=str(self.socket_path), limit=MAX_LINE_BYTES)
+            finally:
+                os.umask(umask)
+        except BaseException:
+            pid_file.close()
+            raise
+        evictor = asyncio.create_task(self.evict_idle_periodically())
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+            for session in self.sessions.values():
+                session.close()
+            self.socket_path.unlink(missing_ok=True)
+            pid_file.close()
+            import client_pool
+            await client_pool.close_async_clients()
+
+
+def is_running(socket_path: Path) -> bool:
+    """
+    Returns:
+        bool: Whether a daemon answers on the socket.
+    """
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            return False
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep chat sessions warm for chat_client.py and chat.py --attach')
+    parser.add_argument('--socket', default=str(SOCKET_PATH), help='The Unix socket to listen on')
+    parser.add_argument('--idle', type=float, default=IDLE_SECONDS,
+        help='Seconds a session without clients stays in memory')
+    args = parser.parse_args()
+    if is_running(Path(args.socket)):
+        print(f'A daemon is already listening on {args.socket}', file=sys.stderr)
+        sys.exit(1)
+    try:
+        asyncio.run(ChatDaemon(Path(args.socket), args.idle).serve())
+    except AlreadyRunningError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
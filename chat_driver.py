@@ -0,0 +1,161 @@
+import time
+import asyncio
+from collections.abc import Callable, AsyncGenerator
+
+import client_pool
+from chat_session import ChatSession
+
+
+async def run_conversation(chat_session: ChatSession, prompts: list) -> list:
+    """
+    Asks the prompts of one conversation in order, each seeing the previous answers.
+    The oldest turns are trimmed whenever the context would outgrow the model's window.
+
+    Args:
+        chat_session (ChatSession): The session holding the conversation's context.
+        prompts (list): The user messages to send.
+
+    Returns:
+        list: The assistant's answers, one per prompt.
+    """
+    answers = []
+    for prompt in prompts:
+        # Waits for the token ledger of the session, so it is kept off the event loop
+        await asyncio.to_thread(chat_session.trim_context, prompt)
+        answers.append(await chat_session.ask_async(prompt))
+    return answers
+
+
+async def run_conversations_async(
+        conversations: dict,
+        concurrency=16,
+        session_factory: Callable[[], ChatSession] = ChatSession) -> dict:
+    """
+    Runs many independent conversations concurrently on the running event loop.
+
+    Every conversation gets its own ChatSession, so their contexts never mix. At most
+    `concurrency` conversations have a request in flight at the same time.
+
+    Args:
+        conversations (dict): Maps a conversation name to its list of prompts.
+        concurrency (int): The maximum number of conversations running at once.
+        session_factory (Callable): Creates the ChatSession of each conversation.
+
+    Returns:
+        dict: Maps each conversation name to its list of answers, or to the exception
+        that stopped it.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(prompts):
+        async with semaphore:
+            return await run_conversation(session_factory(), prompts)
+
+    names = list(conversations)
+    try:
+        results = await asyncio.gather(
+            *(run(conversations[name]) for name in names), return_exceptions=True
+        )
+    finally:
+        await client_pool.close_async_clients()
+    return dict(zip(names, results))
+
+
+def run_conversations(conversations: dict, concurrency=16) -> dict:
+    """
+    Blocking wrapper around run_conversations_async that runs its own event loop.
+
+    Args:
+        conversations (dict): Maps a conversation name to its list of prompts.
+        concurrency (int): The maximum number of conversations running at once.
+
+    Returns:
+        dict: Maps each conversation name to its list of answers, or to the exception
+        that stopped it.
+    """
+    return asyncio.run(run_conversations_async(conversations, concurrency))
+
+
+async def ask_batch_request(chat_session: ChatSession, request: dict) -> dict:
+    """
+    Asks the prompt of one batch request and describes the outcome.
+
+    Args:
+        chat_session (ChatSession): The session of the request's thread.
+        request (dict): The request, with a prompt and optionally an id, a thread name,
+            a system message and a temperature.
+
+    Returns:
+        dict: The result, with the answer or the error, the time taken and the tokens used.
+    """
+    result = {'id': request.get('id'), 'thread': request.get('thread'), 'prompt': request['prompt']}
+    requests_before = len(chat_session.metrics.requests)
+    start = time.perf_counter()
+    try:
+        # Changing the system message clears the context, so a thread that repeats it keeps its history
+        if request.get('system') and request['system'] != chat_session.system_message:
+            chat_session.change_system_message(request['system'])
+        if request.get('temperature') is not None:
+            chat_session.temperature = float(request['temperature'])
+        # Waits for the token ledger of the session, so it is kept off the event loop
+        await asyncio.to_thread(chat_session.trim_context, request['prompt'])
+        result['answer'] = await chat_session.ask_async(request['prompt'])
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    new_requests = chat_session.metrics.requests[requests_before:]
+    result['prompt_tokens'] = sum(r.prompt_tokens for r in new_requests)
+    result['completion_tokens'] = sum(r.completion_tokens for r in new_requests)
+    result['cached'] = 'answer' in result and not new_requests
+    return result
+
+
+async def run_batch_async(
+        requests: list,
+        concurrency=16,
+        session_factory: Callable[[], ChatSession] = ChatSession) -> AsyncGenerator:
+    """
+    Runs batch requests concurrently and yields their results as they complete.
+
+    Requests with the same thread name form a conversation: they are asked in input
+    order on one ChatSession, each seeing the previous answers, and the rest of a thread
+    is skipped once one of its requests fails. Requests without a thread are
+    independent one-shots. At most `concurrency` threads run at the same time.
+
+    Args:
+        requests (list): The requests, as dicts for ask_batch_request.
+        concurrency (int): The maximum number of threads running at once.
+        session_factory (Callable): Creates the ChatSession of each thread.
+
+    Yields:
+        tuple: The index of a request in `requests` and its result.
+    """
+    threads: dict = {}
+    for index, request in enumerate(requests):
+        thread = request.get('thread')
+        threads.setdefault(('thread', thread) if thread is not None else ('one-shot', index), []).append(index)
+    results: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_thread(indexes):
+        async with semaphore:
+            chat_session = session_factory()
+            failed = False
+            for index in indexes:
+                if failed:
+                    request = requests[index]
+                    result = {'id': request.get('id'), 'thread': request.get('thread'), 'prompt': request['prompt'],
+                              'error': 'Skipped after an earlier request of the thread failed'}
+                else:
+                    result = await ask_batch_request(chat_session, requests[index])
+                    failed = 'error' in result
+                results.put_nowait((index, result))
+
+    tasks = [asyncio.ensure_future(run_thread(indexes)) for indexes in threads.values()]
+    try:
+        for _ in range(len(requests)):
+            yield await results.get()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await client_pool.close_async_clients()
@@ -1,27 +1,84 @@
 import os
 import copy
+import json
+import asyncio
+import functools
+import threading
+import collections
+import concurrent.futures
 from pathlib import Path
-from collections.abc import Generator
-# import openai
-from openai import OpenAI
+from collections.abc import Generator, AsyncGenerator
 import tiktoken
 
-from conf import set_openapi_conf
+from conf import ensure_openapi_conf, get_model_name
+from context_window import ContextWindow
+from endpoint_router import get_router
+from history_index import HistoryIndex
+from disk_cache import DEFAULT_CACHE_DIRECTORY, make_cache_key
+from metrics import MetricsRecorder, RequestMetrics
 
 home_directory = str(Path.home())
 tiktoken_cache_path = Path.home() / Path('.chatgpt') / Path('data-gym-cache')
-if not tiktoken_cache_path.exists:
-    tiktoken_cache_path.mkdir()
+tiktoken_cache_path.mkdir(parents=True, exist_ok=True)
 os.environ['DATA_GYM_CACHE_DIR'] = str(tiktoken_cache_path)
+os.environ.setdefault('TIKTOKEN_CACHE_DIR', str(tiktoken_cache_path))
+
+# Every message carries a few tokens of framing (role, separators) on top of its content.
+TOKENS_PER_MESSAGE = 4
+# With auto summarization, older turns are summarized once the context uses this share
+# of the prompt budget, down to SUMMARY_TARGET of it.
+SUMMARY_THRESHOLD = 0.75
+SUMMARY_TARGET = 0.5
+SUMMARY_PREFIX = 'Summary of the earlier conversation: '
+RESPONSE_CACHE_FILENAME = DEFAULT_CACHE_DIRECTORY / 'response-cache.sqlite3'
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding used by the given model, loading it only once per model.
+
+    Args:
+        model (str): The name of the chat model.
+
+    Returns:
+        tiktoken.Encoding: The model's encoding, or cl100k_base for unknown models.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _client_pool():
+    """
+    Imports client_pool on first use. It pulls in openai and httpx, which take most of
+    the start-up time, so it is kept off the path to the first prompt.
+    """
+    import client_pool
+    return client_pool
+
+
+def _request_scheduler():
+    """
+    Imports request_scheduler on first use, as it pulls in openai.
+    """
+    import request_scheduler
+    return request_scheduler
 
 class ChatSession:
     """
     A class to manage chat sessions with an AI assistant using the OpenAI API.
     """
-    def __init__(self):
+    def __init__(self, session_log=None):
         """
         Initializes a ChatSession object with default values for system message, chat context,
         total tokens, temperature, and model.
+
+        Args:
+            session_log (SessionLog): The log the chat context is saved to. If it already
+                has messages, the session resumes from it.
         """
         # possible system messages:
         # You are a helpful assistant.
@@ -30,17 +87,171 @@ class ChatSession:
         # You are a helpful teacher. Answer as detailed as possible.
         # available models: "gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k"
 
-        self.MAX_TOKEN = 4000
+        self.model = os.environ.get("OPENAI_CHAT_MODEL", "gpt-3.5-turbo")
         self.system_message: str = 'You are a helpful assistant.'
-        self.chat_context = [
-            {"role": "system", "content": f"{self.system_message}"},
-        ]
-        self.current_context_tokens = self._count_current_tokens()
+        # The context window keeps the cached token cost of every message in chat_context.
+        # The cost of the initial system message is counted by the warm-up thread.
+        self.context_window = ContextWindow(self.model)
+        self.chat_context = [{"role": "system", "content": self.system_message}]
+        self._ledger_ready = threading.Event()
+        self._system_message_counted = False
         self.temperature = 0.7
-        self.model = "gpt-3.5-turbo-0613"
         self.tokens_consumed = 0
+        # Tokens used by the unused copies of hedged requests, appended from the threads they finish on
+        self._hedged_tokens = collections.deque()
+        self.metrics = MetricsRecorder()
         self.price = 0.002
-        set_openapi_conf()
+        self._client = None
+        # Summarize older turns in the background instead of only trimming them
+        self.auto_summarize = False
+        self._pending_summary = None
+        # A DiskCache of the responses to requests with temperature 0, or None
+        self.response_cache = None
+        # A HistoryIndex of the turns that left the chat context, or None; see enable_recall
+        self.history_index = None
+        self.recall_tokens = 0
+        self.recalled_tokens = 0
+        self.session_log = session_log
+        if session_log is not None and not session_log.is_empty:
+            self._resume(session_log)
+        self._warm_up_thread = threading.Thread(target=self._warm_up, daemon=True)
+        self._warm_up_thread.start()
+
+    def _warm_up(self):
+        """
+        Loads the tokenizer and the API client in the background, so that the first prompt
+        does not wait for them.
+        """
+        try:
+            if self._system_message_counted:
+                get_token_encoding(self.model)
+            else:
+                self.context_window.append(self._count_message_tokens(self.system_message))
+                self._system_message_counted = True
+        except Exception:
+            # Counted again in the foreground, where the error can be reported
+            pass
+        finally:
+            self._ledger_ready.set()
+        try:
+            self.client
+            self._preconnect()
+        except Exception:
+            pass
+
+    def _resume(self, session_log):
+        """
+        Restores the chat context from the tail of a saved session that fits the prompt
+        budget, using the token costs stored in the log instead of counting them again.
+
+        Args:
+            session_log (SessionLog): The log of the saved session.
+        """
+        system_message, system_tokens, messages = session_log.load_tail(self.context_window.budget)
+        self.chat_context = []
+        self.context_window.reset()
+        if system_message:
+            self.system_message = system_message
+            self.chat_context.append({"role": "system", "content": system_message})
+            self.context_window.append(system_tokens)
+        for message in messages:
+            self.chat_context.append({"role": message["role"], "content": message["content"]})
+            self.context_window.append(message["tokens"])
+        self._system_message_counted = True
+
+    def _wait_for_ledger(self):
+        """
+        Waits until the warm-up thread has counted the initial system message.
+        """
+        if self._system_message_counted:
+            return
+        self._ledger_ready.wait()
+        if not self._system_message_counted:
+            self.context_window.append(self._count_message_tokens(self.system_message))
+            self._system_message_counted = True
+
+    @property
+    def client(self):
+        """The pooled OpenAI client of this session, built on first use."""
+        if self._client is None:
+            ensure_openapi_conf()
+            self._client = _client_pool().get_client()
+        return self._client
+
+    def _get_async_client(self):
+        """
+        Returns the pooled AsyncOpenAI client of the running event loop.
+        """
+        ensure_openapi_conf()
+        return _client_pool().get_async_client()
+
+    def _create_completion(self, **request):
+        """
+        Sends a chat completion request through the shared request scheduler, which keeps
+        to the rate limits and retries transient errors. The tokens of the request are
+        estimated from the token ledger. Streamed requests are never hedged. With several
+        endpoints configured, the request goes to the best one of the endpoint router.
+
+        Args:
+            **request: The arguments of the request, except the model.
+
+        Returns:
+            The chat completion, or the stream of chunks.
+        """
+        router = get_router()
+        if router is None:
+            def send():
+                return self.client.chat.completions.create(model=get_model_name(self.model), **request)
+        else:
+            def send():
+                return router.call(lambda endpoint: endpoint.get_client().chat.completions.create(
+                    model=endpoint.get_model(self.model), **request))
+        return _request_scheduler().get_scheduler().call(
+            send,
+            estimated_tokens=self.context_window.total + self.recalled_tokens,
+            hedge=not request.get('stream', False),
+            on_hedge_usage=self._hedged_tokens.append,
+        )
+
+    async def _create_completion_async(self, **request):
+        """
+        Same as _create_completion, on the event loop's pooled AsyncOpenAI clients.
+        """
+        router = get_router()
+        if router is None:
+            client = self._get_async_client()
+
+            def send():
+                return client.chat.completions.create(model=get_model_name(self.model), **request)
+        else:
+            def send():
+                return router.call_async(lambda endpoint: endpoint.get_async_client().chat.completions.create(
+                    model=endpoint.get_model(self.model), **request))
+        return await _request_scheduler().get_scheduler().call_async(
+            send,
+            estimated_tokens=self.context_window.total + self.recalled_tokens,
+            hedge=not request.get('stream', False),
+            on_hedge_usage=self._hedged_tokens.append,
+        )
+
+    def preconnect(self):
+        """
+        Opens a connection to the API in the background so that the next request does not
+        pay for the TCP/TLS handshake. Meant to be called while waiting for user input.
+        """
+        if self._warm_up_thread.is_alive():
+            # The warm-up thread pre-connects when it is done
+            return
+        self._preconnect()
+
+    @staticmethod
+    def _preconnect():
+        router = get_router()
+        if router is None:
+            _client_pool().preconnect()
+        else:
+            # The next request most likely goes to the best endpoint
+            router.rank()[0].preconnect()
 
     def _count_tokens(self, text: str) -> int:
         """
@@ -52,53 +263,251 @@ class ChatSession:
         Returns:
             int: The number of tokens in the text.
         """
-        token_encoding = tiktoken.get_encoding("cl100k_base")
-        return len(token_encoding.encode(text))
+        # Pasted text may hold special tokens, which are counted as plain text
+        return len(get_token_encoding(self.model).encode(text, disallowed_special=()))
 
     def _count_current_tokens(self):
         """
-        Counts the total number of tokens in the current chat context.
+        Returns the total number of tokens in the current chat context from the token ledger.
 
         Returns:
             int: The total number of tokens in the chat context.
         """
-        return sum(self._count_tokens(item['content']) for item in self.chat_context)
+        return self.current_context_tokens
+
+    @property
+    def current_context_tokens(self) -> int:
+        """The number of tokens in the current chat context."""
+        self._wait_for_ledger()
+        return self.context_window.total
+
+    def _count_message_tokens(self, content: str) -> int:
+        """
+        Counts the tokens a message with the given content takes in the chat context.
+        """
+        return self._count_tokens(content) + TOKENS_PER_MESSAGE
+
+    def count_message_tokens(self, content: str) -> int:
+        """
+        Counts the tokens a user message takes in the chat context, so that a long
+        message can be counted once, e.g. in a worker thread, and the count passed to
+        trim_context and the ask methods.
+
+        Args:
+            content (str): The message content.
+
+        Returns:
+            int: The token cost of the message, framing included.
+        """
+        return self._count_message_tokens(content)
 
-    def append_user_message(self, user_text):
+    def get_message_room(self) -> tuple:
+        """
+        Tells how long the next user message may be, from the token ledger. Never waits
+        for the warm-up thread, so it is cheap enough to call on every keystroke.
+
+        Returns:
+            tuple: The tokens the message may have without trimming the context, and
+            the most it may have at all, when only the system message is kept.
+        """
+        budget = self.context_window.budget
+        if self.history_index is not None:
+            budget -= self.recall_tokens
+        prefix = self.context_window.prefix
+        head = 1 if self.chat_context and self.chat_context[0]["role"] == "system" else 0
+        head_tokens = prefix[head] if len(prefix) > head else 0
+        return budget - prefix[-1] - TOKENS_PER_MESSAGE, budget - head_tokens - TOKENS_PER_MESSAGE
+
+    def _append_message(self, role: str, content: str, tokens=None):
+        """
+        Appends a message to the chat context, records its token cost in the ledger and
+        saves it to the session log, if any.
+
+        Args:
+            role (str): The role of the message author.
+            content (str): The message content.
+            tokens (int): The token cost of the message, or None to count it.
+        """
+        self._wait_for_ledger()
+        if tokens is None:
+            tokens = self._count_message_tokens(content)
+        if self.session_log is not None and self.session_log.is_empty:
+            # A new session starts with the system message it was created with
+            head = self.chat_context[0] if self.chat_context and self.chat_context[0]["role"] == "system" else None
+            self.session_log.reset(head["content"] if head else '', self.context_window.cost(0) if head else 0)
+        self.chat_context.append({"role": role, "content": content})
+        self.context_window.append(tokens)
+        if self.session_log is not None:
+            self.session_log.append(role, content, tokens)
+
+    def _reset_context(self, system_message: str):
+        """
+        Resets the chat context and the token ledger, keeping only the given system message,
+        and records the reset in the session log, if any.
+
+        Args:
+            system_message (str): The system message to start with, or an empty string for none.
+        """
+        self._wait_for_ledger()
+        self.chat_context = []
+        self.context_window.reset()
+        tokens = 0
+        if system_message:
+            tokens = self._count_message_tokens(system_message)
+            self.chat_context.append({"role": "system", "content": system_message})
+            self.context_window.append(tokens)
+        if self.session_log is not None:
+            self.session_log.reset(system_message, tokens)
+        if self.history_index is not None:
+            self.history_index.clear()
+
+    def append_user_message(self, user_text, tokens=None):
         """
         Appends a user message to the chat context.
 
         Args:
             user_text (str): The user's message to add to the chat context.
+            tokens (int): The token cost of the message from count_message_tokens, or None to count it.
         """
         if user_text.strip():
-            self.chat_context.append({
-                "role": "user",
-                "content": user_text
-            })
+            self._append_message("user", user_text, tokens)
 
-    def append_assistant_message(self, assistant_text, total_tokens):
+    def append_assistant_message(self, assistant_text):
         """
-        Appends an assistant message to the chat context and updates the total tokens.
+        Appends an assistant message to the chat context and updates the token ledger.
 
         Args:
             assistant_text (str): The assistant's message to add to the chat context.
-            total_tokens (int): The updated total tokens after receiving the assistant's message.
         """
-        self.chat_context.append({
-            "role": "assistant",
-            "content": f"{assistant_text}"
-        })
-        self.current_context_tokens = total_tokens
+        self._append_message("assistant", f"{assistant_text}")
+        if self.auto_summarize:
+            self._start_summary()
+
+    def _start_summary(self):
+        """
+        Starts summarizing the oldest turns in a background thread once the context nears
+        the prompt budget. Only one summary is made at a time.
+        """
+        if self._pending_summary is not None:
+            return
+        budget = self.context_window.budget
+        if self.context_window.total < budget * SUMMARY_THRESHOLD:
+            return
+        head = 1 if self.chat_context and self.chat_context[0]["role"] == "system" else 0
+        cut = self.context_window.find_cut(self.chat_context, head, budget=int(budget * SUMMARY_TARGET))
+        if cut == head:
+            return
+        messages = self.chat_context[head:cut]
+        future = concurrent.futures.Future()
+
+        def summarize_messages():
+            try:
+                future.set_result(self._summarize_messages(messages))
+            except Exception as e:
+                future.set_exception(e)
+
+        self._pending_summary = (future, head, messages)
+        threading.Thread(target=summarize_messages, daemon=True).start()
+
+    def _summarize_messages(self, messages: list):
+        """
+        Asks for a compact summary of the given messages.
+
+        Runs in a background thread, so the tokens and timing of the request are returned
+        for _apply_summary to account for on the caller's thread.
+
+        Returns:
+            tuple: The summary note, its token cost, the tokens used by the request and
+            the RequestMetrics of the request.
+        """
+        prompt = 'Summarize the conversation above as compact notes that keep the facts, decisions and open questions needed to continue it. Use the language of the conversation.'
+        request_metrics = RequestMetrics()
+        with request_metrics.tracking_connection():
+            response = self._create_completion(
+                messages=messages + [{"role": "system", "content": prompt}],
+                temperature=0,
+            )
+        request_metrics.finish(response.usage.prompt_tokens, response.usage.completion_tokens) # type: ignore
+        note = SUMMARY_PREFIX + response.choices[0].message.content # type: ignore
+        return note, self._count_message_tokens(note), response.usage.total_tokens, request_metrics # type: ignore
+
+    def _apply_summary(self):
+        """
+        Replaces the summarized turns by the summary note, if the background summary is
+        finished and those turns are still in the context unchanged. Never waits for it.
+        """
+        if self._pending_summary is None or not self._pending_summary[0].done():
+            return
+        future, head, messages = self._pending_summary
+        self._pending_summary = None
+        if future.exception() is not None:
+            return
+        note, tokens, total_tokens, request_metrics = future.result()
+        # The tokens are spent even if the note is no longer of use
+        self.tokens_consumed += total_tokens
+        self.metrics.record(request_metrics)
+        current = self.chat_context[head:head + len(messages)]
+        if len(current) != len(messages) or any(a is not b for a, b in zip(current, messages)):
+            # The context was cleared or trimmed meanwhile
+            return
+        self._archive(head, head + len(messages))
+        self.chat_context[head:head + len(messages)] = [{"role": "system", "content": note}]
+        self.context_window.replace(head, head + len(messages), tokens)
+
+    def enable_recall(self, tokens: int):
+        """
+        Keeps the turns that leave the chat context in a local BM25 index, and sends the
+        ones most relevant to each question along with the recent turns. The recent
+        turns are trimmed to the prompt budget minus the recalled tokens, so prompts stay
+        small without forgetting what was said long ago. A resumed session indexes the
+        older messages of its log.
+
+        Args:
+            tokens (int): The number of tokens of older turns sent with a request.
+        """
+        self.history_index = HistoryIndex()
+        self.recall_tokens = tokens
+        if self.session_log is None or self.session_log.is_empty:
+            return
+        loaded = sum(1 for message in self.chat_context if message["role"] != "system")
+        messages = self.session_log.load_context()
+        older = messages[:len(messages) - loaded]
+        self.history_index.add_messages(older, [message["tokens"] for message in older])
+
+    def _archive(self, start: int, stop: int):
+        """
+        Adds the messages in [start, stop) of the chat context, which are about to leave
+        it, to the history index, if any.
+        """
+        if self.history_index is not None:
+            costs = [self.context_window.cost(index) for index in range(start, stop)]
+            self.history_index.add_messages(self.chat_context[start:stop], costs)
+
+    def _build_request_messages(self) -> list:
+        """
+        Builds the messages of a request for the chat context. With a history index, the
+        older turns most relevant to the latest user message are put back between the
+        system message and the recent turns, within recall_tokens and the room left in
+        the prompt budget.
+
+        Returns:
+            list: The messages to send.
+        """
+        self.recalled_tokens = 0
+        if not self.history_index or not self.chat_context or self.chat_context[-1]["role"] != "user":
+            return self.chat_context
+        budget = min(self.recall_tokens, self.context_window.budget - self.context_window.total)
+        messages, self.recalled_tokens = self.history_index.recall(self.chat_context[-1]["content"], budget)
+        if not messages:
+            return self.chat_context
+        head = 1 if self.chat_context[0]["role"] == "system" else 0
+        return self.chat_context[:head] + messages + self.chat_context[head:]
 
     def clear_context(self):
         """
-        Clears the chat context except for the system message and resets the total tokens.
+        Clears the chat context except for the system message and resets the token ledger.
         """
-        self.chat_context = [
-            {"role": "system", "content": f"{self.system_message}"},
-        ]
-        self.current_context_tokens = 0
+        self._reset_context(self.system_message)
 
     def change_system_message(self, text):
         """
@@ -110,27 +519,44 @@ class ChatSession:
         if text is None:
             return
         if not text.strip():
-            self.chat_context = []
+            self._reset_context('')
         else:
             self.system_message = text
-            self.chat_context = [
-                {"role": "system", "content": f"{self.system_message}"},
-            ]
-        self.current_context_tokens = 0
+            self._reset_context(self.system_message)
 
-    def trim_context(self):
+    def trim_context(self, user_text='', tokens=None):
         """
-        Trims the chat context if the token count exceeds the limit (4000 by default).
+        Trims the oldest messages if the chat context does not fit the model's prompt budget.
+
+        The budget is the model's context window minus the tokens reserved for the
+        completion. The system message is always kept and question/answer pairs are
+        dropped together. With auto_summarize, a finished background summary first
+        replaces the turns it covers. With a history index, the budget leaves room for
+        the recalled turns and the dropped messages are indexed.
+
+        Args:
+            user_text (str): A user message about to be sent, counted towards the budget.
+            tokens (int): The token cost of the user message from count_message_tokens, or None to count it.
 
         Returns:
             bool: True if the chat context was trimmed, False otherwise.
         """
-        if self.current_context_tokens >= self.MAX_TOKEN or self._count_current_tokens() > self.MAX_TOKEN:
-            self.chat_context = self.chat_context[:1] + self.chat_context[-5:]
-            while self._count_current_tokens() > self.MAX_TOKEN and len(self.chat_context) > 2:
-                self.chat_context = self.chat_context[:1] + self.chat_context[2:]
-            return True
-        return False
+        self._wait_for_ledger()
+        self._apply_summary()
+        extra_tokens = 0
+        if user_text.strip():
+            extra_tokens = self._count_message_tokens(user_text) if tokens is None else tokens
+        head = 1 if self.chat_context and self.chat_context[0]["role"] == "system" else 0
+        budget = None
+        if self.history_index is not None:
+            budget = max(0, self.context_window.budget - self.recall_tokens)
+        cut = self.context_window.find_cut(self.chat_context, head, extra_tokens, budget)
+        if cut == head:
+            return False
+        self._archive(head, cut)
+        del self.chat_context[head:cut]
+        self.context_window.remove(head, cut)
+        return True
 
     def change_temperature(self, setting):
         """
@@ -147,84 +573,252 @@ class ChatSession:
             if 0 <= val <= 2:
                 self.temperature = val
 
-    def summarize(self):
+    def _build_summary_context(self) -> list:
+        """
+        Builds the messages of a request that asks for a summary of the chat context.
+
+        Returns:
+            list: A copy of the chat context followed by the summary instruction.
+        """
         context = copy.deepcopy(self.chat_context)
         prompt = 'Summarize the above chat as accurately as possible. The summary should be less than 3 sentences. If the chat is mostly in Chinese, use Chinese for the summary; otherwise, use English for the summary.'
         context.append({
             "role": "system",
             "content": prompt
         })
-        response = openai.ChatCompletion.create(
-            model = self.model,
-            messages = context,
-            request_timeout = 120,
-            timeout = 120,
-            temperature = 0
-        )
+        return context
+
+    def _consume_response(self, response, request_metrics: RequestMetrics) -> str:
+        """
+        Accounts for the tokens and timing of a chat completion and returns its text.
+
+        Args:
+            response: The chat completion returned by the API.
+            request_metrics (RequestMetrics): The metrics of the request.
+
+        Returns:
+            str: The response text.
+        """
         response_text = response.choices[0].message.content # type: ignore
         total_tokens = response.usage.total_tokens # type: ignore
         self.tokens_consumed += total_tokens
+        request_metrics.finish(response.usage.prompt_tokens, response.usage.completion_tokens) # type: ignore
+        self.metrics.record(request_metrics)
         return response_text
 
+    def _consume_stream(self, deltas: list, request_metrics: RequestMetrics):
+        """
+        Appends a streamed response to the chat context and accounts for its tokens and timing.
+
+        Streamed responses carry no usage, so the tokens are taken from the token ledger.
+
+        Args:
+            deltas (list): The pieces of the response text.
+            request_metrics (RequestMetrics): The metrics of the request.
+        """
+        prompt_tokens = self.current_context_tokens + self.recalled_tokens
+        completion_tokens = 0
+        if deltas:
+            self.append_assistant_message(''.join(deltas))
+            completion_tokens = self.context_window.cost(len(self.chat_context) - 1) - TOKENS_PER_MESSAGE
+        self.tokens_consumed += prompt_tokens + completion_tokens
+        request_metrics.finish(prompt_tokens, completion_tokens)
+        self.metrics.record(request_metrics)
+
+    def _lookup_response(self, messages: list, temperature: float):
+        """
+        Looks up the response to a request in the response cache. Only requests with
+        temperature 0 are cached, as the others are not meant to be repeatable.
+
+        Args:
+            messages (list): The messages of the request.
+            temperature (float): The temperature of the request.
+
+        Returns:
+            tuple: The cache key, or None if the request is not cached, and the cached
+            response text, or None on a miss.
+        """
+        if self.response_cache is None or temperature != 0:
+            return None, None
+        normalized = [[m["role"], m["content"].strip()] for m in messages]
+        key = make_cache_key(self.model, temperature, json.dumps(normalized, ensure_ascii=False))
+        return key, self.response_cache.get(key)
+
+    def _store_response(self, key, response_text: str):
+        """Stores a response in the response cache, if the request is cached."""
+        if key is not None and response_text:
+            self.response_cache.put(key, response_text)
+
+    def _prepare_request(self, user_text: str, tokens=None) -> tuple:
+        """
+        Appends the user message and builds the request, looking it up in the response cache.
+
+        Returns:
+            tuple: The request messages, the cache key and the cached response text, or None.
+        """
+        self.append_user_message(user_text, tokens)
+        messages = self._build_request_messages()
+        cache_key, response_text = self._lookup_response(messages, self.temperature)
+        return messages, cache_key, response_text
+
+    def _finish_response(self, cache_key, response_text: str):
+        """Stores a response in the response cache and appends it to the chat context."""
+        self._store_response(cache_key, response_text)
+        self.append_assistant_message(response_text)
+
+    def summarize(self):
+        messages = self._build_summary_context()
+        cache_key, summary = self._lookup_response(messages, 0)
+        if summary is not None:
+            return summary
+        request_metrics = RequestMetrics()
+        with request_metrics.tracking_connection():
+            response = self._create_completion(
+                messages=messages,
+                temperature=0,
+            )
+        summary = self._consume_response(response, request_metrics)
+        self._store_response(cache_key, summary)
+        return summary
+
     def ask(self, user_text):
         """
         Sends the chat context to the OpenAI API and retrieves the AI assistant's response.
+        With a response cache and temperature 0, a repeated request is answered from the
+        cache without consuming tokens.
 
         Args:
             user_text (str): The user's message to send to the OpenAI API.
         Returns:
             str: The AI assistant's response text.
         """
-        self.append_user_message(user_text)
-
-        # response = openai.ChatCompletion.create(
-        #     model = self.model,
-        #     messages = self.chat_context,
-        #     request_timeout = 120,
-        #     timeout = 120,
-        #     temperature = self.temperature
-        # )
-        client = OpenAI(
-            # This is the default and can be omitted
-            api_key=os.environ.get("OPENAI_API_KEY"),
-            base_url=os.environ.get("OPENAI_API_BASE"),
-        )
-        response = client.chat.completions.create(
-            messages=self.chat_context,
-            model=os.environ.get("OPENAI_CHAT_MODEL", "gpt-3.5-turbo"),
-#            model="gpt-3.5-turbo",
-        )
-        response_text = response.choices[0].message.content # type: ignore
-        total_tokens = response.usage.total_tokens # type: ignore
-        self.tokens_consumed += total_tokens
-        self.append_assistant_message(response_text, total_tokens)
+        messages, cache_key, response_text = self._prepare_request(user_text)
+        if response_text is not None:
+            self.append_assistant_message(response_text)
+            return response_text
+
+        request_metrics = RequestMetrics()
+        with request_metrics.tracking_connection():
+            response = self._create_completion(
+                messages=messages,
+                temperature=self.temperature,
+            )
+        response_text = self._consume_response(response, request_metrics)
+        self._finish_response(cache_key, response_text)
         return response_text
 
     def ask_stream(self, user_text: str) -> Generator:
+        """
+        Sends the chat context to the OpenAI API and streams the AI assistant's response.
 
-        self.append_user_message(user_text)
+        Args:
+            user_text (str): The user's message to send to the OpenAI API.
+        Returns:
+            Generator: The pieces of the response text as they arrive.
+        """
+        messages, cache_key, response_text = self._prepare_request(user_text)
+        if response_text is not None:
+            # A cached response arrives as a single piece
+            yield response_text
+            self.append_assistant_message(response_text)
+            return
 
-        response = openai.ChatCompletion.create(
-            model = self.model,
-            messages = self.chat_context,
-            request_timeout = 120,
-            timeout = 120,
-            temperature = self.temperature,
-            stream=True
-        )
-        content = ''
+        request_metrics = RequestMetrics()
+        with request_metrics.tracking_connection():
+            response = self._create_completion(
+                messages=messages,
+                temperature=self.temperature,
+                stream=True,
+            )
+        deltas = []
         for v in response:
-            if v.choices and "content" in v.choices[0].delta and v.choices[0].delta.content:  # type: ignore
-                content += v.choices[0].delta.content  # type: ignore
-                yield content # type: ignore
-        if content:
-            self.append_assistant_message(content, self._count_current_tokens())
+            if v.choices and v.choices[0].delta.content:
+                request_metrics.mark_first_token()
+                deltas.append(v.choices[0].delta.content)
+                yield deltas[-1]
+        self._consume_stream(deltas, request_metrics)
+        self._store_response(cache_key, ''.join(deltas))
+
+    async def summarize_async(self):
+        """
+        Same as summarize, but runs on the event loop's pooled AsyncOpenAI client.
+        """
+        messages = self._build_summary_context()
+        cache_key, summary = self._lookup_response(messages, 0)
+        if summary is not None:
+            return summary
+        request_metrics = RequestMetrics()
+        with request_metrics.tracking_connection():
+            response = await self._create_completion_async(
+                messages=messages,
+                temperature=0,
+            )
+        summary = self._consume_response(response, request_metrics)
+        self._store_response(cache_key, summary)
+        return summary
+
+    async def ask_async(self, user_text, tokens=None):
+        """
+        Same as ask, but runs on the event loop's pooled AsyncOpenAI client. Counting
+        tokens, writing the session log and the response cache run in worker threads,
+        so that they do not hold up the event loop.
+
+        Args:
+            user_text (str): The user's message to send to the OpenAI API.
+            tokens (int): The token cost of the message from count_message_tokens, or None to count it.
+        Returns:
+            str: The AI assistant's response text.
+        """
+        messages, cache_key, response_text = await asyncio.to_thread(self._prepare_request, user_text, tokens)
+        if response_text is not None:
+            await asyncio.to_thread(self.append_assistant_message, response_text)
+            return response_text
+
+        request_metrics = RequestMetrics()
+        with request_metrics.tracking_connection():
+            response = await self._create_completion_async(
+                messages=messages,
+                temperature=self.temperature,
+            )
+        response_text = self._consume_response(response, request_metrics)
+        await asyncio.to_thread(self._finish_response, cache_key, response_text)
+        return response_text
+
+    async def ask_stream_async(self, user_text: str, tokens=None) -> AsyncGenerator:
+        """
+        Same as ask_stream, but runs on the event loop's pooled AsyncOpenAI client, with
+        the blocking work in worker threads as in ask_async.
+        """
+        messages, cache_key, response_text = await asyncio.to_thread(self._prepare_request, user_text, tokens)
+        if response_text is not None:
+            # A cached response arrives as a single piece
+            yield response_text
+            await asyncio.to_thread(self.append_assistant_message, response_text)
+            return
+
+        request_metrics = RequestMetrics()
+        with request_metrics.tracking_connection():
+            response = await self._create_completion_async(
+                messages=messages,
+                temperature=self.temperature,
+                stream=True,
+            )
+        deltas = []
+        async for v in response:
+            if v.choices and v.choices[0].delta.content:
+                request_metrics.mark_first_token()
+                deltas.append(v.choices[0].delta.content)
+                yield deltas[-1]
+        await asyncio.to_thread(self._consume_stream, deltas, request_metrics)
+        await asyncio.to_thread(self._store_response, cache_key, ''.join(deltas))
 
     def get_tokens_consumed(self):
+        while self._hedged_tokens:
+            self.tokens_consumed += self._hedged_tokens.popleft()
         return self.tokens_consumed
 
     def get_session_cost(self):
-        cost = self.tokens_consumed * self.price / 1000
+        cost = self.get_tokens_consumed() * self.price / 1000
         if cost <= 0.01:
             cost = 0.01
         return cost
@@ -0,0 +1,182 @@
+import os
+import time
+import asyncio
+import threading
+import weakref
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+from metrics import current_request_metrics
+
+# Connection settings, each overridable through the environment variable of the same name.
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', 120))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 10))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', 20))
+OPENAI_MAX_KEEPALIVE = int(os.environ.get('OPENAI_MAX_KEEPALIVE', 10))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', 60))
+
+_lock = threading.Lock()
+_clients: dict = {}
+_http_clients: dict = {}
+_last_preconnect: dict = {}
+# Async clients are bound to the event loop they were created on.
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_api_settings() -> tuple:
+    """
+    Returns the API key and base URL configured through conf.set_openapi_conf or the environment.
+
+    Returns:
+        tuple: The API key and the API base URL; either may be None to use the SDK defaults.
+    """
+    api_key = openai.api_key or os.environ.get('OPENAI_API_KEY')
+    base_url = os.environ.get('OPENAI_API_BASE') or getattr(openai, 'api_base', None)
+    return api_key, base_url
+
+
+def _trace(event_name, info):
+    request_metrics = current_request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.on_connection_event(event_name)
+
+
+async def _trace_async(event_name, info):
+    _trace(event_name, info)
+
+
+def _add_trace(request: httpx.Request):
+    request.extensions['trace'] = _trace
+
+
+async def _add_trace_async(request: httpx.Request):
+    request.extensions['trace'] = _trace_async
+
+
+def _http_client_options() -> dict:
+    return dict(
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def _build_http_client() -> httpx.Client:
+    return httpx.Client(event_hooks={'request': [_add_trace]}, **_http_client_options())
+
+
+def get_client(api_key=None, base_url=None) -> OpenAI:
+    """
+    Returns the shared OpenAI client for the given credentials, creating it on first use.
+
+    All clients are long-lived and keep their connections alive, so consecutive
+    requests to the same API base reuse the TCP/TLS connection.
+
+    Args:
+        api_key (str): The API key, or None to use the configured one.
+        base_url (str): The API base URL, or None to use the configured one.
+
+    Returns:
+        OpenAI: The pooled client.
+    """
+    if api_key is None and base_url is None:
+        api_key, base_url = get_api_settings()
+    key = (api_key, base_url)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = _build_http_client()
+            # Retries are left to request_scheduler, which also keeps to the rate limits
+            client = OpenAI(
+                api_key=api_key, base_url=base_url, timeout=OPENAI_TIMEOUT, max_retries=0, http_client=http_client
+            )
+            _clients[key] = client
+            _http_clients[key] = http_client
+    return client
+
+
+def get_async_client(api_key=None, base_url=None) -> AsyncOpenAI:
+    """
+    Returns the shared AsyncOpenAI client of the running event loop for the given credentials.
+
+    Must be called from a coroutine. Each event loop gets its own pooled client, so
+    all coroutines on one loop share its keep-alive connections.
+
+    Args:
+        api_key (str): The API key, or None to use the configured one.
+        base_url (str): The API base URL, or None to use the configured one.
+
+    Returns:
+        AsyncOpenAI: The pooled async client.
+    """
+    if api_key is None and base_url is None:
+        api_key, base_url = get_api_settings()
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get((api_key, base_url))
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=OPENAI_TIMEOUT,
+            max_retries=0,
+            http_client=httpx.AsyncClient(event_hooks={'request': [_add_trace_async]}, **_http_client_options()),
+        )
+        clients[(api_key, base_url)] = client
+    return client
+
+
+async def close_async_clients():
+    """Closes the pooled async clients of the running event loop."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+
+
+def _warm_connection(api_key, base_url):
+    try:
+        client = get_client(api_key, base_url)
+        # Any response will do; the point is to leave an open connection in the pool.
+        _http_clients[(api_key, base_url)].head(str(client.base_url))
+    except (httpx.HTTPError, openai.OpenAIError):
+        pass
+
+
+def preconnect(api_key=None, base_url=None):
+    """
+    Builds the client and opens a keep-alive connection to the API host on a background thread.
+
+    Calls made while a recent connection should still be alive are ignored.
+
+    Args:
+        api_key (str): The API key, or None to use the configured one.
+        base_url (str): The API base URL, or None to use the configured one.
+
+    Returns:
+        threading.Thread: The started thread, or None if no pre-connect was needed.
+    """
+    if api_key is None and base_url is None:
+        api_key, base_url = get_api_settings()
+    key = (api_key, base_url)
+    now = time.monotonic()
+    with _lock:
+        if now - _last_preconnect.get(key, -OPENAI_KEEPALIVE_EXPIRY) < OPENAI_KEEPALIVE_EXPIRY / 2:
+            return None
+        _last_preconnect[key] = now
+    thread = threading.Thread(target=_warm_connection, args=key, daemon=True)
+    thread.start()
+    return thread
+
+
+def close_clients():
+    """Closes all pooled clients and their connections."""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        _http_clients.clear()
+        _last_preconnect.clear()
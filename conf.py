@@ -1,6 +1,12 @@
 import os
+import threading
 from pathlib import Path
-import openai
+
+# The model names of the default API base, set from its line in .apibase. Replaced as a
+# whole, never changed in place, as other threads read it.
+_model_mappings = {}
+_configured = False
+_configure_lock = threading.Lock()
 
 def get_conf_content_by_name(name: str) -> str:
     """
@@ -37,22 +43,64 @@ def set_openapi_conf(api_key='', api_base='') -> None:
 
     If the API key and/or API base URL are not provided, this function will
     search for the corresponding configuration files in the user's home
-    directory and the current working directory.
+    directory and the current working directory. The first endpoint of .apibase
+    is the API base; the API key and model mappings on its line, if any, are
+    used with it.
 
     Args:
         api_key (str): The API key for the OpenAI API.
         api_base (str): The API base URL for the OpenAI API.
     """
+    # Imported here so that importing conf stays cheap
+    import openai
+
+    from endpoint_router import parse_endpoint_line
+    global _model_mappings, _configured
+
     if api_key:
         openai.api_key = api_key
     if api_base:
         openai.api_base = api_base
 
+    if not api_base and not os.environ.get('OPENAI_API_BASE'):
+        # With several endpoints, one per line, the first one is the default;
+        # endpoint_router spreads the requests over all of them.
+        endpoints = map(parse_endpoint_line, get_conf_content_by_name('.apibase').splitlines())
+        default = next((endpoint for endpoint in endpoints if endpoint is not None), None)
+        if default is not None:
+            openai.api_base = default.base_url
+            if default.api_key and not api_key:
+                openai.api_key = default.api_key
+            _model_mappings = dict(default.models)
     if not openai.api_key:
         content = get_conf_content_by_name('.apikey')
         if content:
             openai.api_key = content
-    if not api_base and not os.environ.get('OPENAI_API_BASE'):
-        content = get_conf_content_by_name('.apibase')
-        if content:
-            openai.api_base = content
+    _configured = True
+
+
+def ensure_openapi_conf() -> None:
+    """
+    Configures the OpenAI API from the configuration files, unless set_openapi_conf
+    has already run. Cheap enough to call before every request, as the files are only
+    read once per process.
+    """
+    if _configured:
+        return
+    with _configure_lock:
+        if not _configured:
+            set_openapi_conf()
+
+
+def get_model_name(model: str) -> str:
+    """
+    Returns the name of a model at the default API base, as mapped in .apibase.
+    Only valid once set_openapi_conf has run.
+
+    Args:
+        model (str): The model name used by this program.
+
+    Returns:
+        str: The model name to send.
+    """
+    return _model_mappings.get(model, model)
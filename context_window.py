@@ -0,0 +1,136 @@
+import os
+import bisect
+
+# Context window sizes (prompt + completion) of the chat models, matched by the longest name prefix.
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-3.5-turbo-0301': 4096,
+    'gpt-3.5-turbo-0613': 4096,
+    'gpt-3.5-turbo-16k': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4.1': 1047576,
+    'o1': 200000,
+    'o3': 200000,
+    'o4-mini': 200000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# At most this many tokens of the window are held back for the completion.
+MAX_COMPLETION_RESERVE = 4096
+
+
+def get_context_window(model: str) -> int:
+    """
+    Looks up the context window size of a model.
+
+    The OPENAI_CONTEXT_WINDOW environment variable overrides the table, which is
+    useful for models served through a custom OPENAI_API_BASE.
+
+    Args:
+        model (str): The name of the chat model.
+
+    Returns:
+        int: The number of tokens the model accepts for prompt and completion together.
+    """
+    override = os.environ.get('OPENAI_CONTEXT_WINDOW')
+    if override:
+        return int(override)
+    best = ''
+    for name in MODEL_CONTEXT_WINDOWS:
+        if model.startswith(name) and len(name) > len(best):
+            best = name
+    return MODEL_CONTEXT_WINDOWS[best] if best else DEFAULT_CONTEXT_WINDOW
+
+
+class ContextWindow:
+    """
+    Token ledger of a chat context, kept as prefix sums of the per-message token costs.
+
+    prefix[i] is the number of tokens used by the first i messages, so the total is
+    prefix[-1] and the cost of any run of messages is a single subtraction.
+    """
+    def __init__(self, model: str, reserve_tokens=None):
+        """
+        Args:
+            model (str): The chat model, used to look up the window size.
+            reserve_tokens (int): Tokens held back for the completion. Defaults to a
+                quarter of the window, capped at MAX_COMPLETION_RESERVE.
+        """
+        self.limit = get_context_window(model)
+        if reserve_tokens is None:
+            reserve_tokens = min(self.limit // 4, MAX_COMPLETION_RESERVE)
+        self.reserve_tokens = reserve_tokens
+        self.prefix = [0]
+
+    @property
+    def budget(self) -> int:
+        """The number of tokens the prompt may use."""
+        return self.limit - self.reserve_tokens
+
+    @property
+    def total(self) -> int:
+        """The number of tokens used by all messages."""
+        return self.prefix[-1]
+
+    def cost(self, index: int) -> int:
+        """Returns the token cost of the message at the given index."""
+        return self.prefix[index + 1] - self.prefix[index]
+
+    def append(self, tokens: int):
+        """Records the token cost of a newly appended message."""
+        self.prefix.append(self.prefix[-1] + tokens)
+
+    def reset(self):
+        """Forgets all messages."""
+        self.prefix = [0]
+
+    def remove(self, start: int, stop: int):
+        """
+        Forgets the messages in [start, stop), rebuilding the prefix sums in one pass.
+        """
+        removed = self.prefix[stop] - self.prefix[start]
+        self.prefix[start + 1:] = [p - removed for p in self.prefix[stop + 1:]]
+
+    def replace(self, start: int, stop: int, tokens: int):
+        """
+        Replaces the messages in [start, stop) by a single message of the given cost.
+        """
+        delta = tokens - (self.prefix[stop] - self.prefix[start])
+        self.prefix[start + 1:] = [self.prefix[start] + tokens] + [p + delta for p in self.prefix[stop + 1:]]
+
+    def find_cut(self, messages: list, head: int, extra_tokens=0, budget=None) -> int:
+        """
+        Finds where to cut the history so that the prompt fits the budget.
+
+        Messages before head (the system message) are always kept. The cut is
+        moved forward to the next user message so that question/answer pairs stay
+        together. Without a pending message, the latest turn is kept even if it
+        alone exceeds the budget.
+
+        Args:
+            messages (list): The chat messages the ledger describes.
+            head (int): The number of leading messages that are never dropped.
+            extra_tokens (int): Tokens of a message that is about to be appended.
+            budget (int): The number of tokens to fit in, if not the prompt budget.
+
+        Returns:
+            int: The index of the first message to keep after head; head if nothing
+            needs to be dropped.
+        """
+        overflow = self.total + extra_tokens - (self.budget if budget is None else budget)
+        if overflow <= 0:
+            return head
+        # Smallest cut with prefix[cut] - prefix[head] >= overflow.
+        cut = bisect.bisect_left(self.prefix, self.prefix[head] + overflow, lo=head, hi=len(messages))
+        while cut < len(messages) and messages[cut]['role'] != 'user':
+            cut += 1
+        if cut < len(messages) or extra_tokens:
+            return cut
+        for index in range(len(messages) - 1, head - 1, -1):
+            if messages[index]['role'] == 'user':
+                return index
+        return max(head, len(messages) - 1)
@@ -0,0 +1,126 @@
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import Optional
+
+DEFAULT_CACHE_DIRECTORY = Path.home() / '.chatgpt'
+
+
+def make_cache_key(*parts) -> str:
+    """
+    Hash the given parts into a cache key.
+
+    Args:
+        *parts: Strings or numbers that together identify a cached value.
+
+    Returns:
+        str: Hex digest of the parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    A size-bounded LRU cache of strings, stored zlib-compressed in a SQLite file.
+
+    Entries older than `ttl` seconds are treated as missing. When the stored size goes
+    over `max_bytes`, the least recently used entries are evicted. The cache may be
+    shared by several threads.
+    """
+    def __init__(self, path: Path, max_bytes=64 * 1024 * 1024, ttl: Optional[float] = None):
+        """
+        Args:
+            path (Path): The SQLite file, created if needed.
+            max_bytes (int): The maximum total size of the compressed values.
+            ttl (float): The number of seconds an entry stays valid, or None to keep it forever.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self._db.commit()
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Looks up a value and marks it as recently used.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            str: The cached value, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self.hits += 1
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, key: str, value: str):
+        """
+        Stores a value, evicting the least recently used entries if the cache is full.
+
+        Args:
+            key (str): The cache key.
+            value (str): The value to store.
+        """
+        blob = zlib.compress(value.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+            if row:
+                self._size -= row[0]
+            self._db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, blob, len(blob), now, now),
+            )
+            self._size += len(blob)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes."""
+        rows = self._db.execute('SELECT key, size FROM cache ORDER BY accessed')
+        evicted = []
+        for key, size in rows:
+            if self._size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._db.executemany('DELETE FROM cache WHERE key = ?', evicted)
+
+    def get_stats(self) -> str:
+        """
+        Returns:
+            str: A one-line summary of the hits and misses so far.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        return f'{self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate)'
+
+    def close(self):
+        """Closes the SQLite connection."""
+        with self._lock:
+            self._db.close()
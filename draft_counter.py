@@ -0,0 +1,108 @@
+import threading
+from collections.abc import Callable
+from typing import Optional
+
+# Counted lines kept for reuse; the cache is emptied when it grows past this.
+LINE_CACHE_SIZE = 20000
+
+
+class DraftTokenCounter:
+    """
+    Counts the tokens of the text being typed at the prompt, on a background thread.
+
+    The draft is counted line by line and the count of every line is cached, so after a
+    keystroke only the edited line is tokenized again, and a large paste is tokenized
+    once. The total is the sum of the lines plus one token per line break, which is
+    within a few tokens of counting the whole text at once; count_exact gives the
+    exact count. The counts are kept per encoding, so switching models never reuses
+    the counts of another tokenizer.
+
+    Pasted text may hold special tokens, which are counted as plain text.
+    """
+    def __init__(self, get_encoding: Callable):
+        """
+        Args:
+            get_encoding (Callable): Returns the tiktoken encoding of the current model.
+        """
+        self.get_encoding = get_encoding
+        # Called from the background thread whenever a new count is ready
+        self.on_update: Optional[Callable[[], None]] = None
+        # Line counts by encoding name
+        self._caches = {}
+        self._counted = (None, '', 0)
+        self._pending = None
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def count(self, text: str) -> int:
+        """
+        Counts the tokens of a text right away, using the cached lines.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The number of tokens.
+        """
+        if not text:
+            return 0
+        encoding = self.get_encoding()
+        cache = self._caches.setdefault(encoding.name, {})
+        if len(cache) > LINE_CACHE_SIZE:
+            cache.clear()
+        lines = text.split('\n')
+        tokens = len(lines) - 1
+        for line in lines:
+            line_tokens = cache.get(line)
+            if line_tokens is None:
+                line_tokens = cache[line] = len(encoding.encode(line, disallowed_special=())) if line else 0
+            tokens += line_tokens
+        return tokens
+
+    def count_exact(self, text: str) -> int:
+        """
+        Counts the tokens of a text as a whole, for when the count must be exact.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The number of tokens.
+        """
+        return len(self.get_encoding().encode(text, disallowed_special=()))
+
+    def request(self, text: str) -> tuple:
+        """
+        Asks for the count of a text without waiting for it.
+
+        Args:
+            text (str): The current draft.
+
+        Returns:
+            tuple: The latest count and whether it is the count of this text. If it is
+            not, the text is counted in the background and on_update is called when done.
+        """
+        encoding_name, counted_text, tokens = self._counted
+        if text == counted_text and encoding_name == self.get_encoding().name:
+            return tokens, True
+        self._pending = text
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._wakeup.set()
+        return tokens, False
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            text = self._pending
+            try:
+                encoding_name = self.get_encoding().name
+                tokens = self.count(text)
+            except Exception:
+                # The tokenizer is not available yet; the next keystroke tries again
+                continue
+            self._counted = (encoding_name, text, tokens)
+            if self.on_update is not None:
+                self.on_update()
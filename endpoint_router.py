@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import random
+import threading
+from pathlib import Path
+from collections.abc import Callable, Awaitable
+from typing import Optional
+
+from conf import get_conf_content_by_name, ensure_openapi_conf
+
+ENDPOINTS_FILENAME = Path.home() / '.chatgpt' / 'endpoints.json'
+# Weight of the latest observation in the moving averages of TTFT and error rate.
+EWMA_ALPHA = 0.3
+# An endpoint is ejected after this many failures in a row, or once its error rate exceeds EJECT_ERROR_RATE.
+MAX_CONSECUTIVE_FAILURES = 3
+EJECT_ERROR_RATE = 0.5
+EJECT_SECONDS = 30.0
+MAX_EJECT_SECONDS = 600.0
+# Share of requests sent to a random healthy endpoint, so that the slower ones keep being measured.
+EXPLORE_RATE = 0.05
+
+
+class Endpoint:
+    """
+    An OpenAI-compatible API endpoint, with its health as seen by the router.
+
+    `ttft` is the moving average of the seconds until the response starts (the first
+    token of a streamed response, or the whole response otherwise), and `error_rate`
+    the moving average of the share of failed requests.
+    """
+    def __init__(self, base_url: str, api_key=None, models=None, name=None):
+        """
+        Args:
+            base_url (str): The API base URL.
+            api_key (str): The API key, or None to use the configured one.
+            models (dict): Maps the model names used by this program to the ones of the endpoint.
+            name (str): The name shown in the stats, by default the base URL.
+        """
+        self.base_url = base_url
+        self.api_key = api_key
+        self.models = models or {}
+        self.name = name or base_url
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def get_model(self, model: str) -> str:
+        """Returns the endpoint's name for the given model."""
+        return self.models.get(model, model)
+
+    def _get_api_key(self):
+        if self.api_key:
+            return self.api_key
+        import client_pool
+        return client_pool.get_api_settings()[0]
+
+    def get_client(self):
+        """Returns the pooled OpenAI client of the endpoint."""
+        import client_pool
+        return client_pool.get_client(self._get_api_key(), self.base_url)
+
+    def get_async_client(self):
+        """Returns the pooled AsyncOpenAI client of the endpoint for the running event loop."""
+        import client_pool
+        return client_pool.get_async_client(self._get_api_key(), self.base_url)
+
+    def preconnect(self):
+        """Opens a keep-alive connection to the endpoint in the background."""
+        import client_pool
+        client_pool.preconnect(self._get_api_key(), self.base_url)
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def score(self) -> float:
+        """
+        The expected seconds to a response; lower is better. Unmeasured endpoints come
+        first, unless they failed without ever answering, which puts them last.
+        """
+        if self.ttft is None:
+            return float('inf') if self.error_rate else 0.0
+        return self.ttft / max(0.05, 1 - self.error_rate)
+
+
+def parse_endpoint_line(line: str) -> Optional[Endpoint]:
+    """
+    Parses an endpoint of a multi-line .apibase file. A line holds the base URL, then
+    optionally the API key and model mappings, separated by spaces:
+
+        https://gateway.example.com/v1 sk-... gpt-3.5-turbo=gpt-35-turbo
+
+    Args:
+        line (str): The line.
+
+    Returns:
+        Endpoint: The endpoint, or None for an empty or comment line.
+    """
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+    fields = line.split()
+    api_key = None
+    models = {}
+    for field in fields[1:]:
+        if '=' in field:
+            model, endpoint_model = field.split('=', 1)
+            models[model] = endpoint_model
+        else:
+            api_key = field
+    return Endpoint(fields[0], api_key, models)
+
+
+def _get_endpoints_filename() -> Path:
+    return Path(os.environ.get('OPENAI_ENDPOINTS_FILE') or ENDPOINTS_FILENAME)
+
+
+def load_endpoints() -> list:
+    """
+    Loads the configured endpoints.
+
+    They are read from the JSON file named by OPENAI_ENDPOINTS_FILE, or else from
+    ~/.chatgpt/endpoints.json, a list of objects with base_url and optionally api_key,
+    models and name. Without such a file, every line of .apibase is an endpoint.
+
+    Returns:
+        list: The endpoints, in the order of the configuration.
+    """
+    filename = _get_endpoints_filename()
+    if filename.exists():
+        return [
+            Endpoint(entry['base_url'], entry.get('api_key'), entry.get('models'), entry.get('name'))
+            for entry in json.loads(filename.read_text())
+        ]
+    endpoints = [parse_endpoint_line(line) for line in get_conf_content_by_name('.apibase').splitlines()]
+    return [endpoint for endpoint in endpoints if endpoint is not None]
+
+
+class EndpointRouter:
+    """
+    Sends each request to the fastest healthy endpoint and fails over to the next one.
+
+    Endpoints are ranked by their moving average TTFT, weighted by their error rate. An
+    endpoint that fails MAX_CONSECUTIVE_FAILURES times in a row, or whose error rate
+    exceeds EJECT_ERROR_RATE, is ejected for EJECT_SECONDS, doubling with every further
+    ejection. When its time is up, it gets one request to prove itself, and is ejected
+    again right away if that request fails.
+
+    The router is shared by threads and event loops.
+    """
+    def __init__(self, endpoints: list, explore_rate=EXPLORE_RATE):
+        self.endpoints = endpoints
+        self.explore_rate = explore_rate
+        self._lock = threading.Lock()
+
+    def rank(self) -> list:
+        """
+        Returns:
+            list: The endpoints to try, best first. Ejected endpoints are left out,
+            unless all of them are ejected.
+        """
+        now = time.monotonic()
+        with self._lock:
+            healthy = [e for e in self.endpoints if not e.is_ejected(now)]
+            if not healthy:
+                return sorted(self.endpoints, key=lambda e: e.ejected_until)
+            ranked = sorted(healthy, key=Endpoint.score)
+            if len(ranked) > 1 and random.random() < self.explore_rate:
+                ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+            return ranked
+
+    def record_success(self, endpoint: Endpoint, ttft: float):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.ttft = ttft if endpoint.ttft is None else EWMA_ALPHA * ttft + (1 - EWMA_ALPHA) * endpoint.ttft
+            endpoint.error_rate *= 1 - EWMA_ALPHA
+            endpoint.consecutive_failures = 0
+            endpoint.ejections = 0
+
+    def record_failure(self, endpoint: Endpoint):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.failures += 1
+            endpoint.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * endpoint.error_rate
+            endpoint.consecutive_failures += 1
+            # An endpoint back from an ejection has not succeeded since
+            on_probation = endpoint.ejections > 0
+            if on_probation or endpoint.consecutive_failures >= MAX_CONSECUTIVE_FAILURES \
+                    or endpoint.error_rate > EJECT_ERROR_RATE:
+                eject_seconds = min(MAX_EJECT_SECONDS, EJECT_SECONDS * 2 ** endpoint.ejections)
+                endpoint.ejected_until = time.monotonic() + eject_seconds
+                endpoint.ejections += 1
+                endpoint.consecutive_failures = 0
+                # Measured afresh once it is back
+                endpoint.ttft = None
+                endpoint.error_rate = 0.0
+
+    def call(self, send: Callable):
+        """
+        Sends a request to the best endpoint, failing over to the next one on a
+        transient error.
+
+        Args:
+            send (Callable): Takes an Endpoint, sends the request to it and returns the result.
+
+        Returns:
+            The result of the first endpoint that succeeds.
+
+        Raises:
+            Exception: The error of the last endpoint, if all of them failed, or the
+            first error that is not transient.
+        """
+        from request_scheduler import is_retryable
+        error = None
+        for endpoint in self.rank():
+            start = time.perf_counter()
+            try:
+                result = send(endpoint)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self.record_failure(endpoint)
+                error = e
+                continue
+            self.record_success(endpoint, time.perf_counter() - start)
+            return result
+        raise error
+
+    async def call_async(self, send: Callable[[Endpoint], Awaitable]):
+        """
+        Same as call, for a send that returns an awaitable.
+        """
+        from request_scheduler import is_retryable
+        error = None
+        for endpoint in self.rank():
+            start = time.perf_counter()
+            try:
+                result = await send(endpoint)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self.record_failure(endpoint)
+                error = e
+                continue
+            self.record_success(endpoint, time.perf_counter() - start)
+            return result
+        raise error
+
+    def format_status(self) -> str:
+        """
+        Returns:
+            str: A small table with the health of every endpoint.
+        """
+        now = time.monotonic()
+        lines = [f'{"Endpoint":<40}{"TTFT (s)":>10}{"Errors":>8}{"Requests":>10}  Status']
+        with self._lock:
+            for e in self.endpoints:
+                ttft = f'{e.ttft:.3f}' if e.ttft is not None else '-'
+                status = f'ejected for {e.ejected_until - now:.0f}s' if e.is_ejected(now) else 'healthy'
+                lines.append(f'{e.name[:39]:<40}{ttft:>10}{e.error_rate:>8.0%}{e.requests:>10}  {status}')
+        return '\n'.join(lines)
+
+
+_router = None
+_router_loaded = False
+_router_lock = threading.Lock()
+
+
+def get_router() -> Optional[EndpointRouter]:
+    """
+    The API configuration is read along with the endpoints, once, so that the
+    endpoints without an API key of their own can use the configured one.
+
+    Returns:
+        EndpointRouter: The router of the configured endpoints, or None if .apibase
+        holds at most one, in which case requests go to the configured API base. A
+        single endpoint of endpoints.json gets a router, as its key and models are
+        only known to it.
+    """
+    global _router, _router_loaded
+    with _router_lock:
+        if not _router_loaded:
+            ensure_openapi_conf()
+            endpoints = load_endpoints()
+            if len(endpoints) > 1 or (endpoints and _get_endpoints_filename().exists()):
+                _router = EndpointRouter(endpoints)
+            _router_loaded = True
+        return _router
+
+
+def configure(endpoints: list) -> EndpointRouter:
+    """
+    Replaces the configured endpoints, e.g. for tests and benchmarks.
+
+    Args:
+        endpoints (list): The endpoints to route to.
+
+    Returns:
+        EndpointRouter: The new shared router.
+    """
+    global _router, _router_loaded
+    with _router_lock:
+        ensure_openapi_conf()
+        _router = EndpointRouter(endpoints)
+        _router_loaded = True
+        return _router
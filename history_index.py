@@ -0,0 +1,155 @@
+import re
+import math
+import heapq
+from collections import Counter
+
+# BM25 parameters: term frequency saturation and document length normalization.
+BM25_K1 = 1.2
+BM25_B = 0.75
+# At most this many of the best scoring turns are considered for a request.
+MAX_CANDIDATES = 20
+# Runs of CJK characters are indexed as overlapping character pairs, as they have no spaces between words.
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_CJK_PATTERN = re.compile(f'[{_CJK}]')
+_TERM_PATTERN = re.compile(f'[{_CJK}]+|[^\\W_{_CJK}]+')
+STOP_WORDS = frozenset((
+    'a an and are as at be but by can did do does for from had has have he her his how i if in is it its '
+    'me my no not of on or our she so that the their them then there these they this to was we were what '
+    'when where which who why will with would you your'
+).split())
+
+
+def get_terms(text: str) -> list:
+    """
+    Splits a text into index terms: lower-case words without the stop words, and
+    character pairs for Chinese, Japanese and Korean.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The terms, in the order of the text.
+    """
+    terms = []
+    for match in _TERM_PATTERN.findall(text.lower()):
+        if _CJK_PATTERN.match(match):
+            if len(match) == 1:
+                terms.append(match)
+            else:
+                terms.extend(match[i:i + 2] for i in range(len(match) - 1))
+        elif match not in STOP_WORDS:
+            terms.append(match)
+    return terms
+
+
+class HistoryIndex:
+    """
+    An in-memory BM25 index of the older turns of a chat session.
+
+    A turn is a user message with the answers that followed it. Turns are added as
+    they leave the chat context, and each one is indexed once, so adding costs the
+    length of the turn and a search only visits the postings of the query terms.
+    """
+    def __init__(self):
+        # The turns as (messages, tokens), numbered in the order they were added
+        self.turns = []
+        # Maps a term to {turn number: term frequency}
+        self.postings = {}
+        self.lengths = []
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def add(self, messages: list, tokens: int):
+        """
+        Adds a turn to the index.
+
+        Args:
+            messages (list): The messages of the turn.
+            tokens (int): The token cost of the messages in the chat context.
+        """
+        number = len(self.turns)
+        terms = Counter(term for message in messages for term in get_terms(message['content']))
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[number] = count
+        length = sum(terms.values())
+        self.turns.append(([{'role': m['role'], 'content': m['content']} for m in messages], tokens))
+        self.lengths.append(length)
+        self.total_length += length
+
+    def add_messages(self, messages: list, costs: list):
+        """
+        Splits messages into turns at every user message and adds them. System messages,
+        such as summary notes, are left out.
+
+        Args:
+            messages (list): The messages, oldest first.
+            costs (list): The token cost of each message.
+        """
+        turn, tokens = [], 0
+        for message, cost in zip(messages, costs):
+            if message['role'] == 'system':
+                continue
+            if message['role'] == 'user' and turn:
+                self.add(turn, tokens)
+                turn, tokens = [], 0
+            turn.append(message)
+            tokens += cost
+        if turn:
+            self.add(turn, tokens)
+
+    def clear(self):
+        """Forgets all turns."""
+        self.__init__()
+
+    def search(self, query: str, limit=MAX_CANDIDATES) -> list:
+        """
+        Scores the turns against a query with BM25.
+
+        Args:
+            query (str): The query text.
+            limit (int): The maximum number of turns returned.
+
+        Returns:
+            list: (score, turn number) pairs of the turns sharing a term with the query,
+            best first.
+        """
+        if not self.turns:
+            return []
+        count = len(self.turns)
+        # The length normalization of BM25 is base + scale * length
+        base = BM25_K1 * (1 - BM25_B)
+        scale = BM25_K1 * BM25_B / (self.total_length / count or 1)
+        lengths = self.lengths
+        scores = {}
+        for term in set(get_terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            weight = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)) * (BM25_K1 + 1)
+            for number, frequency in postings.items():
+                scores[number] = scores.get(number, 0.0) + weight * frequency / (frequency + base + scale * lengths[number])
+        return heapq.nlargest(limit, ((score, number) for number, score in scores.items()))
+
+    def recall(self, query: str, budget: int) -> tuple:
+        """
+        Picks the turns most relevant to a query that fit the token budget.
+
+        Args:
+            query (str): The query text, usually the pending user message.
+            budget (int): The number of tokens the turns may use.
+
+        Returns:
+            tuple: The messages of the picked turns in their original order, and their
+            token cost.
+        """
+        picked = []
+        used = 0
+        for _, number in self.search(query):
+            tokens = self.turns[number][1]
+            if used + tokens <= budget:
+                picked.append(number)
+                used += tokens
+        messages = [message for number in sorted(picked) for message in self.turns[number][0]]
+        return messages, used
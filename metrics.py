@@ -0,0 +1,135 @@
+import math
+import time
+import threading
+import contextlib
+import contextvars
+from typing import Optional
+
+# The RequestMetrics of the request being sent, so that connection events can be attributed to it.
+current_request_metrics: contextvars.ContextVar = contextvars.ContextVar('current_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """
+    Timing and token counts of one API request.
+
+    All times are in seconds from the start of the request. For requests that are not
+    streamed, the first token arrives with the whole response.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.connect_seconds = 0.0
+        self.first_token_seconds: Optional[float] = None
+        self.total_seconds: Optional[float] = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._connect_started: Optional[float] = None
+
+    @contextlib.contextmanager
+    def tracking_connection(self):
+        """
+        Attributes the connection set-up done inside the with block to this request.
+        """
+        token = current_request_metrics.set(self)
+        try:
+            yield self
+        finally:
+            current_request_metrics.reset(token)
+
+    def on_connection_event(self, event_name: str):
+        """
+        Records the time spent on TCP connect and TLS handshake, from httpcore trace events.
+
+        Args:
+            event_name (str): The name of the trace event.
+        """
+        if event_name == 'connection.connect_tcp.started':
+            self._connect_started = time.perf_counter()
+        elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            if self._connect_started is not None:
+                now = time.perf_counter()
+                self.connect_seconds += now - self._connect_started
+                self._connect_started = now
+
+    def mark_first_token(self):
+        """Records the arrival of the first token of a streamed response."""
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.perf_counter() - self.start
+
+    def finish(self, prompt_tokens: int, completion_tokens: int):
+        """
+        Records the end of the request.
+
+        Args:
+            prompt_tokens (int): The number of tokens in the request.
+            completion_tokens (int): The number of tokens in the response.
+        """
+        self.total_seconds = time.perf_counter() - self.start
+        if self.first_token_seconds is None:
+            self.first_token_seconds = self.total_seconds
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    @property
+    def tokens_per_second(self) -> float:
+        """The generation speed, counted from the first token for streamed responses."""
+        generation_seconds = self.total_seconds - self.first_token_seconds
+        if generation_seconds <= 0:
+            generation_seconds = self.total_seconds
+        return self.completion_tokens / generation_seconds if generation_seconds > 0 else 0.0
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Returns the nearest-rank percentile of the values.
+
+    Args:
+        values (list): The values, in any order.
+        fraction (float): The percentile as a fraction, e.g. 0.95.
+
+    Returns:
+        float: The percentile, or 0 for no values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class MetricsRecorder:
+    """
+    Collects the RequestMetrics of a session or a run and summarizes them as p50/p95.
+
+    Requests may be recorded from several threads.
+    """
+    def __init__(self):
+        self.requests: list = []
+        self._lock = threading.Lock()
+
+    def record(self, request_metrics: RequestMetrics):
+        """Adds the metrics of a finished request."""
+        with self._lock:
+            self.requests.append(request_metrics)
+
+    def format_summary(self) -> str:
+        """
+        Returns:
+            str: A small table with the p50 and p95 of every metric.
+        """
+        with self._lock:
+            requests = list(self.requests)
+        if not requests:
+            return 'No requests yet.'
+        rows = [
+            ('Connect (s)', [r.connect_seconds for r in requests], '.3f'),
+            ('First token (s)', [r.first_token_seconds for r in requests], '.3f'),
+            ('Latency (s)', [r.total_seconds for r in requests], '.3f'),
+            ('Tokens/s', [r.tokens_per_second for r in requests], '.1f'),
+            ('Prompt tokens', [r.prompt_tokens for r in requests], '.0f'),
+            ('Completion tokens', [r.completion_tokens for r in requests], '.0f'),
+        ]
+        lines = [f'Requests: {len(requests)}', f'{"":<18}{"p50":>10}{"p95":>10}']
+        for name, values, number_format in rows:
+            lines.append(f'{name:<18}{percentile(values, 0.5):>10{number_format}}{percentile(values, 0.95):>10{number_format}}')
+        return '\n'.join(lines)
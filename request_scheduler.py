@@ -0,0 +1,333 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+import email.utils
+import concurrent.futures
+from collections.abc import Callable, Awaitable
+from typing import Optional
+import openai
+
+# Scheduler settings, each overridable through the environment variable of the same name.
+# A limit of 0 means no limit; a hedge delay of 0 disables hedging.
+OPENAI_RPM_LIMIT = int(os.environ.get('OPENAI_RPM_LIMIT', 0))
+OPENAI_TPM_LIMIT = int(os.environ.get('OPENAI_TPM_LIMIT', 0))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 6))
+OPENAI_HEDGE_AFTER = float(os.environ.get('OPENAI_HEDGE_AFTER', 0))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `per_minute` tokens per minute, holding at most that many.
+
+    Reservations may take the level below zero; the caller then waits until the
+    bucket has refilled to zero. Concurrent callers thus queue up one after the other
+    instead of all retrying at once.
+    """
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes tokens from the bucket.
+
+        Args:
+            amount (float): The number of tokens to take.
+
+        Returns:
+            float: The number of seconds to wait before using them.
+        """
+        if self.capacity <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def try_reserve(self, amount: float) -> bool:
+        """
+        Takes tokens from the bucket only if they can be used right away.
+
+        Returns:
+            bool: Whether the tokens were taken.
+        """
+        if self.capacity <= 0:
+            return True
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.level < amount:
+            return False
+        self.level -= amount
+        return True
+
+    def give_back(self, amount: float):
+        """Returns tokens that were reserved but not used, or takes more if amount is negative."""
+        if self.capacity > 0:
+            self.level = min(self.capacity, self.level + amount)
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Returns:
+        bool: Whether the request that raised the error may succeed when sent again.
+    """
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Reads the delay the server asked for in the Retry-After (or retry-after-ms) header.
+
+    Returns:
+        float: The delay in seconds, or None if the server did not ask for one.
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            value = headers['retry-after']
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def _get_usage_tokens(result) -> Optional[int]:
+    usage = getattr(result, 'usage', None)
+    return getattr(usage, 'total_tokens', None)
+
+
+class RequestScheduler:
+    """
+    Sends API requests within requests-per-minute and tokens-per-minute limits and
+    retries the ones that fail with a transient error.
+
+    Every request first reserves one request and its estimated tokens in the RPM and
+    TPM token buckets, waiting if the quota is used up; the token reservation is
+    corrected once the response reports its usage. Failed requests are retried with
+    full-jitter exponential backoff, or after the delay given by Retry-After. With
+    `hedge_after` set, a request that has not finished after that many seconds is sent
+    a second time and whichever copy finishes first is used, trading tokens for a
+    shorter tail latency. The second copy is only sent if the quota has room for it
+    right away; the other copy is left to finish and its tokens are counted in
+    `hedged_tokens` and passed to the `on_hedge_usage` callback of the request.
+
+    The scheduler is shared by threads and event loops.
+    """
+    def __init__(self, rpm=OPENAI_RPM_LIMIT, tpm=OPENAI_TPM_LIMIT, max_retries=OPENAI_MAX_RETRIES,
+                 hedge_after=OPENAI_HEDGE_AFTER):
+        """
+        Args:
+            rpm (int): Requests allowed per minute, or 0 for no limit.
+            tpm (int): Tokens allowed per minute, or 0 for no limit.
+            max_retries (int): How many times a failed request is sent again.
+            hedge_after (float): Seconds after which a slow request is hedged, or 0 to never hedge.
+        """
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.retries = 0
+        self.hedges = 0
+        # Tokens used by the copies of hedged requests that were not used
+        self.hedged_tokens = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        with self._lock:
+            return max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+
+    def _settle(self, estimated_tokens: int, result):
+        used_tokens = _get_usage_tokens(result)
+        if used_tokens is not None:
+            with self._lock:
+                self.tokens.give_back(estimated_tokens - used_tokens)
+
+    def _try_reserve(self, estimated_tokens: int) -> bool:
+        with self._lock:
+            if not self.requests.try_reserve(1):
+                return False
+            if not self.tokens.try_reserve(estimated_tokens):
+                self.requests.give_back(1)
+                return False
+            self.hedges += 1
+            return True
+
+    def _finish_hedge(self, future, estimated_tokens: int, on_hedge_usage: Optional[Callable]):
+        """
+        Accounts for the copy of a hedged request that was not used, once it is done.
+        Works with both concurrent.futures and asyncio futures.
+        """
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                with self._lock:
+                    self.tokens.give_back(estimated_tokens)
+                return
+            used_tokens = _get_usage_tokens(future.result())
+            if used_tokens is None:
+                return
+            with self._lock:
+                self.tokens.give_back(estimated_tokens - used_tokens)
+                self.hedged_tokens += used_tokens
+            if on_hedge_usage is not None:
+                on_hedge_usage(used_tokens)
+
+        future.add_done_callback(done)
+
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        with self._lock:
+            self.retries += 1
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)
+        return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+    def _call_hedged(self, request: Callable, hedge: bool, estimated_tokens: int, on_hedge_usage: Optional[Callable]):
+        if not hedge or self.hedge_after <= 0:
+            return request()
+        futures = []
+
+        def send():
+            future = concurrent.futures.Future()
+
+            def run():
+                try:
+                    future.set_result(request())
+                except BaseException as e:
+                    future.set_exception(e)
+
+            # Run in a copy of the context, so that the request metrics see the connection
+            threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+            futures.append(future)
+
+        send()
+        done, _ = concurrent.futures.wait(futures, timeout=self.hedge_after)
+        if not done and self._try_reserve(estimated_tokens):
+            send()
+        for finished, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            # A failed copy only counts if the other one failed too
+            if future.exception() is None or finished == len(futures):
+                for other in futures:
+                    if other is not future:
+                        self._finish_hedge(other, estimated_tokens, on_hedge_usage)
+                return future.result()
+
+    def call(self, request: Callable, estimated_tokens=0, hedge=True, on_hedge_usage=None):
+        """
+        Sends a request through the scheduler.
+
+        Args:
+            request (Callable): Sends the request and returns its result. May be called
+                several times.
+            estimated_tokens (int): The tokens the request is expected to use.
+            hedge (bool): Whether the request may be hedged. Streamed requests should not be.
+            on_hedge_usage (Callable): Called with the tokens used by the copy of a hedged
+                request that was not used, from the thread it finishes on, or None.
+
+        Returns:
+            The result of the request.
+        """
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._reserve(estimated_tokens))
+            try:
+                result = self._call_hedged(request, hedge, estimated_tokens, on_hedge_usage)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                time.sleep(self._backoff(e, attempt))
+                continue
+            self._settle(estimated_tokens, result)
+            return result
+
+    async def _call_hedged_async(self, request: Callable[[], Awaitable], hedge: bool, estimated_tokens: int,
+                                 on_hedge_usage: Optional[Callable]):
+        if not hedge or self.hedge_after <= 0:
+            return await request()
+        tasks = [asyncio.ensure_future(request())]
+        done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+        if not done and self._try_reserve(estimated_tokens):
+            tasks.append(asyncio.ensure_future(request()))
+        used = None
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None or not pending:
+                        used = task
+                        return task.result()
+        finally:
+            for task in tasks:
+                if used is None:
+                    # Cancelled, e.g. because the client went away
+                    task.cancel()
+                elif task is not used:
+                    self._finish_hedge(task, estimated_tokens, on_hedge_usage)
+
+    async def call_async(self, request: Callable[[], Awaitable], estimated_tokens=0, hedge=True, on_hedge_usage=None):
+        """
+        Same as call, for a request that returns an awaitable. Waiting does not block the event loop.
+        """
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._reserve(estimated_tokens))
+            try:
+                result = await self._call_hedged_async(request, hedge, estimated_tokens, on_hedge_usage)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                await asyncio.sleep(self._backoff(e, attempt))
+                continue
+            self._settle(estimated_tokens, result)
+            return result
+
+
+_scheduler: Optional[RequestScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """
+    Returns:
+        RequestScheduler: The scheduler shared by all requests of the process.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def configure(**settings) -> RequestScheduler:
+    """
+    Replaces the shared scheduler by one with the given settings.
+
+    Args:
+        **settings: Keyword arguments of RequestScheduler; the others keep their defaults.
+
+    Returns:
+        RequestScheduler: The new shared scheduler.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = RequestScheduler(**settings)
+        return _scheduler
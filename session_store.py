@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import tempfile
+import threading
+import contextlib
+from pathlib import Path
+from typing import Optional
+
+SESSIONS_DIRECTORY = Path.home() / '.chatgpt' / 'sessions'
+TITLE_LENGTH = 60
+
+
+def _read_lines_reversed(path: Path, block_size=64 * 1024):
+    """
+    Yields the non-empty lines of a file from the last to the first, reading it in
+    blocks from the end so that only the lines consumed are ever read.
+
+    Args:
+        path (Path): The file to read.
+        block_size (int): The number of bytes read at a time.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        rest = b''
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + rest).split(b'\n')
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line
+        if rest.strip():
+            yield rest
+
+
+class SessionLog:
+    """
+    The append-only log of one chat session, `<id>.jsonl` in the sessions directory.
+
+    Every message is a record with its role, content and token cost, so a resumed
+    session does not need to tokenize its history again. A reset record, holding the
+    new system message and its token cost, is written whenever the context is cleared
+    or the system message changes; the messages after the last reset are the context.
+    """
+    def __init__(self, store: 'SessionStore', session_id: str, entry: dict):
+        self.store = store
+        self.session_id = session_id
+        self.entry = entry
+        self.path = store.directory / f'{session_id}.jsonl'
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_empty(self) -> bool:
+        """Whether nothing has been written to the log yet."""
+        return not self.path.exists() or self.path.stat().st_size == 0
+
+    def _write(self, record: dict):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def append(self, role: str, content: str, tokens: int):
+        """
+        Records a message of the chat context.
+
+        Args:
+            role (str): The role of the message author.
+            content (str): The message content.
+            tokens (int): The token cost of the message.
+        """
+        self._write({'role': role, 'content': content, 'tokens': tokens})
+        if role == 'user' and not self.entry.get('title'):
+            self.entry = self.store.update(self.session_id, **dict(self.entry, title=content))
+
+    def reset(self, system_message: str, tokens: int):
+        """
+        Records that the context was cleared, keeping only the given system message.
+
+        Args:
+            system_message (str): The new system message, or an empty string for none.
+            tokens (int): The token cost of the system message.
+        """
+        self._write({'event': 'reset', 'system': system_message, 'tokens': tokens})
+        self.entry = self.store.update(self.session_id, **dict(self.entry, system=system_message, system_tokens=tokens))
+
+    def load_tail(self, budget: int):
+        """
+        Loads the most recent messages of the context that fit the token budget.
+
+        The log is read backwards and only until the budget is used up or the last
+        reset is reached, so resuming takes the same time however long the session is.
+        The loaded messages start with a user message, so that question/answer pairs
+        stay together.
+
+        Args:
+            budget (int): The number of tokens the messages may use, system message included.
+
+        Returns:
+            tuple: The system message, its token cost, and the list of messages as dicts
+            with role, content and tokens.
+        """
+        system_message = self.entry.get('system', '')
+        system_tokens = self.entry.get('system_tokens', 0)
+        messages = []
+        used = system_tokens
+        if not self.is_empty:
+            for line in _read_lines_reversed(self.path):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash
+                    continue
+                if record.get('event') == 'reset':
+                    system_message, system_tokens = record['system'], record['tokens']
+                    break
+                if used + record['tokens'] > budget:
+                    break
+                used += record['tokens']
+                messages.append(record)
+        messages.reverse()
+        while messages and messages[0]['role'] != 'user':
+            messages.pop(0)
+        return system_message, system_tokens, messages
+
+    def load_context(self) -> list:
+        """
+        Loads all the messages of the context, reading the log backwards to the last reset.
+        Unlike load_tail, this takes time in proportion to the length of the context.
+
+        Returns:
+            list: The messages as dicts with role, content and tokens, oldest first.
+        """
+        messages = []
+        if not self.is_empty:
+            for line in _read_lines_reversed(self.path):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get('event') == 'reset':
+                    break
+                messages.append(record)
+        messages.reverse()
+        return messages
+
+    def close(self):
+        """Closes the log file and records the time of the last update in the index."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        self.store.update(self.session_id)
+
+
+class SessionStore:
+    """
+    The saved chat sessions, one SessionLog per session plus an index.json that lists
+    them with their model, title and current system message.
+
+    Many chat.py processes and the chat daemon update the index at the same time, so
+    every update holds a lock on index.lock and replaces the index atomically.
+    """
+    def __init__(self, directory: Path = SESSIONS_DIRECTORY):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = directory / 'index.json'
+        self.lock_path = directory / 'index.lock'
+        self._lock = threading.Lock()
+
+    def _read_index(self, strict=False) -> dict:
+        """
+        Args:
+            strict (bool): Raise ValueError if the index cannot be parsed, instead of
+                returning an empty one.
+        """
+        try:
+            return json.loads(self.index_path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            if strict:
+                raise ValueError(f'{self.index_path} cannot be parsed')
+            return {}
+
+    def _write_index(self, index: dict):
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix='index.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_name, self.index_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_name)
+            raise
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Holds the index lock of this process and of all the others."""
+        with self._lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """
+        Returns:
+            dict: The index entry of the session, or None if there is no such session.
+        """
+        return self._read_index().get(session_id)
+
+    def update(self, session_id: str, **fields) -> dict:
+        """
+        Updates the index entry of a session and its time of the last update.
+
+        Args:
+            session_id (str): The session id.
+            **fields: The fields to set.
+
+        Returns:
+            dict: The updated entry.
+        """
+        if 'title' in fields:
+            fields['title'] = ' '.join(fields['title'].split())[:TITLE_LENGTH]
+        with self._locked():
+            try:
+                index = self._read_index(strict=True)
+            except ValueError:
+                # Writing it back would lose every other session; leave it for the user to repair
+                return dict(fields, updated=time.time())
+            entry = index.setdefault(session_id, {})
+            entry.update(fields, updated=time.time())
+            self._write_index(index)
+        return entry
+
+    def create(self, model: str) -> SessionLog:
+        """
+        Starts a new session. It is added to the index once something is written to it.
+
+        Args:
+            model (str): The chat model of the session.
+
+        Returns:
+            SessionLog: The log of the new session.
+        """
+        session_id = uuid.uuid4().hex[:8]
+        return SessionLog(self, session_id, {'model': model, 'created': time.time()})
+
+    def open(self, session_id: str) -> SessionLog:
+        """
+        Opens a saved session to resume it.
+
+        Args:
+            session_id (str): The session id.
+
+        Returns:
+            SessionLog: The log of the session.
+
+        Raises:
+            KeyError: If there is no such session.
+        """
+        entry = self.get(session_id)
+        if entry is None:
+            raise KeyError(session_id)
+        return SessionLog(self, session_id, entry)
+
+    def list_sessions(self) -> list:
+        """
+        Returns:
+            list: (session id, index entry) pairs, most recently updated first.
+        """
+        index = self._read_index()
+        return sorted(index.items(), key=lambda item: item[1].get('updated', 0), reverse=True)
@@ -1,8 +1,102 @@
 import os
+import json
+import uuid
+import queue
+import atexit
 import datetime
+import threading
+
+
+class _LogWriter:
+    """
+    Background thread that appends queued log records to a JSON Lines file in batches.
+
+    There is one writer per log file, shared by all the loggers writing to it. Callers
+    only put records on a queue, so logging never waits for the disk.
+    """
+    flush_interval = 1.0
+    max_bytes = 10 * 1024 * 1024
+    backup_count = 3
+
+    _writers: dict = {}
+    _writers_lock = threading.Lock()
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def get(cls, filename: str) -> '_LogWriter':
+        with cls._writers_lock:
+            writer = cls._writers.get(filename)
+            if writer is None:
+                writer = cls._writers[filename] = cls(filename)
+            return writer
+
+    def put(self, record: dict):
+        self.queue.put(record)
+
+    def close(self):
+        """Writes the queued records and stops the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _rotate(self):
+        for index in range(self.backup_count - 1, 0, -1):
+            older = f'{self.filename}.{index}'
+            if os.path.exists(older):
+                os.replace(older, f'{self.filename}.{index + 1}')
+        os.replace(self.filename, f'{self.filename}.1')
+
+    def _write(self, records: list):
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) >= self.max_bytes:
+            self._rotate()
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            records = []
+            while True:
+                if record is None:
+                    stopping = True
+                else:
+                    records.append(record)
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if records:
+                try:
+                    self._write(records)
+                except OSError:
+                    # Losing log records is better than breaking the chat
+                    pass
+
 
 class SimpleLogger:
-    logfilename = '.chatgpt.log'
+    """
+    Logs prompts, answers and errors of a chat session as JSON Lines.
+
+    Every record has the time, the session id, the remote SSH address, the event type
+    and the text, plus any extra fields such as latency and token counts. Records are
+    written by a background thread, which flushes them when the program exits.
+    """
+    logfilename = '.chatgpt.jsonl'
+
+    def __init__(self, session_id: str = ''):
+        self.session_id = session_id or uuid.uuid4().hex[:12]
+        self.remote_ip = SimpleLogger._get_ssh_remote_ip()
+        self._writer = _LogWriter.get(SimpleLogger.logfilename)
 
     @staticmethod
     def _get_ssh_remote_ip():
@@ -15,22 +109,33 @@ class SimpleLogger:
 
     @staticmethod
     def _get_timestamp():
-        now = datetime.datetime.now()
-        formatted_timestamp = now.strftime("%Y-%m-%d %H:%M")
-        return formatted_timestamp
+        return datetime.datetime.now().isoformat(timespec='milliseconds')
 
-    @staticmethod
-    def log_answer(answer_text: str):
-        with open(SimpleLogger.logfilename, 'a') as f:
-            name = 'ChatGPT'
-            f.write(f'{name:>15} {SimpleLogger._get_timestamp()}: {answer_text}\n')
+    def _log(self, event: str, text: str, fields: dict):
+        record = {
+            'time': SimpleLogger._get_timestamp(),
+            'session': self.session_id,
+            'remote_ip': self.remote_ip,
+            'event': event,
+            'text': text,
+        }
+        record.update(fields)
+        self._writer.put(record)
 
-    @staticmethod
-    def log_prompt(user_text: str):
-        with open(SimpleLogger.logfilename, 'a') as f:
-            f.write(f'{SimpleLogger._get_ssh_remote_ip():>15} {SimpleLogger._get_timestamp()}: {user_text}\n')
+    def log_answer(self, answer_text: str, **fields):
+        """
+        Logs an answer. Extra keyword arguments, e.g. latency and token counts, are added to the record.
+        """
+        self._log('answer', answer_text, fields)
 
-    @staticmethod
-    def log_error(error_text: str):
-        with open(SimpleLogger.logfilename, 'a') as f:
-            f.write(f'Got Exception: {SimpleLogger._get_timestamp()}: {error_text}\n')
+    def log_prompt(self, user_text: str, **fields):
+        """
+        Logs a prompt. Extra keyword arguments are added to the record.
+        """
+        self._log('prompt', user_text, fields)
+
+    def log_error(self, error_text: str, **fields):
+        """
+        Logs an error. Extra keyword arguments are added to the record.
+        """
+        self._log('error', error_text, fields)
@@ -0,0 +1,104 @@
+import time
+from rich.console import Console
+from rich.live import Live
+from rich.markdown import Markdown
+
+FENCE_MARKS = ('```', '~~~')
+
+
+def scan_blocks(text: str, pos=0, in_fence=False):
+    """
+    Scans the complete lines of markdown text for the end of the last finished block.
+
+    A block is finished once it is followed by a blank line outside of a code fence,
+    or once its code fence is closed. Scanning can be resumed where a previous scan of
+    the same, since grown, text stopped.
+
+    Args:
+        text (str): Markdown text that starts outside of any block.
+        pos (int): The position to resume scanning from, at the start of a line.
+        in_fence (bool): Whether pos is inside a code fence.
+
+    Returns:
+        tuple: The end of the finished part of the text (0 if no block was finished
+        after pos), the position after the last complete line, and whether that
+        position is inside a code fence.
+    """
+    frozen = 0
+    while True:
+        newline = text.find('\n', pos)
+        if newline < 0:
+            return frozen, pos, in_fence
+        line = text[pos:newline].strip()
+        pos = newline + 1
+        if line.startswith(FENCE_MARKS):
+            in_fence = not in_fence
+            if not in_fence:
+                frozen = pos
+        elif not line and not in_fence:
+            frozen = pos
+
+
+class StreamingMarkdownRenderer:
+    """
+    Renders a markdown answer that arrives in small deltas.
+
+    Finished blocks are printed once and never parsed again; only the trailing open
+    block is re-parsed and shown in a Live display, at most refresh_per_second times
+    per second. Deltas are collected in a list and joined only when a line is complete,
+    so the cost of a long answer stays linear in its length.
+
+    Use it as a context manager and call feed for every delta.
+    """
+    def __init__(self, console: Console, refresh_per_second=8):
+        self.console = console
+        self.refresh_interval = 1 / refresh_per_second
+        self.live = Live("[bold green]Asking...", console=console, auto_refresh=False, transient=True)
+        self._tail = ''
+        self._deltas = []
+        self._scan_pos = 0
+        self._in_fence = False
+        self._last_render = 0.0
+
+    def __enter__(self):
+        self.live.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+
+    @staticmethod
+    def _markdown(text: str) -> Markdown:
+        return Markdown(text, inline_code_lexer="auto", inline_code_theme="monokai")
+
+    def feed(self, delta: str):
+        """
+        Adds a delta of the answer.
+
+        Args:
+            delta (str): The next piece of the answer text.
+        """
+        self._deltas.append(delta)
+        if '\n' in delta:
+            self._tail += ''.join(self._deltas)
+            self._deltas.clear()
+            frozen, self._scan_pos, self._in_fence = scan_blocks(self._tail, self._scan_pos, self._in_fence)
+            if frozen:
+                self.live.console.print(self._markdown(self._tail[:frozen]))
+                self._tail = self._tail[frozen:]
+                self._scan_pos -= frozen
+        now = time.monotonic()
+        if now - self._last_render >= self.refresh_interval:
+            self._last_render = now
+            self.live.update(self._markdown(self._tail + ''.join(self._deltas)), refresh=True)
+
+    def finish(self):
+        """Stops the live display and prints the last block."""
+        if not self.live.is_started:
+            return
+        self._tail += ''.join(self._deltas)
+        self._deltas.clear()
+        self.live.stop()
+        if self._tail.strip():
+            self.console.print(self._markdown(self._tail))
+        self._tail = ''
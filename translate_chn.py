@@ -1,38 +1,126 @@
+import os
+import json
+import mmap
 import time
+import bisect
 import argparse
+import functools
+import contextlib
+from itertools import accumulate
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 import openai
 import tiktoken
-from conf import set_openapi_conf
+import client_pool
+import endpoint_router
+import request_scheduler
+from conf import set_openapi_conf, get_model_name
+from disk_cache import DiskCache, DEFAULT_CACHE_DIRECTORY, make_cache_key
+from metrics import MetricsRecorder, RequestMetrics
+from translation_manifest import TranslationManifest
 
 AVERAGE_CHARS_PER_TOKEN = 6
 MODEL_NAME = "gpt-3.5-turbo"
+PROMPT_TEMPLATE = '将下面的文字翻译成简体中文\n"""{text}\n"""'
+TRANSLATION_CACHE_FILENAME = DEFAULT_CACHE_DIRECTORY / 'translation-cache.sqlite3'
+# In streaming mode, at most this many bytes of the source are tokenized at a time.
+STREAM_WINDOW_BYTES = 1024 * 1024
+# Chunks are cut after one of these, preferring whichever comes last within the token limit.
+SENTENCE_END_BYTES = (b'.', b'!', b'?', b'\n')
+# The source is tokenized in segments of about this many bytes, in parallel.
+TOKENIZE_SEGMENT_BYTES = 1024 * 1024
+PRICE_PER_1K_TOKENS = 0.002
+# Estimates used by --plan until translated chunks give observed values: output tokens
+# per source token, and seconds per source token of a request.
+OUTPUT_TOKEN_RATIO = 1.0
+SECONDS_PER_TOKEN = 0.03
 
-def translate_text(user_text: str, temperature: float):
+class Chunk(NamedTuple):
+    """A chunk of the source, as a byte range of its UTF-8 encoding."""
+    start: int
+    end: int
+    tokens: int
+
+def build_translation_request(user_text: str, temperature: float) -> dict:
+    """
+    Build the chat completion request that translates the given text.
+
+    :param user_text: Text to be translated.
+    :param temperature: Controls the randomness of the AI's response.
+    :return: Keyword arguments of the chat completion request.
+    """
+
+    return {
+        'model': MODEL_NAME,
+        'messages': [
+            {
+                'role': "user",
+                "content": PROMPT_TEMPLATE.format(text=user_text)
+            }
+        ],
+        'temperature': temperature,
+    }
+
+def translate_text(user_text: str, temperature: float, request_metrics=None, estimated_tokens=None):
     """
     Request translation of the given text using OpenAI API.
 
+    The request goes through the shared request scheduler, which keeps to the rate
+    limits and retries transient errors, and to the best endpoint if several are configured.
+
     :param user_text: Text to be translated.
     :param temperature: Controls the randomness of the AI's response.
+    :param request_metrics: RequestMetrics to record the timing and tokens of the request in, or None.
+    :param estimated_tokens: Tokens the request is expected to use, for the tokens-per-minute limit.
+        Defaults to an estimate from the length of the text.
     :return: Tuple containing the translated text and the number of tokens used in the API call.
     """
 
-    response = openai.ChatCompletion.create(
-      model = MODEL_NAME,
-      messages = [
-        {
-            'role': "user",
-            "content": f'将下面的文字翻译成简体中文\n"""{user_text}\n"""'
-        }
-      ],
-      request_timeout = 120,
-      timeout = 120,
-      temperature = temperature
-    )
+    if estimated_tokens is None:
+        # The translation is about as long as the text itself
+        estimated_tokens = 2 * len(user_text) // AVERAGE_CHARS_PER_TOKEN
+    request = build_translation_request(user_text, temperature)
+    router = endpoint_router.get_router()
+    if router is None:
+        def send():
+            return client_pool.get_client().chat.completions.create(**dict(request, model=get_model_name(request['model'])))
+    else:
+        def send():
+            return router.call(lambda endpoint: endpoint.get_client().chat.completions.create(
+                **dict(request, model=endpoint.get_model(request['model']))))
+    request_metrics = request_metrics or RequestMetrics()
+    with request_metrics.tracking_connection():
+        response = request_scheduler.get_scheduler().call(send, estimated_tokens=estimated_tokens)
     response_text:str = response.choices[0].message.content # type: ignore
     total_tokens:int = response.usage.total_tokens # type: ignore
+    request_metrics.finish(response.usage.prompt_tokens, response.usage.completion_tokens) # type: ignore
     return response_text, total_tokens
 
+def get_translation_cache_key(user_text: str, temperature: float) -> str:
+    """
+    Build the translation cache key of a chunk.
+
+    The text is normalized by collapsing whitespace, so that reflowed copies of the
+    same text share their translation.
+
+    :param user_text: Text to be translated.
+    :param temperature: Controls the randomness of the AI's response.
+    :return: Cache key.
+    """
+
+    return make_cache_key(' '.join(user_text.split()), MODEL_NAME, PROMPT_TEMPLATE, temperature)
+
+@functools.lru_cache(maxsize=None)
+def get_encoding() -> tiktoken.Encoding:
+    """
+    Load the tokenizer once.
+
+    :return: The cl100k_base encoding.
+    """
+
+    return tiktoken.get_encoding("cl100k_base")
+
 def get_tokens(text: str) -> int:
     """
     Calculate the number of tokens in the given text.
@@ -41,36 +129,362 @@ def get_tokens(text: str) -> int:
     :return: Number of tokens in the text.
     """
 
-    token_encoding = tiktoken.get_encoding("cl100k_base")
-    return len(token_encoding.encode(text))
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+def get_token_ends(data: bytes) -> list:
+    """
+    Tokenize UTF-8 encoded text once and map every token to the byte offset where it ends.
+
+    :param data: UTF-8 encoded text.
+    :return: List of the end offsets, one per token, in increasing order.
+    """
+
+    encoding = get_encoding()
+    tokens = encoding.encode(data.decode('utf-8'), disallowed_special=())
+    return list(accumulate(map(len, encoding.decode_tokens_bytes(tokens))))
+
+def get_token_ends_parallel(data, segment_bytes=TOKENIZE_SEGMENT_BYTES) -> list:
+    """
+    Like get_token_ends, but tokenize segments of the text in parallel with tiktoken's batch encoding.
+
+    Segments end at line breaks where possible, where the tokenizer splits anyway, so
+    the result matches tokenizing the text in one piece for all practical purposes.
+
+    :param data: UTF-8 encoded text, as bytes or mmap.mmap.
+    :param segment_bytes: Approximate size of a segment.
+    :return: List of the end offsets, one per token, in increasing order.
+    """
+
+    bounds = []
+    start = 0
+    while start < len(data):
+        end = min(len(data), start + segment_bytes)
+        if end < len(data):
+            line_end = data.rfind(b'\n', start, end)
+            if line_end > start:
+                end = line_end + 1
+            else:
+                while end > start + 1 and data[end] & 0xC0 == 0x80:
+                    end -= 1
+        bounds.append((start, end))
+        start = end
+    encoding = get_encoding()
+    segments = [data[start:end].decode('utf-8') for start, end in bounds]
+    token_lists = encoding.encode_batch(segments, num_threads=os.cpu_count() or 1, disallowed_special=())
+    token_ends = []
+    for (start, _), tokens in zip(bounds, token_lists):
+        token_ends.extend(start + end for end in accumulate(map(len, encoding.decode_tokens_bytes(tokens))))
+    return token_ends
+
+def find_cut_point(data: bytes, start: int, limit: int) -> int:
+    """
+    Find where to end a chunk that starts at `start` and may not extend past `limit`.
+
+    The chunk ends after the last sentence end or line break in the range, else after
+    the last space, else at `limit` moved back to a UTF-8 character boundary.
+
+    :param data: UTF-8 encoded text.
+    :param start: Byte offset of the chunk start.
+    :param limit: Byte offset the chunk may not extend past.
+    :return: Byte offset of the chunk end.
+    """
+
+    cut = max(data.rfind(mark, start, limit) for mark in SENTENCE_END_BYTES)
+    if cut < start:
+        cut = data.rfind(b' ', start, limit)
+    if cut >= start:
+        return cut + 1
+    while limit > start + 1 and limit < len(data) and data[limit] & 0xC0 == 0x80:
+        limit -= 1
+    return limit
+
+def cut_chunk(data: bytes, token_ends: list, start: int, first_token: int, max_tokens: int, at_end_of_text=True):
+    """
+    Cut the chunk starting at byte `start`, whose first token is `first_token`.
+
+    A token that straddles the cut is counted in both chunks, so the token counts
+    never underestimate a chunk.
+
+    :param data: UTF-8 encoded text.
+    :param token_ends: End offsets of the tokens of `data`, as returned by get_token_ends.
+    :param start: Byte offset of the chunk start.
+    :param first_token: Index of the token containing `start`.
+    :param max_tokens: Maximum number of tokens allowed for the chunk.
+    :param at_end_of_text: Whether `data` ends where the text ends, so that its tail may form the last chunk.
+    :return: Tuple containing the chunk end offset, its number of tokens and the index of the next chunk's first token.
+    """
+
+    last_token = first_token + max_tokens
+    if last_token >= len(token_ends):
+        if at_end_of_text:
+            return len(data), len(token_ends) - first_token, len(token_ends)
+        limit = len(data)
+    else:
+        limit = token_ends[last_token - 1]
+    end = find_cut_point(data, start, limit)
+    last = bisect.bisect_left(token_ends, end, lo=first_token)
+    next_token = last + 1 if token_ends[last] == end else last
+    return end, last - first_token + 1, next_token
+
+def plan_chunks(data: bytes, max_tokens=1365, token_ends=None) -> list:
+    """
+    Split the text into chunks of at most `max_tokens` tokens in a single pass.
+
+    The text is tokenized once and the cut points are found from the token offsets,
+    so the cost is linear in the size of the text. Chunks that hold only whitespace
+    are left out.
+
+    :param data: UTF-8 encoded text to be translated.
+    :param max_tokens: Maximum number of tokens allowed for a chunk.
+    :param token_ends: Token end offsets of `data` if already known, see get_token_ends.
+    :return: List of Chunk.
+    """
+
+    if token_ends is None:
+        token_ends = get_token_ends(data)
+    chunks = []
+    start = 0
+    first_token = 0
+    while start < len(data):
+        end, tokens, first_token = cut_chunk(data, token_ends, start, first_token, max_tokens)
+        if data[start:end].strip():
+            chunks.append(Chunk(start, end, tokens))
+        start = end
+    return chunks
+
+def plan_chunks_parallel(data, max_tokens=1365) -> list:
+    """
+    Split the text into chunks like plan_chunks, tokenizing it on all cores.
+
+    :param data: UTF-8 encoded text to be translated, as bytes or mmap.mmap.
+    :param max_tokens: Maximum number of tokens allowed for a chunk.
+    :return: List of Chunk.
+    """
+
+    return plan_chunks(data, max_tokens, get_token_ends_parallel(data))
+
+def iter_chunks_streaming(data, max_tokens=1365, window_bytes=STREAM_WINDOW_BYTES):
+    """
+    Yield the chunks of the text one by one, tokenizing a bounded window at a time.
+
+    This gives the same kind of chunks as plan_chunks, but only about `window_bytes`
+    of the text are held as a copy at any time, so `data` can be a memory-mapped file
+    of any size. A chunk is only cut once its whole token limit lies inside the window;
+    the remainder is tokenized again as the start of the next window. Windows never end
+    in the middle of a UTF-8 character.
+
+    :param data: UTF-8 encoded text, e.g. an mmap.mmap of the source file.
+    :param max_tokens: Maximum number of tokens allowed for a chunk.
+    :param window_bytes: Number of bytes tokenized at a time.
+    :return: Generator of Chunk.
+    """
+
+    start = 0
+    window_bytes = max(window_bytes, max_tokens * AVERAGE_CHARS_PER_TOKEN * 4)
+    while start < len(data):
+        window_end = min(len(data), start + window_bytes)
+        while window_end < len(data) and data[window_end] & 0xC0 == 0x80:
+            window_end -= 1
+        window = data[start:window_end]
+        at_end_of_text = window_end == len(data)
+        token_ends = get_token_ends(window)
+        if not at_end_of_text and len(token_ends) <= max_tokens:
+            # Not even one full chunk in the window: look further ahead
+            window_bytes *= 2
+            continue
+        offset = 0
+        first_token = 0
+        while offset < len(window) and (at_end_of_text or first_token + max_tokens < len(token_ends)):
+            end, tokens, first_token = cut_chunk(window, token_ends, offset, first_token, max_tokens, at_end_of_text)
+            if window[offset:end].strip():
+                yield Chunk(start + offset, start + end, tokens)
+            offset = end
+        start += offset
+
+def get_planner(stream: bool):
+    """
+    Choose how to plan the chunks of a source.
+
+    :param stream: Whether the source is memory-mapped and must be chunked with bounded memory.
+    :return: plan_chunks_streaming or plan_chunks_parallel.
+    """
+
+    return plan_chunks_streaming if stream else plan_chunks_parallel
+
+def plan_chunks_streaming(data, max_tokens=1365) -> list:
+    """
+    Split the text into chunks like plan_chunks, with the bounded memory of iter_chunks_streaming.
+
+    :param data: UTF-8 encoded text, e.g. an mmap.mmap of the source file.
+    :param max_tokens: Maximum number of tokens allowed for a chunk.
+    :return: List of Chunk.
+    """
+
+    return list(iter_chunks_streaming(data, max_tokens))
+
+def open_manifest(output_filename: str, data, max_tokens: int, stream: bool) -> TranslationManifest:
+    """
+    Open the manifest of an output file, telling where an output it did not track was moved to.
+
+    :param output_filename: Path of the translated output.
+    :param data: UTF-8 encoded source text.
+    :param max_tokens: Maximum number of tokens allowed for a chunk.
+    :param stream: Whether the source is memory-mapped.
+    :return: TranslationManifest.
+    """
+
+    manifest = TranslationManifest.open(output_filename, data, max_tokens, get_planner(stream))
+    if manifest.backup_path is not None:
+        print(f'{output_filename} was not written by a resumable run, it was moved to {manifest.backup_path}')
+    return manifest
+
+@contextlib.contextmanager
+def open_source(filename: str, stream=False):
+    """
+    Open the source text as bytes, either read into memory or memory-mapped.
+
+    :param filename: Path to the source text file.
+    :param stream: Whether to memory-map the file instead of reading it.
+    :return: Context manager giving the UTF-8 encoded text as bytes or mmap.mmap.
+    """
+
+    if not stream:
+        yield Path(filename).read_bytes()
+        return
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be memory-mapped
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
 
 def get_next_chunk(text: str, start_pos: int, max_tokens=1365):
     """
     Find the next chunk of text to translate based on the starting position and maximum tokens allowed.
 
+    Only a window of the text after `start_pos` is tokenized. Use plan_chunks to split a whole text.
+
     :param text: Full text to be translated.
     :param start_pos: Starting position for the next chunk.
     :param max_tokens: Maximum number of tokens allowed for the chunk.
     :return: Tuple containing the text chunk, end position, number of tokens, and a flag indicating if the end of the text is reached.
     """
 
-    sentence_split_punctuation = '.!?'
-    # Let's assume that each token has 6 character length on average
-    end_pos = min(len(text) - 1, start_pos + max_tokens * AVERAGE_CHARS_PER_TOKEN)
-    is_end_of_text = False
-    while True:
-        chunk_text = text[start_pos:end_pos+1]
-        tokens = get_tokens(chunk_text)
-        if tokens <= max_tokens:
-            if end_pos == len(text) - 1:
-                is_end_of_text = True
-            return chunk_text, end_pos + 1, tokens, is_end_of_text
-        # search backwards for a sentence
-        while end_pos > 0:
-            end_pos -= 1
-            c = text[end_pos]
-            if c in sentence_split_punctuation:
+    # A chunk is unlikely to be longer than twice the average number of characters per token
+    window_end = min(len(text), start_pos + max_tokens * AVERAGE_CHARS_PER_TOKEN * 2)
+    data = text[start_pos:window_end].encode('utf-8')
+    if not data:
+        return '', start_pos, 0, True
+    is_last_window = window_end == len(text)
+    end, tokens, _ = cut_chunk(data, get_token_ends(data), 0, 0, max_tokens, at_end_of_text=is_last_window)
+    chunk_text = data[:end].decode('utf-8')
+    end_pos = start_pos + len(chunk_text)
+    return chunk_text, end_pos, tokens, end_pos == len(text)
+
+def translate_chunk(chunk: dict, chunk_text: str, temperature: float, cache=None, metrics=None):
+    """
+    Translate one chunk and measure how long the request takes.
+
+    The translation cache is checked first; a cached translation costs no tokens.
+
+    :param chunk: The chunk, as recorded in the translation manifest.
+    :param chunk_text: Text of the chunk.
+    :param temperature: Controls the randomness of the AI's response.
+    :param cache: DiskCache of earlier translations, or None to always call the API.
+    :param metrics: MetricsRecorder to record the API request in, or None.
+    :return: Tuple containing the chunk, the translated text, the number of tokens used and the seconds taken.
+    """
+
+    start_time = time.time()
+    cache_key = get_translation_cache_key(chunk_text, temperature)
+    translated_text = cache.get(cache_key) if cache else None
+    if translated_text is not None:
+        return chunk, translated_text, 0, time.time() - start_time
+    request_metrics = RequestMetrics()
+    translated_text, total_tokens = translate_text(chunk_text, temperature, request_metrics, 2 * chunk['tokens'])
+    if metrics:
+        metrics.record(request_metrics)
+    if cache:
+        cache.put(cache_key, translated_text)
+    return chunk, translated_text, total_tokens, time.time() - start_time
+
+def run_translation(
+        data,
+        manifest: TranslationManifest,
+        output_chinese_filename: str,
+        selected_chunks: list,
+        temperature: float,
+        workers: int,
+        cache=None) -> None:
+    """
+    Translate the selected chunks of the manifest that are not done yet, then assemble the output.
+
+    :param data: UTF-8 encoded source text, as bytes or mmap.mmap.
+    :param manifest: Manifest of the translation job.
+    :param output_chinese_filename: Path to the output Simplified Chinese text file.
+    :param selected_chunks: Chunks of the manifest to be translated.
+    :param temperature: Controls the randomness of the AI's response.
+    :param workers: Number of chunk requests kept in flight.
+    :param cache: DiskCache of earlier translations, or None to always call the API.
+    """
+
+    # Skip the chunks translated by an earlier run
+    todo_chunks = [chunk for chunk in selected_chunks if not manifest.is_done(chunk)]
+    if len(todo_chunks) < len(selected_chunks):
+        print(f'Skipping {len(selected_chunks) - len(todo_chunks)} chunks translated by an earlier run')
+    chunks = iter(todo_chunks)
+
+    translated_chunks = 0
+    total_tokens_consumed = 0
+    metrics = MetricsRecorder()
+    pending = set()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            while len(pending) < workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                chunk_text = data[chunk['start']:chunk['end']].decode('utf-8')
+                print(f"Request to translate chunk: {chunk['no']}...", flush=True)
+                pending.add(executor.submit(translate_chunk, chunk, chunk_text, temperature, cache, metrics))
+            if not pending:
                 break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk, translated_text, total_tokens, seconds = future.result()
+                manifest.mark_done(chunk, translated_text, total_tokens, seconds)
+                total_tokens_consumed += total_tokens
+                translated_chunks += 1
+                print(f"Chunk {chunk['no']} Done...Takes {seconds:.2f} seconds")
+    except Exception as e:
+        print(f'Got Exception {e}')
+    except KeyboardInterrupt:
+        print('break')
+    else:
+        print('Translation completed.')
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        missing_chunks = manifest.assemble(output_chinese_filename)
+        if missing_chunks:
+            print(f'Stopped at chunk {missing_chunks[0]}, finished {translated_chunks} chunks, '
+                  f'{len(missing_chunks)} chunks are not translated yet')
+        else:
+            print(f'Finished {translated_chunks} chunks, all {len(manifest.chunks)} chunks are translated')
+        scheduler = request_scheduler.get_scheduler()
+        # The copies of hedged requests that lost the race are paid for too
+        total_tokens_consumed += scheduler.hedged_tokens
+        print(f'Token consumed: {total_tokens_consumed}, ${total_tokens_consumed / 1000 * PRICE_PER_1K_TOKENS:.3f} dollars.')
+        if cache:
+            print(f'Translation cache: {cache.get_stats()}')
+        if metrics.requests:
+            print(metrics.format_summary())
+        if scheduler.retries or scheduler.hedges:
+            print(f'Retried requests: {scheduler.retries}, hedged requests: {scheduler.hedges}')
+        router = endpoint_router.get_router()
+        if router is not None:
+            print(router.format_status())
 
 def translate(
         source_english_filename: str,
@@ -78,60 +492,259 @@ def translate(
         start_chunk_no=1,
         chunks_to_translate=65535,
         temperature=0.6,
-        max_token_per_request=1365) -> None:
+        max_token_per_request=1365,
+        workers=1,
+        cache=None,
+        stream=False) -> None:
     """
     Translate a text file from English to Simplified Chinese using OpenAI API.
 
+    The chunk plan and the translated chunks are kept in a manifest next to the output
+    (see TranslationManifest), so a rerun skips the chunks that are already done. Up to
+    `workers` chunks are translated concurrently. When the run stops, the output file is
+    assembled atomically from all the translated chunks in chunk order.
+
     :param source_english_filename: Path to the input English text file.
     :param output_chinese_filename: Path to the output Simplified Chinese text file.
     :param start_chunk_no: The chunk number to start translating from.
     :param chunks_to_translate: The number of chunks to be translated.
     :param temperature: Controls the randomness of the AI's response.
     :param max_token_per_request: Maximum number of tokens allowed in one API call.
+    :param workers: Number of chunk requests kept in flight.
+    :param cache: DiskCache of earlier translations, or None to always call the API.
+    :param stream: Whether to memory-map the source and chunk it with bounded memory, for very large sources.
     """
 
-    text = open(source_english_filename, encoding="utf-8").read()
+    with open_source(source_english_filename, stream) as data:
+        manifest = open_manifest(output_chinese_filename, data, max_token_per_request, stream)
+        selected_chunks = manifest.chunks[start_chunk_no - 1:start_chunk_no - 1 + chunks_to_translate]
+        run_translation(data, manifest, output_chinese_filename, selected_chunks, temperature, workers, cache)
 
-    done = False
-    start_pos = 0
-    translated_chunks = 0
-    current_chunk_no = 1
-    total_tokens_consumed = 0
+def get_batch_custom_id(chunk: dict) -> str:
+    """
+    Build the batch request id of a chunk, which stays the same for as long as the chunk plan does.
 
-    # Skip the chunks before start_chunk_no
-    while current_chunk_no < start_chunk_no:
-        chunk_text, start_pos, _, done = get_next_chunk(text, start_pos)
-        current_chunk_no += 1
-    try:
-        while not done and translated_chunks < chunks_to_translate:
-            chunk_text, start_pos, _, done = get_next_chunk(text, start_pos, max_tokens=max_token_per_request)
-            if not chunk_text.strip():
-                continue
-            start_time = time.time()
-            print(f'Request to translate chunk: {current_chunk_no}...', end='', flush=True)
-            translated_text, total_tokens = translate_text(chunk_text, temperature)
-            current_chunk_no += 1
-            translated_chunks += 1
-            total_tokens_consumed += total_tokens
-            end_time = time.time()
-            print(f'Done...Takes {end_time - start_time:.2f} seconds')
-            with open(output_chinese_filename, 'ab') as f:
-                f.write(translated_text.encode('utf-8'))
-
-            # print(f'English tokens: {english_tokens}')
-            # if total_tokens >= 4096:
-            #     print(f'Response has not enough tokens')
-            # print(f'Chinese tokens: {total_tokens-english_tokens}')
-            # print(f'Chinese token Magnification ratio: {(total_tokens-english_tokens) / english_tokens: .2f}')
-    except Exception as e:
-        print(f'Got Exception {e}')
-    except KeyboardInterrupt:
-        print('break')
+    :param chunk: The chunk, as recorded in the translation manifest.
+    :return: Custom id of the batch request.
+    """
+
+    return f"chunk-{chunk['no']:05d}-{chunk['hash'][:16]}"
+
+def emit_batch(
+        source_english_filename: str,
+        output_chinese_filename: str,
+        batch_filename: str,
+        start_chunk_no=1,
+        chunks_to_translate=65535,
+        temperature=0.6,
+        max_token_per_request=1365,
+        stream=False) -> None:
+    """
+    Write one chat completion request per chunk to a JSONL batch file instead of calling the API.
+
+    The chunk plan is the one of the translation manifest, so the results can be
+    ingested into the same output with ingest_batch. Chunks that are already
+    translated are left out.
+
+    :param source_english_filename: Path to the input English text file.
+    :param output_chinese_filename: Path to the output Simplified Chinese text file.
+    :param batch_filename: Path to the JSONL batch file to write.
+    :param start_chunk_no: The chunk number to start translating from.
+    :param chunks_to_translate: The number of chunks to be translated.
+    :param temperature: Controls the randomness of the AI's response.
+    :param max_token_per_request: Maximum number of tokens allowed in one API call.
+    :param stream: Whether to memory-map the source and chunk it with bounded memory.
+    """
+
+    with open_source(source_english_filename, stream) as data:
+        manifest = open_manifest(output_chinese_filename, data, max_token_per_request, stream)
+        selected_chunks = manifest.chunks[start_chunk_no - 1:start_chunk_no - 1 + chunks_to_translate]
+        requests = 0
+        requested_hashes = set()
+        with open(batch_filename, 'w', encoding='utf-8') as f:
+            for chunk in selected_chunks:
+                if manifest.is_done(chunk) or chunk['hash'] in requested_hashes:
+                    continue
+                requested_hashes.add(chunk['hash'])
+                chunk_text = data[chunk['start']:chunk['end']].decode('utf-8')
+                f.write(json.dumps({
+                    'custom_id': get_batch_custom_id(chunk),
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': build_translation_request(chunk_text, temperature),
+                }, ensure_ascii=False) + '\n')
+                requests += 1
+    print(f'Wrote {requests} requests for {len(selected_chunks)} chunks to {batch_filename}')
+
+def ingest_batch(
+        source_english_filename: str,
+        output_chinese_filename: str,
+        results_filename: str,
+        temperature=0.6,
+        max_token_per_request=1365,
+        cache=None,
+        stream=False) -> None:
+    """
+    Record the translations of a batch results file in the manifest and assemble the output.
+
+    Results may come in any order. Failed, malformed and unknown results are reported and
+    skipped, and chunks without a result stay pending, so they can be emitted again or translated
+    with a normal run.
+
+    :param source_english_filename: Path to the input English text file.
+    :param output_chinese_filename: Path to the output Simplified Chinese text file.
+    :param results_filename: Path to the JSONL batch results file.
+    :param temperature: The temperature the batch was emitted with, for the translation cache.
+    :param max_token_per_request: Maximum number of tokens allowed in one API call.
+    :param cache: DiskCache to store the translations in, or None.
+    :param stream: Whether to memory-map the source and chunk it with bounded memory.
+    """
+
+    with open_source(source_english_filename, stream) as data:
+        manifest = open_manifest(output_chinese_filename, data, max_token_per_request, stream)
+        chunks_by_id = {get_batch_custom_id(chunk): chunk for chunk in manifest.chunks}
+        ingested_chunks = 0
+        failed_results = 0
+        unknown_results = 0
+        total_tokens_consumed = 0
+        with open(results_filename, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short or garbled; its chunk stays pending
+                    failed_results += 1
+                    continue
+                if not isinstance(result, dict):
+                    failed_results += 1
+                    continue
+                chunk = chunks_by_id.get(result.get('custom_id'))
+                if chunk is None:
+                    unknown_results += 1
+                    continue
+                response = result.get('response') or {}
+                if result.get('error') or response.get('status_code') != 200:
+                    failed_results += 1
+                    continue
+                try:
+                    body = response['body']
+                    translated_text = body['choices'][0]['message']['content']
+                    total_tokens = (body.get('usage') or {}).get('total_tokens', 0)
+                except (KeyError, IndexError, TypeError, AttributeError):
+                    failed_results += 1
+                    continue
+                if not isinstance(translated_text, str):
+                    failed_results += 1
+                    continue
+                manifest.mark_done(chunk, translated_text, total_tokens, 0)
+                if cache:
+                    chunk_text = data[chunk['start']:chunk['end']].decode('utf-8')
+                    cache.put(get_translation_cache_key(chunk_text, temperature), translated_text)
+                ingested_chunks += 1
+                total_tokens_consumed += total_tokens
+        missing_chunks = manifest.assemble(output_chinese_filename)
+    print(f'Ingested {ingested_chunks} results, {failed_results} failed, {unknown_results} not in the chunk plan')
+    if missing_chunks:
+        print(f'{len(missing_chunks)} chunks are not translated yet, the first one is chunk {missing_chunks[0]}')
     else:
-        print('Translation completed.')
-    finally:
-        print(f'Stopped at chunk {current_chunk_no}, finished {chunks_to_translate} chunks')
-        print(f'Token consumed: {total_tokens_consumed}, ${total_tokens_consumed / 1000 * 0.002:.3f} dollars.')
+        print(f'All {len(manifest.chunks)} chunks are translated')
+    print(f'Token consumed: {total_tokens_consumed}, ${total_tokens_consumed / 1000 * PRICE_PER_1K_TOKENS:.3f} dollars.')
+
+def get_observed_rates(manifest: TranslationManifest, request_overhead: int) -> tuple:
+    """
+    Measure the output tokens and seconds per source token of the chunks already translated through the API.
+
+    :param manifest: Manifest of the translation job.
+    :param request_overhead: Tokens of a request on top of the chunk text.
+    :return: Tuple containing the output token ratio, the seconds per source token and the number of
+        chunks they were measured on; the defaults OUTPUT_TOKEN_RATIO and SECONDS_PER_TOKEN if there are none.
+    """
+
+    source_tokens = output_tokens = seconds = measured = 0
+    for chunk in manifest.chunks:
+        entry = manifest.done.get(chunk['hash'])
+        # Chunks from the cache or a batch took no request time
+        if not entry or not entry['tokens'] or not entry['seconds']:
+            continue
+        source_tokens += chunk['tokens']
+        output_tokens += max(0, entry['tokens'] - chunk['tokens'] - request_overhead)
+        seconds += entry['seconds']
+        measured += 1
+    if not measured:
+        return OUTPUT_TOKEN_RATIO, SECONDS_PER_TOKEN, 0
+    return output_tokens / source_tokens, seconds / source_tokens, measured
+
+def plan_translation(
+        source_english_filename: str,
+        output_chinese_filename: str,
+        start_chunk_no=1,
+        chunks_to_translate=65535,
+        max_token_per_request=1365,
+        workers=1,
+        rpm=0,
+        tpm=0,
+        stream=False) -> None:
+    """
+    Print the chunk plan of a translation with the estimated tokens, cost and time, without calling the API.
+
+    The plan is stored in the translation manifest, so the translation itself starts
+    right away. Output tokens and request times are estimated from the chunks already
+    translated, if any, else from OUTPUT_TOKEN_RATIO and SECONDS_PER_TOKEN.
+
+    :param source_english_filename: Path to the input English text file.
+    :param output_chinese_filename: Path to the output Simplified Chinese text file.
+    :param start_chunk_no: The chunk number to start translating from.
+    :param chunks_to_translate: The number of chunks to be translated.
+    :param max_token_per_request: Maximum number of tokens allowed in one API call.
+    :param workers: Number of chunk requests kept in flight.
+    :param rpm: Requests per minute allowed by the API quota, or 0 for no limit.
+    :param tpm: Tokens per minute allowed by the API quota, or 0 for no limit.
+    :param stream: Whether to memory-map the source and chunk it with bounded memory, for very large sources.
+    """
+
+    start_time = time.time()
+    with open_source(source_english_filename, stream) as data:
+        source_size = len(data)
+        manifest = open_manifest(output_chinese_filename, data, max_token_per_request, stream)
+    plan_seconds = time.time() - start_time
+    selected_chunks = manifest.chunks[start_chunk_no - 1:start_chunk_no - 1 + chunks_to_translate]
+    # The prompt template and the framing of the chat message
+    request_overhead = get_tokens(PROMPT_TEMPLATE.format(text='')) + 7
+    output_ratio, seconds_per_token, measured = get_observed_rates(manifest, request_overhead)
+
+    print(f"{'Chunk':>7}{'Input':>9}{'Output':>9}{'Cost $':>10}{'Seconds':>9}  Status")
+    pending = 0
+    input_tokens = output_tokens = request_seconds = 0.0
+    for chunk in selected_chunks:
+        chunk_input = chunk['tokens'] + request_overhead
+        chunk_output = round(chunk['tokens'] * output_ratio)
+        chunk_seconds = chunk['tokens'] * seconds_per_token
+        status = manifest.status(chunk)
+        print(f"{chunk['no']:>7}{chunk_input:>9}{chunk_output:>9}"
+              f"{(chunk_input + chunk_output) / 1000 * PRICE_PER_1K_TOKENS:>10.4f}{chunk_seconds:>9.1f}  {status}")
+        if status == 'pending':
+            pending += 1
+            input_tokens += chunk_input
+            output_tokens += chunk_output
+            request_seconds += chunk_seconds
+
+    total_tokens = input_tokens + output_tokens
+    # The slowest of the workers, the request quota and the token quota sets the pace
+    wall_seconds = max(
+        request_seconds / workers,
+        pending / rpm * 60 if rpm else 0,
+        total_tokens / tpm * 60 if tpm else 0,
+    )
+    basis = f'observed on {measured} chunks' if measured else 'defaults, no chunk translated yet'
+    print(f'Source: {source_size / 1024 / 1024:.1f} MB in {len(manifest.chunks)} chunks, planned in {plan_seconds:.1f} seconds')
+    print(f'Selected: {len(selected_chunks)} chunks, {len(selected_chunks) - pending} done, {pending} to translate')
+    print(f'Input tokens: {input_tokens:.0f}, estimated output tokens: {output_tokens:.0f} '
+          f'({output_ratio:.2f} per input token, {basis})')
+    print(f'Estimated cost: ${total_tokens / 1000 * PRICE_PER_1K_TOKENS:.2f}')
+    print(f'Estimated time: {wall_seconds / 60:.1f} minutes with {workers} workers '
+          f'({seconds_per_token * 1000:.1f} seconds per 1000 input tokens)')
 
 def get_arguments():
     """
@@ -149,22 +762,77 @@ def get_arguments():
     parser.add_argument('--chunks', help='The number of chunks to be translated', type=int, default=65536)
     parser.add_argument('--temperature', help="API's temperature parameter (0~2.0)", type=float, default=0.6)
     parser.add_argument('--tokens', help='Maximum number of English tokens in one API call', type=int, default=1365)
+    parser.add_argument('--workers', help='Number of chunks translated concurrently', type=int, default=1)
+    parser.add_argument('--stream', help='Memory-map the source and chunk it incrementally, for very large sources', action='store_true')
+    parser.add_argument('--emit-batch', help='Write the chunk requests to this JSONL batch file instead of calling the API', metavar='FILE')
+    parser.add_argument('--plan', help='Print the chunk plan with estimated tokens, cost and time, without calling the API', action='store_true')
+    parser.add_argument('--ingest-batch', help='Build the output from this JSONL batch results file', metavar='FILE')
+    parser.add_argument('--no-cache', help='Do not use the local translation cache', action='store_true')
+    parser.add_argument('--cache-size', help='Maximum size of the translation cache in MB', type=int, default=256)
+    parser.add_argument('--rpm', help='Requests per minute allowed by the API quota (0 for no limit)', type=int,
+                        default=request_scheduler.OPENAI_RPM_LIMIT)
+    parser.add_argument('--tpm', help='Tokens per minute allowed by the API quota (0 for no limit)', type=int,
+                        default=request_scheduler.OPENAI_TPM_LIMIT)
+    parser.add_argument('--hedge-after', help='Send a second copy of requests slower than this many seconds (0 to never)',
+                        type=float, default=request_scheduler.OPENAI_HEDGE_AFTER)
 
     args = parser.parse_args()
     return args
 
 if __name__ == '__main__':
     arg = get_arguments()
-    set_openapi_conf(arg.api_key, arg.api_base)
-    if not openai.api_key:
-        print('API KEY is not configured')
-        exit(1)
-
     source_file = Path(arg.source)
     if not source_file.is_file():
         print(f'{arg.source} is not available')
         exit(1)
 
+    cache = None
+    if not arg.no_cache:
+        cache = DiskCache(TRANSLATION_CACHE_FILENAME, max_bytes=arg.cache_size * 1024 * 1024)
+
+    if arg.plan:
+        plan_translation(
+            source_english_filename=arg.source,
+            output_chinese_filename=arg.output,
+            start_chunk_no=arg.start,
+            chunks_to_translate=arg.chunks,
+            max_token_per_request=arg.tokens,
+            workers=arg.workers,
+            rpm=arg.rpm,
+            tpm=arg.tpm,
+            stream=arg.stream,
+        )
+        exit(0)
+    if arg.emit_batch:
+        emit_batch(
+            source_english_filename=arg.source,
+            output_chinese_filename=arg.output,
+            batch_filename=arg.emit_batch,
+            start_chunk_no=arg.start,
+            chunks_to_translate=arg.chunks,
+            temperature=arg.temperature,
+            max_token_per_request=arg.tokens,
+            stream=arg.stream,
+        )
+        exit(0)
+    if arg.ingest_batch:
+        ingest_batch(
+            source_english_filename=arg.source,
+            output_chinese_filename=arg.output,
+            results_filename=arg.ingest_batch,
+            temperature=arg.temperature,
+            max_token_per_request=arg.tokens,
+            cache=cache,
+            stream=arg.stream,
+        )
+        exit(0)
+
+    set_openapi_conf(arg.api_key, arg.api_base)
+    if not openai.api_key:
+        print('API KEY is not configured')
+        exit(1)
+    request_scheduler.configure(rpm=arg.rpm, tpm=arg.tpm, hedge_after=arg.hedge_after)
+
     translate(
         source_english_filename=arg.source,
         output_chinese_filename=arg.output,
@@ -172,4 +840,7 @@ if __name__ == '__main__':
         chunks_to_translate=arg.chunks,
         temperature=arg.temperature,
         max_token_per_request=arg.tokens,
+        workers=arg.workers,
+        cache=cache,
+        stream=arg.stream,
     )
@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from collections.abc import Callable
+
+MANIFEST_VERSION = 1
+
+
+def _write_atomically(path: Path, data: bytes):
+    """
+    Write a file so that readers see either the old or the new content, never a partial one.
+
+    :param path: Path of the file.
+    :param data: New content.
+    """
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _back_up(path: Path) -> Path:
+    """
+    Rename a file to the first free `<name>.bak`, `<name>.bak1`, ... next to it.
+
+    :param path: Path of the file.
+    :return: Path of the backup.
+    """
+
+    backup_path = path.with_name(path.name + '.bak')
+    number = 0
+    while backup_path.exists():
+        number += 1
+        backup_path = path.with_name(f'{path.name}.bak{number}')
+    os.replace(path, backup_path)
+    return backup_path
+
+
+class TranslationManifest:
+    """
+    On-disk state of a translation job, kept in a `<output>.parts` directory next to the output.
+
+    manifest.json holds the source fingerprint and the chunk plan, each chunk with the
+    hash of its content. Every translated chunk is stored as its own file named after
+    that hash, and done.jsonl is an append-only journal of the finished chunks. A crash
+    can at worst lose the chunk being written, never corrupt the ones already done.
+
+    The output file is rewritten from the chunks by `assemble`. An output that no manifest
+    tracks yet, e.g. one appended to by runs before manifests existed, is moved to a
+    backup when the manifest is created, so that its translations are never lost.
+    """
+
+    def __init__(self, directory: Path, manifest: dict):
+        self.directory = directory
+        self.manifest = manifest
+        # Where an untracked output file was moved to by `open`, or None
+        self.backup_path = None
+        self.done = {}
+        journal = directory / 'done.jsonl'
+        if journal.exists():
+            for line in journal.read_text(encoding='utf-8').splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash; its chunk is simply translated again
+                    continue
+                if (directory / entry['output']).exists():
+                    self.done[entry['hash']] = entry
+
+    @property
+    def chunks(self) -> list:
+        """The chunk plan, as a list of dicts with no, start, end, tokens and hash."""
+        return self.manifest['chunks']
+
+    @staticmethod
+    def fingerprint(data: bytes) -> str:
+        """
+        Hash the content of a chunk or of the whole source.
+
+        :param data: Bytes to be hashed.
+        :return: Hex digest.
+        """
+
+        return hashlib.sha256(data).hexdigest()
+
+    @classmethod
+    def open(cls, output_filename: str, source_data: bytes, max_tokens: int, planner: Callable):
+        """
+        Load the manifest of an output file, or plan the chunks and create it.
+
+        The saved chunk plan is reused as long as the source content and the token limit
+        are unchanged, so a rerun does not tokenize the source again. Otherwise the plan
+        is rebuilt; chunks whose content did not change keep their translations. When
+        there is no manifest yet but the output file exists, the file is moved to a
+        backup, see `backup_path`.
+
+        :param output_filename: Path of the translated output.
+        :param source_data: UTF-8 encoded source text.
+        :param max_tokens: Maximum number of tokens allowed for a chunk.
+        :param planner: Callable taking the source data and max_tokens, returning a list of Chunk.
+        :return: TranslationManifest.
+        """
+
+        directory = Path(f'{output_filename}.parts')
+        manifest_path = directory / 'manifest.json'
+        source_hash = cls.fingerprint(source_data)
+        if manifest_path.exists():
+            manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+            if (manifest.get('version') == MANIFEST_VERSION
+                    and manifest['source_hash'] == source_hash
+                    and manifest['max_tokens'] == max_tokens):
+                return cls(directory, manifest)
+        backup_path = None
+        output_path = Path(output_filename)
+        if not manifest_path.exists() and output_path.exists() and output_path.stat().st_size > 0:
+            backup_path = _back_up(output_path)
+        directory.mkdir(parents=True, exist_ok=True)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'source_hash': source_hash,
+            'max_tokens': max_tokens,
+            'chunks': [
+                {
+                    'no': no,
+                    'start': chunk.start,
+                    'end': chunk.end,
+                    'tokens': chunk.tokens,
+                    'hash': cls.fingerprint(source_data[chunk.start:chunk.end]),
+                }
+                for no, chunk in enumerate(planner(source_data, max_tokens), start=1)
+            ],
+        }
+        _write_atomically(manifest_path, json.dumps(manifest).encode('utf-8'))
+        translation_manifest = cls(directory, manifest)
+        translation_manifest.backup_path = backup_path
+        return translation_manifest
+
+    def is_done(self, chunk: dict) -> bool:
+        """Whether the chunk has been translated."""
+        return chunk['hash'] in self.done
+
+    def status(self, chunk: dict) -> str:
+        """The status of the chunk: 'done' or 'pending'."""
+        return 'done' if self.is_done(chunk) else 'pending'
+
+    def mark_done(self, chunk: dict, translated_text: str, tokens: int, seconds: float):
+        """
+        Store the translation of a chunk and record it in the journal.
+
+        :param chunk: The chunk, as found in `chunks`.
+        :param translated_text: Its translation.
+        :param tokens: Number of tokens used by the request.
+        :param seconds: Time the request took.
+        """
+
+        output = f"{chunk['hash']}.txt"
+        _write_atomically(self.directory / output, translated_text.encode('utf-8'))
+        entry = {'hash': chunk['hash'], 'no': chunk['no'], 'output': output, 'tokens': tokens, 'seconds': round(seconds, 3)}
+        with open(self.directory / 'done.jsonl', 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.done[chunk['hash']] = entry
+
+    def assemble(self, output_filename: str) -> list:
+        """
+        Atomically write the output file from the translations of the done chunks, in chunk order.
+
+        :param output_filename: Path of the translated output.
+        :return: List of the numbers of the chunks that are not translated yet.
+        """
+
+        missing = []
+        output_path = Path(output_filename)
+        tmp_path = output_path.with_name(output_path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            for chunk in self.chunks:
+                if self.is_done(chunk):
+                    f.write((self.directory / self.done[chunk['hash']]['output']).read_bytes())
+                else:
+                    missing.append(chunk['no'])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+        return missing